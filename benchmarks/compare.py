@@ -0,0 +1,69 @@
+import argparse
+import json
+import sys
+
+
+# for these a higher value is better, for all others a lower one
+HIGHER_IS_BETTER = ("throughput_per_s", "delivered_per_s")
+COMPARED = ("p50_ms", "p99_ms", "throughput_per_s", "latency_p50_ms", "latency_p99_ms", "delivered_per_s",
+            "peak_rss_bytes")
+
+
+def flatten(results: dict, prefix: str="") -> dict:
+    values = dict()
+    for key, value in results.items():
+        name = "{0}.{1}".format(prefix, key) if prefix else key
+        if isinstance(value, dict):
+            values.update(flatten(value, name))
+        elif key in COMPARED and isinstance(value, (int, float)):
+            values[name] = value
+    return values
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> tuple:
+    """
+    Rows of (metric, baseline, current, change) for the metrics of both
+    results, and the metrics which got worse by more than threshold.
+    """
+    before = flatten(baseline["scenarios"])
+    after = flatten(current["scenarios"])
+    rows = []
+    regressions = []
+    for name in sorted(set(before) & set(after)):
+        if not before[name]:
+            continue
+        change = (after[name] - before[name]) / float(before[name])
+        rows.append((name, before[name], after[name], change))
+        worse = -change if name.rsplit(".", 1)[-1] in HIGHER_IS_BETTER else change
+        if worse > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark results of benchmarks/run.py")
+    parser.add_argument("baseline",
+                        help="Use 'baseline' argument to specify the results to compare against")
+    parser.add_argument("current",
+                        help="Use 'current' argument to specify the results to compare")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=10,
+                        help="Use '--threshold' option to specify the percent a metric may get worse by")
+
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    rows, regressions = compare(baseline, current, args.threshold / 100.0)
+    print("{0} ({1}) -> {2} ({3})".format(args.baseline, (baseline.get("commit") or "unknown")[:12],
+                                           args.current, (current.get("commit") or "unknown")[:12]))
+    width = max([len(name) for name, _, _, _ in rows] or [0])
+    for name, before, after, change in rows:
+        print("{0:<{width}}  {1:>14.3f}  {2:>14.3f}  {3:>+8.1%}{4}".format(
+            name, before, after, change, "  !" if name in regressions else "", width=width))
+    if regressions:
+        print("{0} metrics regressed by more than {1}%".format(len(regressions), args.threshold))
+        sys.exit(1)
@@ -0,0 +1,528 @@
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from standin import StandInServer
+
+
+# the broker is run from the checkout as python -m opcua_broker
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+opcua_service_class_id = "00000000-0000-0000-0000-000000000000"
+discovery_service_plan_id = "00000000-0000-0000-0000-000000000001"
+node_management_service_plan_id = "00000000-0000-0000-0000-000000000002"
+data_change_service_plan_id = "00000000-0000-0000-0000-000000000004"
+
+HEADERS = {"X-Broker-Api-Version": "2.13", "Content-Type": "application/json"}
+OBJECTS_FOLDER = 85
+VARIABLE_NODE_CLASS = 2
+
+
+class BrokerProcess(object):
+    """
+    The broker run as its own process, like in production, so that its memory
+    is measured apart from the stand-in server and the load generator.
+    """
+
+    def __init__(self, port: int, url: str, asgi: bool=False, args: list=(), log: str=None, timeout: float=300,
+                 **kwargs):
+        self.port = port
+        self.url = url
+        self.asgi = asgi
+        self.args = list(args)
+        self.log = log
+        self.timeout = timeout
+        self.process = None
+
+    def start(self, ready_timeout: float=60, poll_interval: float=0.1) -> float:
+        """
+        Start the broker and wait for its first successful /v2/catalog,
+        returning the seconds that took.
+        """
+        command = [sys.executable, "-m", "opcua_broker", "-p", "http://127.0.0.1:{0}".format(self.port),
+                   "-u", self.url]
+        if self.asgi:
+            command.append("--asgi")
+        log = open(self.log, "w") if self.log else subprocess.DEVNULL
+        start = time.perf_counter()
+        self.process = subprocess.Popen(command + self.args, stdout=log, stderr=log, cwd=ROOT)
+        deadline = time.time() + ready_timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("the broker exited with {0}".format(self.process.returncode))
+            try:
+                if self.request("GET", "/v2/catalog")[0] == 200:
+                    return time.perf_counter() - start
+            except OSError:
+                time.sleep(poll_interval)
+        raise RuntimeError("the broker did not answer within {0}s".format(ready_timeout))
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+    def request(self, method: str, path: str, body: dict=None, query: dict=None) -> tuple:
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+        try:
+            if query:
+                path += "?" + urlencode(query)
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=HEADERS)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def stream(self, binding_id: str):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+        conn.request("GET", "/opcua/bindings/{0}/stream?format=ndjson".format(binding_id))
+        response = conn.getresponse()
+        if response.status != 200:
+            conn.close()
+            raise RuntimeError("stream of binding {0} answered {1}".format(binding_id, response.status))
+        return response
+
+    def memory(self) -> dict:
+        # resident and peak resident set size of the broker, from procfs
+        memory = dict(rss_bytes=None, peak_rss_bytes=None)
+        try:
+            with open("/proc/{0}/status".format(self.process.pid)) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        memory["rss_bytes"] = int(line.split()[1]) * 1024
+                    elif line.startswith("VmHWM:"):
+                        memory["peak_rss_bytes"] = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return memory
+
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[max(0, int(math.ceil(q / 100.0 * len(samples))) - 1)]
+
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    return dict(count=len(latencies),
+                errors=errors,
+                p50_ms=round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+                p99_ms=round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+                mean_ms=round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                max_ms=round(max(latencies) * 1000, 3) if latencies else None,
+                throughput_per_s=round(len(latencies) / elapsed, 3) if elapsed > 0 else None)
+
+
+def run_phase(broker: BrokerProcess, requests: list, concurrency: int) -> dict:
+    """
+    Send requests, a list of (method, path, body, query), concurrency at a
+    time and summarize their latencies. Any answer but 2xx is an error.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def send(request):
+        start = time.perf_counter()
+        try:
+            status, body = broker.request(*request)
+        except OSError as e:
+            logging.error("%s %s failed: %s", request[0], request[1], e)
+            status = None
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+            if status is None or status // 100 != 2:
+                errors[0] += 1
+                if status is not None:
+                    logging.error("%s %s answered %s: %s", request[0], request[1], status, body[:200])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, requests))
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def provision_request(instance_id: str, plan_id: str, parameters: dict) -> tuple:
+    return ("PUT", "/v2/service_instances/{0}".format(instance_id),
+            dict(service_id=opcua_service_class_id, plan_id=plan_id, organization_guid="benchmark",
+                 space_guid="benchmark", parameters=parameters), None)
+
+
+def bind_request(instance_id: str, binding_id: str, plan_id: str, parameters: dict=None) -> tuple:
+    return ("PUT", "/v2/service_instances/{0}/service_bindings/{1}".format(instance_id, binding_id),
+            dict(service_id=opcua_service_class_id, plan_id=plan_id, bind_resource=dict(app_guid="benchmark"),
+                 parameters=parameters or dict()), None)
+
+
+def unbind_request(instance_id: str, binding_id: str, plan_id: str) -> tuple:
+    return ("DELETE", "/v2/service_instances/{0}/service_bindings/{1}".format(instance_id, binding_id), None,
+            dict(service_id=opcua_service_class_id, plan_id=plan_id))
+
+
+def deprovision_request(instance_id: str, plan_id: str) -> tuple:
+    return ("DELETE", "/v2/service_instances/{0}".format(instance_id), None,
+            dict(service_id=opcua_service_class_id, plan_id=plan_id))
+
+
+def lifecycle(broker: BrokerProcess, plan_id: str, instances: list, concurrency: int) -> dict:
+    """
+    Provision, bind, unbind and deprovision instances, a list of
+    (instance_id, parameters), each phase for all of them before the next.
+    """
+    operations = dict()
+    operations["provision"] = run_phase(broker, [provision_request(instance_id, plan_id, parameters)
+                                                 for instance_id, parameters in instances], concurrency)
+    operations["bind"] = run_phase(broker, [bind_request(instance_id, instance_id + "-binding", plan_id)
+                                            for instance_id, _ in instances], concurrency)
+    operations["unbind"] = run_phase(broker, [unbind_request(instance_id, instance_id + "-binding", plan_id)
+                                              for instance_id, _ in instances], concurrency)
+    operations["deprovision"] = run_phase(broker, [deprovision_request(instance_id, plan_id)
+                                                   for instance_id, _ in instances], concurrency)
+    return operations
+
+
+def bench_catalog(broker: BrokerProcess, server: StandInServer, args, run_id: str) -> dict:
+    operations = dict(catalog=run_phase(broker, [("GET", "/v2/catalog", None, None)] * args.iterations,
+                                        args.concurrency))
+    return dict(operations=operations, memory=broker.memory())
+
+
+def bench_startup(broker: BrokerProcess, server: StandInServer, args, run_id: str) -> dict:
+    """
+    Start the broker args.startups times, apart from the one the other
+    scenarios use, and summarize the time to its first /v2/catalog.
+    """
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(args.startups):
+        started = BrokerProcess(args.broker_port + 1, server.url, asgi=args.asgi, args=broker_args(args))
+        try:
+            latencies.append(started.start(poll_interval=0.002))
+        except (OSError, RuntimeError) as e:
+            logging.error("start %d failed: %s", i, e)
+            errors += 1
+        finally:
+            started.stop()
+    return dict(operations=dict(first_catalog=summarize(latencies, errors, time.perf_counter() - start)))
+
+
+def bench_discovery(broker: BrokerProcess, server: StandInServer, args, run_id: str) -> dict:
+    instances = [("bench-{0}-discovery-{1}".format(run_id, i), dict(discovery_url=server.url))
+                 for i in range(args.iterations)]
+    return dict(operations=lifecycle(broker, discovery_service_plan_id, instances, args.concurrency),
+                memory=broker.memory())
+
+
+def nodes_to_add(prefix: str, count: int) -> list:
+    folder = "ns=2;s={0}".format(prefix)
+    nodes = [dict(browseName="2:" + prefix, nodeClass=1, parentNodeId=OBJECTS_FOLDER, requestedNewNodeId=folder)]
+    nodes.extend(dict(browseName="2:v{0}".format(i), nodeClass=VARIABLE_NODE_CLASS, parentNodeId=folder,
+                      requestedNewNodeId="{0}.{1}".format(folder, i)) for i in range(count))
+    return nodes
+
+
+def bench_nodes(broker: BrokerProcess, server: StandInServer, args, run_id: str) -> dict:
+    results = dict()
+    for count in args.node_counts:
+        # bigger instances are provisioned fewer times, to keep the run short
+        iterations = max(1, min(args.iterations, args.node_budget // count))
+        instances = []
+        for i in range(iterations):
+            instance_id = "bench-{0}-nodes-{1}-{2}".format(run_id, count, i)
+            instances.append((instance_id, dict(url=server.admin_url, nodesToAdd=nodes_to_add(instance_id, count))))
+        results[str(count)] = dict(operations=lifecycle(broker, node_management_service_plan_id, instances,
+                                                        args.concurrency),
+                                   memory=broker.memory())
+    return results
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    # python-opcua timestamps are naive UTC, asyncua ones carry the offset
+    if isinstance(value, str) and value.endswith("+00:00"):
+        value = value[:-6]
+    for layout in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, layout)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def read_stream(response, since: datetime.datetime, latencies: list, counts: dict, lock: threading.Lock):
+    # records are [node id, value, source timestamp, status]; the delivery
+    # latency is taken from the source timestamp set by the stand-in, and the
+    # initial values sent for new monitored items, written before since, are
+    # left out
+    try:
+        for line in response:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line.decode("utf-8"))
+            received = datetime.datetime.utcnow()
+            with lock:
+                if isinstance(record, dict):
+                    counts["dropped"] += record.get("dropped", 0)
+                    continue
+                source = parse_timestamp(record[2])
+                if source is None or source < since:
+                    continue
+                counts["delivered"] += 1
+                latencies.append((received - source).total_seconds())
+    except (OSError, http.client.HTTPException, ValueError):
+        pass
+    finally:
+        response.close()
+
+
+def bench_subscriptions(broker: BrokerProcess, server: StandInServer, args, run_id: str) -> dict:
+    instance_id = "bench-{0}-subscription".format(run_id)
+    binding_ids = ["{0}-binding-{1}".format(instance_id, i) for i in range(args.bindings)]
+    plan_id = data_change_service_plan_id
+    parameters = dict(url=server.url, nodes=server.node_ids(args.subscription_nodes),
+                      publishingInterval=args.publishing_interval)
+
+    operations = dict()
+    operations["provision"] = run_phase(broker, [provision_request(instance_id, plan_id, parameters)], 1)
+    operations["bind"] = run_phase(broker, [bind_request(instance_id, binding_id, plan_id,
+                                                         dict(bufferSize=args.buffer_size))
+                                            for binding_id in binding_ids], args.concurrency)
+
+    latencies = []
+    counts = dict(delivered=0, dropped=0)
+    lock = threading.Lock()
+    readers = []
+    since = datetime.datetime.utcnow()
+    for binding_id in binding_ids:
+        reader = threading.Thread(target=read_stream,
+                                  args=(broker.stream(binding_id), since, latencies, counts, lock))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+
+    rounds = server.start_updates(args.subscription_nodes, args.update_interval / 1000.0)
+    start = time.perf_counter()
+    time.sleep(args.duration)
+    server.stop_updates()
+    elapsed = time.perf_counter() - start
+    # let the last publish of the subscription reach the streams
+    time.sleep(max(1.0, 3 * args.publishing_interval / 1000.0))
+    memory = broker.memory()
+
+    operations["unbind"] = run_phase(broker, [unbind_request(instance_id, binding_id, plan_id)
+                                              for binding_id in binding_ids], args.concurrency)
+    for reader in readers:
+        reader.join(10)
+    operations["deprovision"] = run_phase(broker, [deprovision_request(instance_id, plan_id)], 1)
+
+    with lock:
+        notifications = dict(expected=rounds[0] * args.subscription_nodes * args.bindings,
+                             delivered=counts["delivered"],
+                             dropped=counts["dropped"],
+                             delivered_per_s=round(counts["delivered"] / elapsed, 3),
+                             latency_p50_ms=round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+                             latency_p99_ms=round(percentile(latencies, 99) * 1000, 3) if latencies else None)
+    return dict(operations=operations, notifications=notifications, memory=memory)
+
+
+SCENARIOS = dict(startup=bench_startup,
+                 catalog=bench_catalog,
+                 discovery=bench_discovery,
+                 nodes=bench_nodes,
+                 subscriptions=bench_subscriptions)
+
+
+def git_revision() -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                                             stderr=subprocess.DEVNULL).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return dict(commit=None, dirty=None)
+    return dict(commit=commit, dirty=dirty)
+
+
+def failures(results: dict, path: str="") -> list:
+    """
+    The dotted paths of the operations in results which had errors.
+    """
+    failed = []
+    for key, value in sorted(results.items()):
+        name = "{0}.{1}".format(path, key) if path else key
+        if isinstance(value, dict):
+            failed.extend(failures(value, name))
+        elif key == "errors" and value:
+            failed.append(path)
+    return failed
+
+
+def broker_args(args) -> list:
+    # The stand-in server answers one request at a time and deletes a node in
+    # time growing with its address space, so the requests of instances
+    # deprovisioned together queue far longer than the broker's default
+    # request timeout allows, and hold their sessions meanwhile: every
+    # request sent at once gets a session of its own. Extra broker args may
+    # still override both.
+    return (["--request-timeout", str(args.request_timeout), "--max-sessions", str(args.concurrency)] +
+            args.broker_args.split())
+
+
+def int_list(value: str) -> list:
+    return [int(item) for item in value.split(",") if item]
+
+
+def str_list(value: str) -> list:
+    names = [item for item in value.split(",") if item]
+    for name in names:
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError("unknown scenario {0}, choose from {1}".format(
+                name, ", ".join(sorted(SCENARIOS))))
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the broker against an in-process stand-in OPC UA server")
+    parser.add_argument("--scenarios",
+                        type=str_list,
+                        default=["startup", "catalog", "discovery", "nodes", "subscriptions"],
+                        help="Use '--scenarios' option to specify the comma separated scenarios to run")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=8,
+                        help="Use '--concurrency' option to specify the requests sent to the broker at once")
+    parser.add_argument("--iterations",
+                        type=int,
+                        default=50,
+                        help="Use '--iterations' option to specify the requests or instances per phase")
+    parser.add_argument("--startups",
+                        type=int,
+                        default=10,
+                        help="Use '--startups' option to specify how many times the broker is started to time it")
+    parser.add_argument("--node-counts",
+                        type=int_list,
+                        default=[10, 100, 1000],
+                        help="Use '--node-counts' option to specify the comma separated nodes per provisioned instance")
+    parser.add_argument("--node-budget",
+                        type=int,
+                        default=5000,
+                        help="Use '--node-budget' option to cap the nodes added per node count, fewer instances "
+                             "being provisioned for the bigger counts")
+    parser.add_argument("--address-space",
+                        type=int,
+                        default=1000,
+                        help="Use '--address-space' option to specify the variables of the stand-in server")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0,
+                        help="Use '--latency' option to specify the milliseconds of round trip added to OPC UA requests")
+    parser.add_argument("--bindings",
+                        type=int,
+                        default=50,
+                        help="Use '--bindings' option to specify the bindings sharing the subscription")
+    parser.add_argument("--subscription-nodes",
+                        type=int,
+                        default=100,
+                        help="Use '--subscription-nodes' option to specify the monitored variables")
+    parser.add_argument("--publishing-interval",
+                        type=int,
+                        default=100,
+                        help="Use '--publishing-interval' option to specify the subscription publishing interval in ms")
+    parser.add_argument("--update-interval",
+                        type=float,
+                        default=100,
+                        help="Use '--update-interval' option to specify the ms between writes of the monitored variables")
+    parser.add_argument("--buffer-size",
+                        type=int,
+                        default=10000,
+                        help="Use '--buffer-size' option to specify the notification buffer of each binding")
+    parser.add_argument("--duration",
+                        type=float,
+                        default=10,
+                        help="Use '--duration' option to specify the seconds the monitored variables are updated")
+    parser.add_argument("--asgi",
+                        action="store_true",
+                        help="Use '--asgi' option to benchmark the broker served from ASGI")
+    parser.add_argument("--broker-port",
+                        type=int,
+                        default=5600,
+                        help="Use '--broker-port' option to specify the port the benchmarked broker listens on")
+    parser.add_argument("--server-port",
+                        type=int,
+                        default=4850,
+                        help="Use '--server-port' option to specify the port of the stand-in OPC UA server")
+    parser.add_argument("--request-timeout",
+                        type=float,
+                        default=60,
+                        help="Use '--request-timeout' option to specify the seconds an OPC UA request of the broker "
+                             "may take")
+    parser.add_argument("--broker-args",
+                        default="",
+                        help="Use '--broker-args' option to pass extra space separated options to the broker")
+    parser.add_argument("--broker-log",
+                        default=None,
+                        help="Use '--broker-log' option to keep the broker output in a file")
+    parser.add_argument("-o",
+                        "--output",
+                        default=None,
+                        help="Use '--output' option to specify the JSON results file, "
+                             "benchmarks/results/<commit>.json by default")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+
+    revision = git_revision()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                         "{0}.json".format((revision["commit"] or "unknown")[:12]))
+    run_id = uuid.uuid4().hex[:8]
+
+    server = StandInServer(port=args.server_port, nodes=max(args.address_space, args.subscription_nodes),
+                           latency=args.latency / 1000.0)
+    server.start()
+    broker = BrokerProcess(args.broker_port, server.url, asgi=args.asgi, args=broker_args(args),
+                           log=args.broker_log)
+    try:
+        broker.start()
+        results = dict(revision,
+                       created=datetime.datetime.utcnow().isoformat() + "Z",
+                       python=platform.python_version(),
+                       platform=platform.platform(),
+                       config=vars(args),
+                       startup_memory=broker.memory(),
+                       scenarios=dict())
+        for name in args.scenarios:
+            print("running {0}".format(name), file=sys.stderr)
+            results["scenarios"][name] = SCENARIOS[name](broker, server, args, run_id)
+    finally:
+        broker.stop()
+        server.stop()
+
+    # results with errors are kept for looking into, but flagged, and the run
+    # fails
+    results["failed"] = failures(results["scenarios"])
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(json.dumps(results["scenarios"], indent=2, sort_keys=True))
+    print("results written to {0}".format(output), file=sys.stderr)
+    if results["failed"]:
+        print("operations with errors: {0}".format(", ".join(results["failed"])), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+import logging
+import threading
+
+from opcua import Server, ua
+
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE_URI = "urn:opcua-broker:benchmark"
+
+
+class LatencyProxy(object):
+    """
+    TCP proxy in front of the stand-in server which holds every chunk for
+    half the latency in each direction, so each OPC UA request pays one
+    round trip of latency like it would against a device on the network.
+    """
+
+    def __init__(self, target_port: int, latency: float, host: str="127.0.0.1", **kwargs):
+        self.target_port = target_port
+        self.latency = latency
+        self.host = host
+        self.port = None
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+
+    def start(self) -> int:
+        self._thread = threading.Thread(target=self._run, name="benchmark-latency-proxy")
+        self._thread.daemon = True
+        self._thread.start()
+        self._started.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._accept, self.host, 0))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._server.close()
+            self._loop.close()
+
+    async def _accept(self, reader, writer):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(self.host, self.target_port)
+        except OSError as e:
+            logger.error("Latency proxy could not reach the stand-in server: %s", e)
+            writer.close()
+            return
+        await asyncio.gather(self._pipe(reader, upstream_writer), self._pipe(upstream_reader, writer))
+
+    async def _pipe(self, reader, writer):
+        # chunks are released in order once they are due, so a burst of
+        # requests is delayed as a whole rather than serialized
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not data:
+                    writer.close()
+                    return
+                writer.write(data)
+                await writer.drain()
+
+        delivery = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                queue.put_nowait((loop.time() + self.latency / 2, data))
+                if not data:
+                    break
+            await delivery
+        except (OSError, asyncio.IncompleteReadError):
+            delivery.cancel()
+            writer.close()
+
+
+class StandInServer(object):
+    """
+    In-process opcua.Server standing in for a device, with an address space
+    of nodes Int64 variables in folders of folder_size below Objects/Benchmark
+    and latency seconds of round trip added to every request.
+    """
+
+    def __init__(self, port: int=4850, nodes: int=1000, folder_size: int=100, latency: float=0, **kwargs):
+        self.port = port
+        self.nodes = nodes
+        self.folder_size = folder_size
+        self.latency = latency
+        self.variables = []
+        self.server = None
+        self._proxy = None
+        self._updater = None
+        self._updating = threading.Event()
+
+    @property
+    def url(self) -> str:
+        port = self._proxy.port if self._proxy is not None else self.port
+        return "opc.tcp://127.0.0.1:{0}".format(port)
+
+    @property
+    def admin_url(self) -> str:
+        # the default user manager of python-opcua grants AddNodes and
+        # DeleteNodes to the "admin" user only
+        return self.url.replace("opc.tcp://", "opc.tcp://admin@", 1)
+
+    def start(self):
+        self.server = Server()
+        self.server.set_endpoint("opc.tcp://127.0.0.1:{0}".format(self.port))
+        self.server.set_server_name("opcua-broker benchmark stand-in")
+        idx = self.server.register_namespace(NAMESPACE_URI)
+        root = self.server.get_objects_node().add_folder(idx, "Benchmark")
+        folder = None
+        for i in range(self.nodes):
+            if i % self.folder_size == 0:
+                folder = root.add_folder(idx, "Folder{0}".format(i // self.folder_size))
+            self.variables.append(folder.add_variable(idx, "Variable{0}".format(i), 0))
+        self.server.start()
+        if self.latency > 0:
+            self._proxy = LatencyProxy(self.port, self.latency)
+            self._proxy.start()
+
+    def stop(self):
+        self.stop_updates()
+        if self._proxy is not None:
+            self._proxy.stop()
+        if self.server is not None:
+            self.server.stop()
+
+    def node_ids(self, count: int) -> list:
+        return [variable.nodeid.to_string() for variable in self.variables[:count]]
+
+    def start_updates(self, count: int, interval: float) -> list:
+        """
+        Write a new value with the current source timestamp to the first count
+        variables every interval seconds until stop_updates(); returns a list
+        counting the rounds written so far.
+        """
+        rounds = [0]
+        self._updating.clear()
+
+        def update():
+            value = 0
+            while not self._updating.wait(interval):
+                value += 1
+                for variable in self.variables[:count]:
+                    data_value = ua.DataValue(ua.Variant(value, ua.VariantType.Int64))
+                    data_value.SourceTimestamp = datetime.datetime.utcnow()
+                    variable.set_value(data_value)
+                rounds[0] += 1
+
+        self._updater = threading.Thread(target=update, name="benchmark-updates")
+        self._updater.daemon = True
+        self._updater.start()
+        return rounds
+
+    def stop_updates(self):
+        self._updating.set()
+        if self._updater is not None:
+            self._updater.join()
+            self._updater = None
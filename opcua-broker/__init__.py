@@ -1,21 +0,0 @@
-
-from . import openbrokerapi.api
-from . import handler
-from . import (
-    openbrokerapi.catalog.ServicePlan,
-    openbrokerapi.catalog.Schemas
-)
-from openbrokerapi.service_broker import (
-    ServiceBroker,
-    Service,
-    ProvisionedServiceSpec,
-    UpdateServiceSpec,
-    Binding,
-    DeprovisionServiceSpec,
-    LastOperation,
-    UnbindDetails,
-    ProvisionDetails,
-    UpdateDetails,
-    BindDetails,
-    DeprovisionDetails
-)
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""
+OPC UA service broker.
+
+Importing the package loads nothing else, the broker is started by main()
+of broker.py, the opcua-broker console script or python -m opcua_broker.
+"""
@@ -0,0 +1,4 @@
+from .broker import main
+
+
+main()
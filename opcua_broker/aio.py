@@ -0,0 +1,934 @@
+import asyncio
+import functools
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from openbrokerapi.service_broker import (
+    ProvisionedServiceSpec,
+    Binding,
+    DeprovisionServiceSpec,
+    BindResource
+)
+
+from opcua import ua
+from opcua.ua.ua_binary import struct_to_binary
+
+from . import metrics
+from . import node_management
+from .handler import (OpcuaHandler, OpcuaServiceBinding, OpcuaServiceInstance, binding_pipeline, released_bindings,
+                      spool_options)
+from .pool import BROKEN_SESSION_CODES
+from .subscription import (
+    DATA_CHANGE,
+    EVENTS,
+    MonitoredItem,
+    RingBuffer,
+    Subscriber,
+    SubscriptionGroup,
+    SubscriptionManager,
+    subscription_parameters
+)
+
+try:
+    import asyncua
+    from asyncua import ua as aua
+    from asyncua.client.ua_client import UaClientState, UASocketState
+    from asyncua.common import events as aevents
+    from asyncua.common.subscription import Subscription as AsyncSubscription
+    from asyncua.common.utils import Buffer, SocketClosedException
+    from asyncua.ua.ua_binary import struct_from_binary
+except ImportError:
+    asyncua = None
+    AsyncSubscription = object
+
+
+logger = logging.getLogger(__name__)
+
+
+def to_asyncua(value):
+    """
+    The asyncua counterpart of a python-opcua NodeId or structure, so the
+    request builders of node_management serve both clients. Structures are
+    converted through their binary encoding, which both libraries share.
+    """
+    if isinstance(value, ua.NodeId):
+        return aua.NodeId.from_string(value.to_string())
+    return struct_from_binary(getattr(aua, type(value).__name__), Buffer(struct_to_binary(value)))
+
+
+def to_node_id(value):
+    return to_asyncua(node_management.to_node_id(value))
+
+
+def is_broken_session_error(e: Exception) -> bool:
+    # like pool.is_broken_session_error, asyncua failing its pending requests
+    # with ConnectionError once the channel is lost
+    if isinstance(e, aua.UaStatusCodeError):
+        return e.code in BROKEN_SESSION_CODES
+    return isinstance(e, (OSError, TimeoutError, asyncio.TimeoutError, SocketClosedException))
+
+
+def is_connected(client) -> bool:
+    # like pool.is_connected: asyncua closes the protocol with its connection,
+    # and its watchdog marks the client disconnected once the server stops
+    # answering
+    protocol = client.uaclient.protocol
+    return (protocol is not None and protocol.state is UASocketState.OPEN and
+            client.uaclient.state is UaClientState.CONNECTED)
+
+
+class AsyncPooledSession(object):
+    def __init__(self, key: tuple, client, **kwargs):
+        self.key = key
+        self.client = client
+        self.created = time.time()
+        self.last_used = self.created
+        self.last_checked = self.created
+        self.broken = False
+        self.shared_count = 0
+
+
+class AsyncSessionPool(object):
+    """
+    Long-lived asyncua client sessions keyed by endpoint url and security
+    string, the event loop counterpart of SessionPool.
+
+    Each endpoint holds at most max_size sessions. Like those of SessionPool,
+    idle sessions are checked on checkout, their connection every time and
+    the server state once health_check_interval has passed, reconnected
+    when the check fails and evicted by a reaper task after idle_timeout.
+    The reaper starts with the first checkout, on the event loop serving it.
+    """
+
+    def __init__(self,
+                 max_size: int=4,
+                 idle_timeout: float=300,
+                 health_check_interval: float=30,
+                 acquire_timeout: float=10,
+                 timeout: float=4,
+                 **kwargs):
+        if asyncua is None:
+            raise RuntimeError("the asyncio mode needs the asyncua package")
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.timeout = timeout
+        self._idle = dict()
+        self._slots = dict()
+        self._shared = dict()
+        self._shared_locks = dict()
+        self._reaper = None
+        self._closed = False
+
+    @staticmethod
+    def make_key(url: str, security_string: str=None) -> tuple:
+        return url, security_string or ""
+
+    async def acquire(self, url: str, security_string: str=None) -> AsyncPooledSession:
+        if self._closed:
+            raise RuntimeError("session pool is closed")
+        if self._reaper is None:
+            self._reaper = asyncio.ensure_future(self._reap_loop())
+        key = self.make_key(url, security_string)
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = asyncio.Semaphore(self.max_size)
+        start = time.time()
+        try:
+            await asyncio.wait_for(slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("no free OPC UA session for {0} within {1}s".format(url, self.acquire_timeout))
+        metrics.SESSION_WAIT_SECONDS.labels(metrics.endpoint_label(url)).observe(time.time() - start)
+
+        try:
+            idle = self._idle.get(key)
+            session = idle.pop() if idle else None
+            if session is None:
+                session = AsyncPooledSession(key, await self._connect(url, security_string))
+            elif session.broken or not await self._check(session):
+                await self._reconnect(session)
+        except Exception:
+            slots.release()
+            raise
+        session.last_used = time.time()
+        return session
+
+    async def release(self, session: AsyncPooledSession):
+        session.last_used = time.time()
+        self._slots[session.key].release()
+        if session.broken or self._closed:
+            await self._disconnect(session)
+        else:
+            self._idle.setdefault(session.key, []).append(session)
+
+    async def acquire_shared(self, url: str, security_string: str=None) -> AsyncPooledSession:
+        key = self.make_key(url, security_string)
+        lock = self._shared_locks.get(key)
+        if lock is None:
+            lock = self._shared_locks[key] = asyncio.Lock()
+        async with lock:
+            session = self._shared.get(key)
+            if session is None or session.broken:
+                session = self._shared[key] = await self.acquire(url, security_string)
+            session.shared_count += 1
+            return session
+
+    async def release_shared(self, session: AsyncPooledSession):
+        session.shared_count -= 1
+        if session.shared_count > 0:
+            return
+        if self._shared.get(session.key) is session:
+            self._shared.pop(session.key)
+        await self.release(session)
+
+    @asynccontextmanager
+    async def session(self, url: str, security_string: str=None):
+        session = await self.acquire(url, security_string)
+        try:
+            yield session.client
+        except Exception as e:
+            if is_broken_session_error(e):
+                session.broken = True
+            raise
+        finally:
+            await self.release(session)
+
+    def stats(self) -> dict:
+        return dict((key, dict(in_use=self.max_size - slots._value, idle=len(self._idle.get(key) or [])))
+                    for key, slots in self._slots.items())
+
+    def collect_metrics(self) -> list:
+        sessions = []
+        for key, counts in self.stats().items():
+            endpoint = metrics.endpoint_label(key[0])
+            sessions.append((dict(endpoint=endpoint, state="in_use"), counts["in_use"]))
+            sessions.append((dict(endpoint=endpoint, state="idle"), counts["idle"]))
+        shared = [(dict(endpoint=metrics.endpoint_label(key[0])), session.shared_count)
+                  for key, session in list(self._shared.items())]
+        return [("opcua_broker_async_sessions", "gauge", "Pooled asyncua sessions by endpoint and state", sessions),
+                ("opcua_broker_async_sessions_max", "gauge", "Max pooled asyncua sessions per endpoint",
+                 [(dict(), self.max_size)]),
+                ("opcua_broker_async_shared_session_users", "gauge",
+                 "Long-lived users of the shared asyncua session of each endpoint", shared)]
+
+    async def evict_idle(self, now: float=None):
+        now = now or time.time()
+        expired = []
+        for key, idle in list(self._idle.items()):
+            expired.extend(session for session in idle if now - session.last_used > self.idle_timeout)
+            self._idle[key] = [session for session in idle if now - session.last_used <= self.idle_timeout]
+        for session in expired:
+            logger.debug("Evicting idle OPC UA session to %s", session.key[0])
+        await asyncio.gather(*(self._disconnect(session) for session in expired))
+
+    async def close(self):
+        self._closed = True
+        if self._reaper is not None:
+            self._reaper.cancel()
+        sessions = [session for idle in self._idle.values() for session in idle]
+        sessions.extend(self._shared.values())
+        self._idle = dict()
+        self._shared = dict()
+        await asyncio.gather(*(self._disconnect(session) for session in sessions))
+
+    async def _connect(self, url: str, security_string: str=None):
+        # the watchdog of asyncua drops the connection of a server which does
+        # not answer a read within watchdog_intervall, as it may not while
+        # busy with a bulk request of another session, so it gets as long as
+        # any request
+        client = asyncua.Client(url, timeout=self.timeout, watchdog_intervall=self.timeout)
+        if security_string:
+            await client.set_security_string(security_string)
+        # asyncua connects and activates the session in one step, both are
+        # timed as the connect
+        with metrics.opcua_request(client, "connect"):
+            await client.connect()
+        logger.debug("Opened OPC UA session to %s", url)
+        return client
+
+    async def _check(self, session: AsyncPooledSession) -> bool:
+        if not is_connected(session.client):
+            return False
+        now = time.time()
+        if now - session.last_checked < self.health_check_interval:
+            return True
+        session.last_checked = now
+        try:
+            state = await session.client.get_node(aua.NodeId(aua.ObjectIds.Server_ServerStatus_State)).read_value()
+        except Exception as e:
+            logger.info("Health check of OPC UA session to %s failed: %s", session.key[0], e)
+            return False
+        return state == aua.ServerState.Running
+
+    async def _reconnect(self, session: AsyncPooledSession):
+        logger.info("Reconnecting OPC UA session to %s", session.key[0])
+        await self._disconnect(session)
+        session.client = await self._connect(*session.key)
+        session.created = session.last_checked = time.time()
+        session.broken = False
+
+    @staticmethod
+    async def _disconnect(session: AsyncPooledSession):
+        try:
+            await session.client.disconnect()
+        except Exception as e:
+            logger.debug("Error while closing OPC UA session to %s: %s", session.key[0], e)
+
+    async def _reap_loop(self):
+        interval = max(1.0, min(self.idle_timeout, self.health_check_interval) / 2)
+        while not self._closed:
+            await asyncio.sleep(interval)
+            await self.evict_idle()
+
+
+async def get_operation_limits(client) -> dict:
+    # same as node_management.get_operation_limits, for an asyncua client
+    limits = getattr(client, "operation_limits", None)
+    if limits is not None:
+        return limits
+
+    params = aua.ReadParameters()
+    for name in node_management.OPERATION_LIMITS:
+        rv = aua.ReadValueId()
+        rv.NodeId = aua.NodeId(getattr(aua.ObjectIds, "Server_ServerCapabilities_OperationLimits_" + name))
+        rv.AttributeId = aua.AttributeIds.Value
+        params.NodesToRead.append(rv)
+
+    limits = dict()
+    try:
+        results = await client.uaclient.read(params)
+    except aua.UaStatusCodeError:
+        results = []
+    for name, result in zip(node_management.OPERATION_LIMITS, results):
+        if result.StatusCode.is_good() and result.Value is not None and result.Value.Value:
+            limits[name] = int(result.Value.Value)
+        else:
+            limits[name] = 0
+    client.operation_limits = limits
+    return limits
+
+
+async def send_request(client, request, response_class, items: int):
+    """
+    node_management.send_request for an asyncua client.
+    """
+    timeout = node_management.batch_timeout(client.uaclient._timeout, items)
+    data = await client.uaclient._send_request(request, timeout)
+    response = struct_from_binary(response_class, data)
+    response.ResponseHeader.ServiceResult.check()
+    return response
+
+
+def add_nodes_request(items: list):
+    request = aua.AddNodesRequest()
+    request.Parameters.NodesToAdd = [to_asyncua(item) for item in items]
+    return request
+
+
+async def add_node_tree(client, tree: node_management.NodeTree, max_per_call: int=None) -> list:
+    """
+    node_management.add_node_tree for an asyncua client, returning the
+    (index, AddNodesResult) pairs. The chunks of a level are sent together
+    and answered concurrently. When a wave fails the results so far are on
+    the exception as e.results, for rolling them back.
+    """
+    if max_per_call is None:
+        max_per_call = (await get_operation_limits(client)).get("MaxNodesPerNodeManagement")
+    results = []
+    added = dict()
+    for level in range(len(tree.levels)):
+        send, orphans = tree.wave(level, added)
+        results.extend((index, node_management.orphan_result()) for index in orphans)
+        chunks = list(node_management.chunked(send, max_per_call))
+        requests = [add_nodes_request([tree.items[index] for index in chunk]) for chunk in chunks]
+        with metrics.opcua_request(client, "AddNodes"):
+            answers = await asyncio.gather(*[send_request(client, request, aua.AddNodesResponse, len(chunk))
+                                             for chunk, request in zip(chunks, requests)], return_exceptions=True)
+        error = None
+        for chunk, answer in zip(chunks, answers):
+            if isinstance(answer, Exception):
+                error = error or answer
+                continue
+            for index, result in zip(chunk, answer.Results):
+                if result.StatusCode.is_good():
+                    added[index] = ua.NodeId.from_string(result.AddedNodeId.to_string())
+                results.append((index, result))
+        if error is not None:
+            error.results = results
+            raise error
+    return results
+
+
+async def delete_nodes(client, node_ids: list, max_per_call: int=None,
+                       delete_target_references: bool=True) -> list:
+    if max_per_call is None:
+        max_per_call = (await get_operation_limits(client)).get("MaxNodesPerNodeManagement")
+    results = []
+    for chunk in node_management.chunked(node_ids, max_per_call):
+        request = aua.DeleteNodesRequest()
+        for node_id in chunk:
+            item = aua.DeleteNodesItem()
+            item.NodeId = to_node_id(node_id)
+            item.DeleteTargetReferences = delete_target_references
+            request.Parameters.NodesToDelete.append(item)
+        with metrics.opcua_request(client, "DeleteNodes"):
+            results.extend((await send_request(client, request, aua.DeleteNodesResponse, len(chunk))).Results)
+    return results
+
+
+async def read(client, node_ids: list, attribute_id: int=ua.AttributeIds.Value, max_per_call: int=None) -> list:
+    if max_per_call is None:
+        max_per_call = (await get_operation_limits(client)).get("MaxNodesPerRead")
+    results = []
+    for chunk in node_management.chunked(node_ids, max_per_call):
+        params = aua.ReadParameters()
+        for node_id in chunk:
+            rv = aua.ReadValueId()
+            rv.NodeId = to_node_id(node_id)
+            rv.AttributeId = attribute_id
+            params.NodesToRead.append(rv)
+        with metrics.opcua_request(client, "Read"):
+            results.extend(await client.uaclient.read(params))
+    return results
+
+
+class AsyncBatchSubscription(AsyncSubscription):
+    """
+    BatchSubscription for asyncua: data changes and events of a publish
+    response go to the handler as one batch each, on the event loop, rather
+    than as one task per monitored item.
+    """
+
+    async def publish_callback(self, publish_result):
+        message = publish_result.NotificationMessage
+        others = []
+        for notification in message.NotificationData or ():
+            if isinstance(notification, aua.DataChangeNotification):
+                items = [(self._monitored_items.get(item.ClientHandle), item)
+                         for item in notification.MonitoredItems]
+                self._call(self._handler.datachange_batch, items)
+            elif isinstance(notification, aua.EventNotificationList):
+                items = [(self._monitored_items.get(event.ClientHandle), event) for event in notification.Events]
+                self._call(self._handler.event_batch, items)
+            else:
+                others.append(notification)
+        # status changes and the bookkeeping of the publish loop stay with asyncua
+        message.NotificationData = others
+        await super().publish_callback(publish_result)
+
+    def _call(self, handle, items: list):
+        try:
+            handle([(data, item) for data, item in items if data is not None])
+        except Exception:
+            self.logger.exception("Exception calling batch handler")
+
+
+class AsyncSubscriptionGroup(SubscriptionGroup):
+    """
+    SubscriptionGroup on an asyncua session. Notifications are decoded and
+    fanned out by the inherited handlers; adding and removing monitored items
+    are coroutines serialized by an asyncio lock.
+    """
+
+    def __init__(self, key: tuple, session, **kwargs):
+        super().__init__(key, session, **kwargs)
+        self.ready = asyncio.Event()
+        self._mutate_lock = asyncio.Lock()
+
+    async def add(self, subscriber: Subscriber, requests: list):
+        client = self.session.client
+        async with self._mutate_lock:
+            missing = []
+            with self._lock:
+                self._track(subscriber)
+                for request in requests:
+                    monitored_item = self.items.get(request[0])
+                    if monitored_item is not None:
+                        if subscriber in monitored_item.subscribers:
+                            continue
+                        monitored_item.subscribers.append(subscriber)
+                        subscriber.item_keys.append(request[0])
+                    elif request[0] not in (r[0] for r in missing):
+                        missing.append(request)
+
+            limit = (await get_operation_limits(client)).get("MaxMonitoredItemsPerCall")
+            for chunk in node_management.chunked(missing, limit):
+                created = []
+                item_requests = []
+                for key, node_id, attribute_id, sampling_interval, queue_size, mfilter in chunk:
+                    request = monitored_item_request(self.subscription, node_id, attribute_id,
+                                                     sampling_interval, queue_size, mfilter)
+                    monitored_item = MonitoredItem(key, request.RequestedParameters.ClientHandle)
+                    monitored_item.subscribers.append(subscriber)
+                    created.append(monitored_item)
+                    item_requests.append(request)
+                with self._lock:
+                    for monitored_item in created:
+                        self._items_by_handle[monitored_item.client_handle] = monitored_item
+                try:
+                    with metrics.opcua_request(self.session.client, "CreateMonitoredItems"):
+                        results = await self.subscription.create_monitored_items(item_requests)
+                except Exception:
+                    with self._lock:
+                        for monitored_item in created:
+                            self._items_by_handle.pop(monitored_item.client_handle, None)
+                    raise
+                with self._lock:
+                    for monitored_item, result in zip(created, results):
+                        if isinstance(result, aua.StatusCode):
+                            logger.warning("Failed to create monitored item for %s: %s",
+                                           monitored_item.key[1], result.name)
+                            self._items_by_handle.pop(monitored_item.client_handle)
+                            continue
+                        monitored_item.server_handle = result
+                        self.items[monitored_item.key] = monitored_item
+                        subscriber.item_keys.append(monitored_item.key)
+
+        subscriber.group = self
+        return len(subscriber.item_keys)
+
+    async def remove(self, subscriber: Subscriber) -> int:
+        async with self._mutate_lock:
+            unused = []
+            with self._lock:
+                self._untrack(subscriber)
+                for key in subscriber.item_keys:
+                    monitored_item = self.items.get(key)
+                    if monitored_item is None:
+                        continue
+                    monitored_item.subscribers = [s for s in monitored_item.subscribers if s is not subscriber]
+                    if not monitored_item.subscribers:
+                        unused.append(self.items.pop(key))
+                        self._items_by_handle.pop(monitored_item.client_handle, None)
+                subscriber.item_keys = []
+                remaining = len(self.items)
+
+            if unused:
+                try:
+                    limit = (await get_operation_limits(self.session.client)).get("MaxMonitoredItemsPerCall")
+                    for chunk in node_management.chunked([item.server_handle for item in unused], limit):
+                        await self.subscription.unsubscribe(chunk)
+                except Exception as e:
+                    logger.info("Failed to delete %d monitored items on %s: %s", len(unused), self.key[0], e)
+        return remaining
+
+
+class AsyncSubscriptionManager(SubscriptionManager):
+    """
+    SubscriptionManager on the event loop, with one AsyncSubscriptionGroup
+    per (endpoint, security, publishing interval). Bindings are spooled but
+    subscriptions are not resumed, asyncua sessions have no way to take
+    them over.
+    """
+
+    resumable = False
+
+    async def subscribe(self, binding_id: str, kind: str, url: str, security: str=None,
+                        nodes: list=None, publishing_interval: float=500, sampling_interval: float=None,
+                        queue_size: int=0, event_types: list=None, capacity: int=10000,
+                        spool: dict=None, pipeline=None) -> RingBuffer:
+        if self.spooled(kind, spool):
+            await self.unsubscribe(binding_id)
+        subscriber = Subscriber(binding_id, kind, self._buffer(binding_id, kind, url, capacity, spool), pipeline)
+        key = (url, security or "", publishing_interval)
+        try:
+            group = await self._group(key)
+        except BaseException:
+            # a spool left open would keep its segments mapped
+            subscriber.buffer.close()
+            raise
+        try:
+            if kind == DATA_CHANGE:
+                requests = []
+                for node in nodes:
+                    node_id = node_management.to_node_id(node)
+                    requests.append(((DATA_CHANGE, node_id.to_string(), sampling_interval, queue_size),
+                                     to_asyncua(node_id), aua.AttributeIds.Value, sampling_interval, queue_size,
+                                     None))
+            else:
+                source = node_management.to_node_id(nodes[0]) if nodes else ua.NodeId(ua.ObjectIds.Server)
+                type_ids = [node_management.to_node_id(event_type)
+                            for event_type in (event_types or [ua.ObjectIds.BaseEventType])]
+                mfilter = await aevents.get_filter_from_event_type([group.session.client.get_node(to_asyncua(type_id))
+                                                                    for type_id in type_ids])
+                requests = [((EVENTS, source.to_string(), tuple(t.to_string() for t in type_ids), queue_size),
+                             to_asyncua(source), aua.AttributeIds.EventNotifier, 0, queue_size, mfilter)]
+            if not await group.add(subscriber, requests):
+                raise RuntimeError("none of the monitored items could be created")
+        except Exception:
+            await self._remove(group, subscriber)
+            raise
+
+        with self._lock:
+            previous = self._subscribers.get(binding_id)
+            self._subscribers[binding_id] = subscriber
+        if previous is not None:
+            await self._remove(previous.group, previous)
+        return subscriber.buffer
+
+    async def unsubscribe(self, binding_id: str, discard: bool=False):
+        with self._lock:
+            subscriber = self._subscribers.pop(binding_id, None)
+        if subscriber is not None:
+            await self._remove(subscriber.group, subscriber)
+        if discard and self.spool_directory is not None:
+            self.spool_directory.discard(binding_id)
+
+    async def close(self):
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        for subscriber in subscribers:
+            await self.unsubscribe(subscriber.binding_id)
+
+    async def _group(self, key: tuple) -> AsyncSubscriptionGroup:
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = AsyncSubscriptionGroup(key, None)
+                leader = True
+            else:
+                leader = False
+            group.subscribers += 1
+        if not leader:
+            await group.ready.wait()
+            if group.error is not None:
+                raise group.error
+            return group
+
+        try:
+            group.session = await self.session_pool.acquire_shared(key[0], key[1] or None)
+            group.subscription = AsyncBatchSubscription(group.session.client.uaclient,
+                                                        to_asyncua(subscription_parameters(key[2])), group)
+            await group.subscription.init()
+        except Exception as e:
+            group.error = e
+            with self._lock:
+                if self._groups.get(key) is group:
+                    self._groups.pop(key)
+            if group.session is not None:
+                await self.session_pool.release_shared(group.session)
+            raise
+        finally:
+            group.ready.set()
+        return group
+
+    async def _remove(self, group: AsyncSubscriptionGroup, subscriber: Subscriber):
+        subscriber.buffer.close()
+        await group.remove(subscriber)
+        with self._lock:
+            group.subscribers -= 1
+            if group.subscribers:
+                return
+            if self._groups.get(group.key) is group:
+                self._groups.pop(group.key)
+        try:
+            if group.subscription is not None and group.subscription.subscription_id:
+                await group.subscription.delete()
+        except Exception as e:
+            logger.info("Failed to delete subscription on %s: %s", group.key[0], e)
+        finally:
+            if group.session is not None:
+                await self.session_pool.release_shared(group.session)
+
+
+def monitored_item_request(subscription, node_id, attribute_id: int, sampling_interval: float=None,
+                           queue_size: int=0, mfilter=None):
+    # subscription.monitored_item_request for an asyncua subscription, whose
+    # client handles are only ever taken on the event loop
+    rv = aua.ReadValueId()
+    rv.NodeId = node_id
+    rv.AttributeId = attribute_id
+    mparams = aua.MonitoringParameters()
+    subscription._client_handle += 1
+    mparams.ClientHandle = subscription._client_handle
+    if sampling_interval is None:
+        sampling_interval = subscription.parameters.RequestedPublishingInterval
+    mparams.SamplingInterval = sampling_interval
+    mparams.QueueSize = queue_size
+    mparams.DiscardOldest = True
+    if mfilter is not None:
+        mparams.Filter = mfilter
+    request = aua.MonitoredItemCreateRequest()
+    request.ItemToMonitor = rv
+    request.MonitoringMode = aua.MonitoringMode.Reporting
+    request.RequestedParameters = mparams
+    return request
+
+
+def in_executor(name: str):
+    # a coroutine method running the OpcuaHandler method name on a worker
+    # thread, for the plans which have no asyncua implementation
+    async def delegate(self, *args, **kwargs):
+        method = functools.partial(getattr(self.opcua_handler, name), *args, **kwargs)
+        return await asyncio.get_event_loop().run_in_executor(None, method)
+    delegate.__name__ = name
+    return delegate
+
+
+class AsyncOpcuaHandler(object):
+    """
+    OpcuaHandler for the asyncio mode.
+
+    Provisioning node-management, data-change and events instances and
+    binding subscriptions talk to the servers with asyncua on the event
+    loop, so thousands of them can be in flight at once. The other plans
+    and the data access endpoints run the OpcuaHandler methods on worker
+    threads. Both share the registries, state store and node indexes of
+    opcua_handler.
+    """
+
+    def __init__(self,
+                 opcua_handler: OpcuaHandler,
+                 session_pool: AsyncSessionPool=None,
+                 **kwargs):
+        self.opcua_handler = opcua_handler
+        self.session_pool = session_pool or AsyncSessionPool()
+        self.subscriptions = AsyncSubscriptionManager(self.session_pool, opcua_handler.spool_directory)
+        self._subscription_lock = asyncio.Lock()
+
+    @property
+    def service_instances(self):
+        return self.opcua_handler.service_instances
+
+    @property
+    def service_bindings(self):
+        return self.opcua_handler.service_bindings
+
+    provision_discovery_instance = in_executor("provision_discovery_instance")
+    deprovision_discovery_instance = in_executor("deprovision_discovery_instance")
+    bind_discovery_instance = in_executor("bind_discovery_instance")
+    unbind_discovery_instance = in_executor("unbind_discovery_instance")
+    provision_reference_instance = in_executor("provision_reference_instance")
+    deprovision_reference_instance = in_executor("deprovision_reference_instance")
+    bind_node_instance = in_executor("bind_node_instance")
+    unbind_node_instance = in_executor("unbind_node_instance")
+    read_binding_values = in_executor("read_binding_values")
+    write_binding_values = in_executor("write_binding_values")
+    provision_history_instance = in_executor("provision_history_instance")
+    deprovision_history_instance = in_executor("deprovision_history_instance")
+    bind_history_instance = in_executor("bind_history_instance")
+    unbind_history_instance = in_executor("unbind_history_instance")
+    read_binding_history = in_executor("read_binding_history")
+
+    async def _put(self, registry, key: str, value):
+        # registries write through to the state store, which may be on disk
+        await asyncio.get_event_loop().run_in_executor(None, registry.put, key, value)
+
+    async def _pop(self, registry, key: str):
+        return await asyncio.get_event_loop().run_in_executor(None, registry.pop, key)
+
+    async def provision_node_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                      parameters: dict=None,
+                                      tree: node_management.NodeTree=None) -> ProvisionedServiceSpec:
+        url = parameters.get("url")
+        if not url:
+            logger.error("url not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+        nodes_to_add = parameters.get("nodesToAdd")
+        if not nodes_to_add:
+            logger.error("nodes_to_add not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+
+        # every bad node spec is reported at once, before a session is opened,
+        # unless the broker parsed them before answering already
+        if tree is None:
+            tree = node_management.NodeTree(nodes_to_add)
+
+        nodes = []
+        failures = []
+        try:
+            async with self.session_pool.session(url, parameters.get("security")) as client:
+                try:
+                    results = await add_node_tree(client, tree)
+                except Exception as e:
+                    results = getattr(e, "results", [])
+                    nodes = [result.AddedNodeId.to_string() for _, result in results if result.StatusCode.is_good()]
+                    raise
+            for index, result in results:
+                if result.StatusCode.is_good():
+                    nodes.append(result.AddedNodeId.to_string())
+                else:
+                    logger.error("failed to add node %s: %s", tree.names[index], result.StatusCode.name)
+                    failures.append(dict(browseName=tree.names[index], statusCode=result.StatusCode.name))
+            if not nodes:
+                raise RuntimeError("none of the {0} nodes could be added".format(len(tree)))
+
+            service_instance = OpcuaServiceInstance(instance_id, service_id, plan_id, parameters)
+            service_instance.params["nodes"] = nodes
+            service_instance.params["failedNodes"] = failures
+
+            await self._put(self.service_instances, instance_id, service_instance)
+            self.opcua_handler._invalidate_nodes(url, parameters.get("security"), nodes)
+        except Exception:
+            logger.exception("Failed to provision node management service instance %s", instance_id)
+            await self._rollback_nodes(url, parameters.get("security"), nodes)
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("Node management service instance %s is provisioned successfully", instance_id)
+        return ProvisionedServiceSpec()
+
+    async def _rollback_nodes(self, url: str, security: str, nodes: list):
+        if not nodes:
+            return
+        try:
+            async with self.session_pool.session(url, security) as client:
+                await delete_nodes(client, list(reversed(nodes)))
+        except Exception:
+            logger.exception("Failed to roll back %d added nodes on %s", len(nodes), url)
+
+    async def deprovision_node_instance(self, instance_id: str) -> DeprovisionServiceSpec:
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return DeprovisionServiceSpec(is_async=False)
+
+        url = service_instance.params.get("url")
+        # children go before their parents, so walk the nodes backwards
+        nodes = list(reversed(service_instance.params.get("nodes")))
+        try:
+            async with self.session_pool.session(url, service_instance.params.get("security")) as client:
+                results = await delete_nodes(client, nodes)
+        except Exception:
+            logger.exception("Failed to deprovision node management service instance %s", instance_id)
+            return DeprovisionServiceSpec(is_async=False)
+
+        self.opcua_handler._invalidate_nodes(url, service_instance.params.get("security"), nodes, deleted=True)
+        remaining = [node for node, result in zip(nodes, results) if not node_management.is_deleted(result)]
+        if remaining:
+            logger.error("%d nodes of service instance %s could not be deleted", len(remaining), instance_id)
+            service_instance.params["nodes"] = list(reversed(remaining))
+            await self._put(self.service_instances, instance_id, service_instance)
+            return DeprovisionServiceSpec(is_async=False)
+
+        await self._pop(self.service_instances, instance_id)
+
+        logger.info("Node service instance %s is deprovisioned successfully", instance_id)
+        return DeprovisionServiceSpec(is_async=False)
+
+    async def provision_subscription_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                              parameters: dict=None) -> ProvisionedServiceSpec:
+        return await self._provision_subscription(DATA_CHANGE, instance_id, service_id, plan_id, parameters)
+
+    async def provision_event_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                       parameters: dict=None) -> ProvisionedServiceSpec:
+        return await self._provision_subscription(EVENTS, instance_id, service_id, plan_id, parameters)
+
+    async def _provision_subscription(self, kind: str, instance_id: str, service_id: str, plan_id: str,
+                                      parameters: dict=None) -> ProvisionedServiceSpec:
+        url = parameters.get("url")
+        if not url:
+            logger.error("url not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+        nodes = parameters.get("nodes") if kind == DATA_CHANGE else [parameters.get("sourceNodeId", ua.ObjectIds.Server)]
+        if not nodes:
+            logger.error("nodes not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+
+        try:
+            node_ids = [node_management.to_node_id(node) for node in nodes]
+            async with self.session_pool.session(url, parameters.get("security")) as client:
+                results = await read(client, node_ids, ua.AttributeIds.NodeClass)
+            unknown = [node_id.to_string() for node_id, result in zip(node_ids, results)
+                       if not result.StatusCode.is_good()]
+            if unknown:
+                raise RuntimeError("unknown nodes {0}".format(", ".join(unknown[:10])))
+
+            service_instance = OpcuaServiceInstance(instance_id, service_id, plan_id, parameters)
+            service_instance.params["kind"] = kind
+            await self._put(self.service_instances, instance_id, service_instance)
+        except Exception:
+            logger.exception("Failed to provision subscription service instance %s", instance_id)
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("Subscription service instance %s is provisioned successfully", instance_id)
+        return ProvisionedServiceSpec()
+
+    async def deprovision_subscription_instance(self, instance_id: str) -> DeprovisionServiceSpec:
+        if await self._pop(self.service_instances, instance_id) is None:
+            return DeprovisionServiceSpec(is_async=False)
+        for service_binding in self.service_bindings.find("instance_id", instance_id):
+            await self.subscriptions.unsubscribe(service_binding.id, discard=True)
+
+        logger.info("Subscription service instance %s is deprovisioned successfully", instance_id)
+        return DeprovisionServiceSpec(is_async=False)
+
+    async def bind_subscription_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str,
+                                         bind_resource: BindResource, parameters: dict=None):
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return Binding(state="failed")
+
+        service_binding = OpcuaServiceBinding(binding_id, instance_id, service_id, plan_id, bind_resource,
+                                              parameters or dict())
+        try:
+            await self._subscribe(service_instance, service_binding)
+        except Exception:
+            logger.exception("Failed to bind subscription service binding %s to service instance %s",
+                             binding_id, instance_id)
+            return Binding(state="failed")
+
+        credentials = dict(stream="/opcua/bindings/{0}/stream".format(binding_id))
+        service_binding.params["credentials"] = credentials
+        await self._put(self.service_bindings, binding_id, service_binding)
+
+        logger.info("Subscription service binding %s is bound to service instance %s successfully",
+                    binding_id, instance_id)
+        return Binding(credentials=credentials)
+
+    async def _subscribe(self, service_instance: OpcuaServiceInstance,
+                         service_binding: OpcuaServiceBinding) -> RingBuffer:
+        params = service_instance.params
+        nodes = params.get("nodes")
+        if params["kind"] == EVENTS:
+            nodes = [params["sourceNodeId"]] if params.get("sourceNodeId") is not None else None
+        return await self.subscriptions.subscribe(service_binding.id, params["kind"], params["url"],
+                                                  security=params.get("security"),
+                                                  nodes=nodes,
+                                                  publishing_interval=params.get("publishingInterval", 500),
+                                                  sampling_interval=params.get("samplingInterval"),
+                                                  queue_size=params.get("queueSize", 0),
+                                                  event_types=params.get("eventTypes"),
+                                                  capacity=service_binding.params.get("bufferSize", 10000),
+                                                  spool=spool_options(params["kind"], service_binding.params),
+                                                  pipeline=binding_pipeline(params["kind"], service_binding.params))
+
+    async def unbind_subscription_instance(self, instance_id: str, binding_id: str):
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None or not instance_id == service_binding.instance_id:
+            return
+
+        await self._pop(self.service_bindings, binding_id)
+        await self.subscriptions.unsubscribe(binding_id, discard=True)
+
+        logger.info("Subscription service binding %s is unbound to service instance %s successfully",
+                    binding_id, instance_id)
+
+    async def binding_buffer(self, binding_id: str) -> RingBuffer:
+        buffer = self.subscriptions.buffer(binding_id)
+        if buffer is not None:
+            return buffer
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None:
+            return None
+        service_instance = self.service_instances.get(service_binding.instance_id)
+        if service_instance is None or service_instance.params.get("kind") not in (DATA_CHANGE, EVENTS):
+            return None
+        async with self._subscription_lock:
+            buffer = self.subscriptions.buffer(binding_id)
+            if buffer is None:
+                buffer = await self._subscribe(service_instance, service_binding)
+        return buffer
+
+    async def rebalance(self, owns_instance) -> list:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.opcua_handler.rebalance, owns_instance)
+        moved = await loop.run_in_executor(None, released_bindings, self.subscriptions.binding_ids(),
+                                           self.service_bindings, owns_instance)
+        for binding_id in moved:
+            await self.subscriptions.unsubscribe(binding_id, discard=True)
+        return moved
+
+    async def close(self):
+        await self.subscriptions.close()
+        await self.session_pool.close()
@@ -0,0 +1,510 @@
+import asyncio
+import functools
+import json
+import logging
+import re
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+from openbrokerapi import errors
+from openbrokerapi.response import (
+    BindResponse,
+    DeprovisionResponse,
+    EmptyResponse,
+    ErrorResponse,
+    LastOperationResponse,
+    ProvisioningResponse
+)
+from openbrokerapi.service_broker import (
+    BindDetails,
+    BindState,
+    DeprovisionDetails,
+    ProvisionDetails,
+    ProvisionState,
+    UnbindDetails
+)
+
+from . import data_access
+from . import metrics
+from . import validation
+from .catalog import todict
+from .routes import event_chunk, event_reset_chunk, ndjson_chunk, ndjson_reset_chunk, parse_cursor, reset_cursor
+
+
+logger = logging.getLogger(__name__)
+
+MIN_VERSION = (2, 13)
+
+
+class Request(object):
+    def __init__(self, scope: dict, body: bytes, **kwargs):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string = scope.get("query_string", b"").decode("latin-1")
+        self.args = dict(parse_qsl(self.query_string))
+        self.headers = dict((name.decode("latin-1").lower(), value.decode("latin-1"))
+                            for name, value in scope.get("headers", []))
+        self.body = body
+
+    def get_json(self):
+        try:
+            return json.loads(self.body.decode("utf-8")) if self.body else None
+        except ValueError:
+            return None
+
+
+async def send_response(send, status: int, body, content_type: str="application/json", headers: list=None):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({"type": "http.response.start", "status": int(status),
+                "headers": [(b"content-type", content_type.encode("latin-1"))] + (headers or [])})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, obj, status: int=HTTPStatus.OK):
+    await send_response(send, status, json.dumps(todict(obj)))
+
+
+class App(object):
+    """
+    ASGI application serving the Open Service Broker api of an
+    AsyncOpcuaServiceBroker and the binding endpoints of routes.py from one
+    event loop, for the asyncio mode of the broker.
+
+    Notification streams wait on their ring buffer through a listener rather
+    than a blocked thread, so a replica holds as many open streams as it has
+    sockets. With a cluster, requests owned by another replica are forwarded
+    to it like get_cluster_blueprint of routes.py does, and with state_store
+    the state of the cluster is served like get_state_blueprint does.
+    """
+
+    def __init__(self, service_broker, aio_handler, keepalive: float=15, max_batch: int=1000, cluster=None,
+                 state_store=None, **kwargs):
+        self.service_broker = service_broker
+        self.aio_handler = aio_handler
+        self.cluster = cluster
+        self.state_store = state_store
+        self.keepalive = keepalive
+        self.max_batch = max_batch
+        self.routes = [
+            ("GET", "/v2/catalog", self.catalog),
+            ("PUT", "/v2/service_instances/(?P<instance_id>[^/]+)", self.provision),
+            ("DELETE", "/v2/service_instances/(?P<instance_id>[^/]+)", self.deprovision),
+            ("GET", "/v2/service_instances/(?P<instance_id>[^/]+)/last_operation", self.last_operation),
+            ("PUT", "/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)",
+             self.bind),
+            ("DELETE", "/v2/service_instances/(?P<instance_id>[^/]+)/service_bindings/(?P<binding_id>[^/]+)",
+             self.unbind),
+            ("GET", "/opcua/bindings/(?P<binding_id>[^/]+)/stream", self.stream),
+            ("POST", "/opcua/bindings/(?P<binding_id>[^/]+)/read", self.read),
+            ("POST", "/opcua/bindings/(?P<binding_id>[^/]+)/write", self.write),
+            ("POST", "/opcua/bindings/(?P<binding_id>[^/]+)/history", self.history),
+            ("GET", "/metrics", self.metrics_text),
+        ]
+        if state_store is not None:
+            self.routes.extend((method, "/opcua/state/(?P<kind>[^/]+)", self.state)
+                               for method in ("GET", "PUT", "DELETE"))
+        self.routes = [(method, re.compile(pattern), handle) for method, pattern, handle in self.routes]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        request = Request(scope, body)
+
+        if self.cluster is not None:
+            owner = await asyncio.get_event_loop().run_in_executor(None, self.cluster.route, request.method,
+                                                                   request.path, request.headers, body)
+            if owner is not None:
+                await self.forward(owner, request, send, receive)
+                return
+
+        allowed = False
+        for method, pattern, handle in self.routes:
+            match = pattern.fullmatch(request.path)
+            if match is None:
+                continue
+            allowed = True
+            if method == request.method:
+                break
+        else:
+            status = HTTPStatus.METHOD_NOT_ALLOWED if allowed else HTTPStatus.NOT_FOUND
+            await send_json(send, ErrorResponse(description=status.phrase), status)
+            return
+
+        if request.path.startswith("/v2/"):
+            version = request.headers.get("x-broker-api-version")
+            if not version:
+                await send_json(send, ErrorResponse(description="No X-Broker-Api-Version found."),
+                                HTTPStatus.BAD_REQUEST)
+                return
+            if MIN_VERSION > tuple(map(int, version.split("."))):
+                await send_json(send, ErrorResponse(description="Service broker requires version %d.%d+." %
+                                                                MIN_VERSION),
+                                HTTPStatus.PRECONDITION_FAILED)
+                return
+
+        started = []
+
+        async def tracked_send(message):
+            if message["type"] == "http.response.start":
+                started.append(message["status"])
+            await send(message)
+
+        try:
+            await handle(request, tracked_send, receive=receive, **match.groupdict())
+        except validation.InvalidParameters as e:
+            await send_json(send, ErrorResponse(description=str(e)), HTTPStatus.BAD_REQUEST)
+        except Exception as e:
+            logger.exception(e)
+            # a stream which already started can only be cut short
+            if not started:
+                await send_json(send, ErrorResponse(description=str(e)), HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.cluster is not None:
+                    self.cluster.add_listener(functools.partial(self.rebalance, asyncio.get_event_loop()))
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.aio_handler.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def rebalance(self, loop, owns_instance):
+        # called on the heartbeat thread of the cluster
+        asyncio.run_coroutine_threadsafe(self.aio_handler.rebalance(owns_instance), loop).result()
+
+    async def forward(self, owner: str, request: Request, send, receive):
+        target = request.path + ("?" + request.query_string if request.query_string else "")
+        try:
+            status, headers, reader, writer = await self.cluster.forward_async(owner, request.method, target,
+                                                                               request.headers, request.body)
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            await send_json(send, dict(description="replica {0} is unavailable: {1}".format(owner, e)),
+                            HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                    for name, value in headers]})
+            while True:
+                chunk = asyncio.ensure_future(reader.read(65536))
+                await asyncio.wait([chunk, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    chunk.cancel()
+                    return
+                if not chunk.result():
+                    break
+                await send({"type": "http.response.body", "body": chunk.result(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            writer.close()
+
+    def broker(self, service_id: str):
+        if self.service_broker.service_id() != service_id:
+            raise KeyError('service {} not found'.format(service_id))
+        return self.service_broker
+
+    @staticmethod
+    def add_service_id(result, service_id: str):
+        if result.is_async:
+            result.operation = service_id if result.operation is None else ' '.join((service_id, result.operation))
+
+    async def catalog(self, request: Request, send, **kwargs):
+        service_catalog = self.service_broker.service_catalog
+        headers = [(b"etag", service_catalog.etag.encode("latin-1"))]
+        if service_catalog.not_modified(request.headers.get("if-none-match")):
+            await send_response(send, HTTPStatus.NOT_MODIFIED, b"", headers=headers)
+            return
+        await send_response(send, HTTPStatus.OK, service_catalog.body, headers=headers)
+
+    async def provision(self, request: Request, send, instance_id: str, **kwargs):
+        try:
+            accepts_incomplete = 'true' == request.args.get("accepts_incomplete", 'false')
+            provision_details = ProvisionDetails(**(request.get_json() or dict()))
+        except TypeError as e:
+            await send_json(send, ErrorResponse(description=str(e)), HTTPStatus.BAD_REQUEST)
+            return
+
+        try:
+            broker = self.broker(provision_details.service_id)
+            result = await broker.provision(instance_id, provision_details, accepts_incomplete)
+            self.add_service_id(result, broker.service_id())
+        except errors.ErrInstanceAlreadyExists as e:
+            logger.exception(e)
+            await send_json(send, EmptyResponse(), HTTPStatus.CONFLICT)
+            return
+        except errors.ErrAsyncRequired as e:
+            logger.exception(e)
+            await send_json(send, ErrorResponse(
+                error="AsyncRequired",
+                description="This service plan requires client support for asynchronous service operations."
+            ), HTTPStatus.UNPROCESSABLE_ENTITY)
+            return
+
+        response = ProvisioningResponse(result.dashboard_url, result.operation)
+        if result.state == ProvisionState.IS_ASYNC:
+            await send_json(send, response, HTTPStatus.ACCEPTED)
+        elif result.state == ProvisionState.IDENTICAL_ALREADY_EXISTS:
+            await send_json(send, response, HTTPStatus.OK)
+        elif result.state == ProvisionState.SUCCESSFUL_CREATED:
+            await send_json(send, response, HTTPStatus.CREATED)
+        else:
+            raise errors.ServiceExeption('IllegalState, ProvisioningState unknown.')
+
+    async def deprovision(self, request: Request, send, instance_id: str, **kwargs):
+        try:
+            accepts_incomplete = 'true' == request.args.get("accepts_incomplete", 'false')
+            deprovision_details = DeprovisionDetails(request.args["plan_id"], request.args["service_id"])
+        except KeyError as e:
+            await send_json(send, ErrorResponse(description=str(e)), HTTPStatus.BAD_REQUEST)
+            return
+
+        try:
+            broker = self.broker(deprovision_details.service_id)
+            result = await broker.deprovision(instance_id, deprovision_details, accepts_incomplete)
+            self.add_service_id(result, broker.service_id())
+        except errors.ErrInstanceDoesNotExist as e:
+            logger.exception(e)
+            await send_json(send, EmptyResponse(), HTTPStatus.GONE)
+            return
+        except errors.ErrAsyncRequired as e:
+            logger.exception(e)
+            await send_json(send, ErrorResponse(
+                error="AsyncRequired",
+                description="This service plan requires client support for asynchronous service operations."
+            ), HTTPStatus.UNPROCESSABLE_ENTITY)
+            return
+
+        if result.is_async:
+            await send_json(send, DeprovisionResponse(result.operation), HTTPStatus.ACCEPTED)
+        else:
+            await send_json(send, EmptyResponse(), HTTPStatus.OK)
+
+    async def last_operation(self, request: Request, send, instance_id: str, **kwargs):
+        data = (request.args.get("operation") or "").split(' ', maxsplit=1)
+        broker = self.broker(data[0])
+        result = broker.last_operation(instance_id, data[1] if len(data) == 2 else None)
+        await send_json(send, LastOperationResponse(result.state, result.description), HTTPStatus.OK)
+
+    async def bind(self, request: Request, send, instance_id: str, binding_id: str, **kwargs):
+        try:
+            binding_details = BindDetails(**(request.get_json() or dict()))
+        except (KeyError, TypeError) as e:
+            await send_json(send, ErrorResponse(description=str(e)), HTTPStatus.BAD_REQUEST)
+            return
+
+        try:
+            result = await self.broker(binding_details.service_id).bind(instance_id, binding_id, binding_details)
+        except errors.ErrBindingAlreadyExists as e:
+            logger.exception(e)
+            await send_json(send, EmptyResponse(), HTTPStatus.CONFLICT)
+            return
+        except errors.ErrAppGuidNotProvided as e:
+            logger.exception(e)
+            await send_json(send, ErrorResponse(
+                error="RequiresApp",
+                description="This service supports generation of credentials through binding an application only."
+            ), HTTPStatus.UNPROCESSABLE_ENTITY)
+            return
+
+        response = BindResponse(credentials=result.credentials,
+                                syslog_drain_url=result.syslog_drain_url,
+                                route_service_url=result.route_service_url,
+                                volume_mounts=result.volume_mounts)
+        if result.state == BindState.SUCCESSFUL_BOUND:
+            await send_json(send, response, HTTPStatus.CREATED)
+        elif result.state == BindState.IDENTICAL_ALREADY_EXISTS:
+            await send_json(send, response, HTTPStatus.OK)
+        else:
+            raise errors.ServiceExeption('IllegalState, BindState unknown.')
+
+    async def unbind(self, request: Request, send, instance_id: str, binding_id: str, **kwargs):
+        try:
+            unbind_details = UnbindDetails(request.args["plan_id"], request.args["service_id"])
+        except KeyError as e:
+            await send_json(send, ErrorResponse(description=str(e)), HTTPStatus.BAD_REQUEST)
+            return
+
+        try:
+            await self.broker(unbind_details.service_id).unbind(instance_id, binding_id, unbind_details)
+        except errors.ErrBindingDoesNotExist as e:
+            logger.exception(e)
+            await send_json(send, EmptyResponse(), HTTPStatus.GONE)
+            return
+        await send_json(send, EmptyResponse(), HTTPStatus.OK)
+
+    async def stream(self, request: Request, send, binding_id: str, receive=None, **kwargs):
+        try:
+            buffer = await self.aio_handler.binding_buffer(binding_id)
+        except Exception as e:
+            await send_json(send, dict(description=str(e)), HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        if buffer is None:
+            await send_json(send, ErrorResponse(description="Not Found"), HTTPStatus.NOT_FOUND)
+            return
+
+        try:
+            cursor = parse_cursor(request.args.get("after", request.headers.get("last-event-id")))
+        except ValueError as e:
+            await send_json(send, dict(description=str(e)), HTTPStatus.BAD_REQUEST)
+            return
+        if request.args.get("format") == "ndjson":
+            chunk, reset_chunk, content_type, headers = ndjson_chunk, ndjson_reset_chunk, "application/x-ndjson", []
+        else:
+            chunk, reset_chunk, content_type = event_chunk, event_reset_chunk, "text/event-stream"
+            headers = [(b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]
+
+        loop = asyncio.get_event_loop()
+        ready = asyncio.Event()
+
+        def listener():
+            # buffers are extended on the event loop in the asyncio mode, but
+            # may be closed from a worker thread
+            loop.call_soon_threadsafe(ready.set)
+
+        disconnected = asyncio.ensure_future(wait_disconnect(receive))
+        buffer.add_listener(listener)
+        try:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", content_type.encode("latin-1"))] + headers})
+            reset = reset_cursor(buffer, cursor)
+            if reset is not None:
+                cursor = reset
+                await send({"type": "http.response.body", "body": reset_chunk(cursor).encode("utf-8"),
+                            "more_body": True})
+            while not disconnected.done():
+                ready.clear()
+                items, cursor, missed = buffer.read(cursor, self.max_batch, 0)
+                if not items and not missed and not buffer.closed:
+                    waiter = asyncio.ensure_future(ready.wait())
+                    await asyncio.wait([waiter, disconnected], timeout=self.keepalive,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    waiter.cancel()
+                    if disconnected.done():
+                        break
+                    items, cursor, missed = buffer.read(cursor, self.max_batch, 0)
+                if not items and not missed and buffer.closed:
+                    break
+                await send({"type": "http.response.body", "body": chunk(items, cursor, missed).encode("utf-8"),
+                            "more_body": True})
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            buffer.remove_listener(listener)
+            disconnected.cancel()
+
+    async def metrics_text(self, request: Request, send, **kwargs):
+        await send_response(send, HTTPStatus.OK, metrics.REGISTRY.render(), metrics.CONTENT_TYPE)
+
+    async def read(self, request: Request, send, binding_id: str, **kwargs):
+        body = request.get_json() or dict()
+        await self.columnar_response(request, send, self.aio_handler.read_binding_values, binding_id,
+                                     nodes=body.get("nodes"), paths=body.get("paths"))
+
+    async def write(self, request: Request, send, binding_id: str, **kwargs):
+        body = request.get_json() or dict()
+        await self.columnar_response(request, send, self.aio_handler.write_binding_values, binding_id,
+                                     values=body.get("values") or [], nodes=body.get("nodes"), paths=body.get("paths"))
+
+    async def history(self, request: Request, send, binding_id: str, receive=None, **kwargs):
+        body = request.get_json() or dict()
+        loop = asyncio.get_event_loop()
+        try:
+            lines = await self.aio_handler.read_binding_history(binding_id, body, nodes=body.get("nodes"),
+                                                                paths=body.get("paths"))
+        except (ValueError, TypeError) as e:
+            await send_json(send, dict(description=str(e)), HTTPStatus.BAD_REQUEST)
+            return
+        if lines is None:
+            await send_json(send, ErrorResponse(description="Not Found"), HTTPStatus.NOT_FOUND)
+            return
+
+        # the pages are read by the synchronous client, one at a time on a
+        # worker thread, as the client takes them
+        try:
+            try:
+                line = await loop.run_in_executor(None, next, lines, "")
+            except (ValueError, TypeError) as e:
+                await send_json(send, dict(description=str(e)), HTTPStatus.BAD_REQUEST)
+                return
+            except Exception as e:
+                await send_json(send, dict(description=str(e)), HTTPStatus.BAD_GATEWAY)
+                return
+
+            disconnected = asyncio.ensure_future(wait_disconnect(receive))
+            try:
+                await send({"type": "http.response.start", "status": 200,
+                            "headers": [(b"content-type", b"application/x-ndjson")]})
+                while line and not disconnected.done():
+                    await send({"type": "http.response.body", "body": line.encode("utf-8"), "more_body": True})
+                    line = await loop.run_in_executor(None, next, lines, "")
+                if not disconnected.done():
+                    await send({"type": "http.response.body", "body": b""})
+            finally:
+                disconnected.cancel()
+        finally:
+            # releases the continuation points and the session of a stream cut short
+            await loop.run_in_executor(None, lines.close)
+
+    async def state(self, request: Request, send, kind: str, **kwargs):
+        loop = asyncio.get_event_loop()
+        key = request.args.get("key")
+        if key is None:
+            if request.method != "GET":
+                await send_json(send, dict(description="key missing"), HTTPStatus.BAD_REQUEST)
+                return
+            index = await loop.run_in_executor(None, self.state_store.load_index, kind)
+            await send_response(send, HTTPStatus.OK, json.dumps(index))
+        elif request.method == "GET":
+            record = await loop.run_in_executor(None, self.state_store.load, kind, key)
+            await send_response(send, HTTPStatus.OK, json.dumps(record))
+        elif request.method == "DELETE":
+            await loop.run_in_executor(None, self.state_store.delete, kind, key)
+            await send_response(send, HTTPStatus.NO_CONTENT, b"")
+        else:
+            body = request.get_json()
+            if not isinstance(body, dict) or not isinstance(body.get("record"), dict):
+                await send_json(send, dict(description="record missing"), HTTPStatus.BAD_REQUEST)
+                return
+            await loop.run_in_executor(None, self.state_store.save, kind, key, body["record"],
+                                       body.get("index") or dict())
+            await send_response(send, HTTPStatus.NO_CONTENT, b"")
+
+    @staticmethod
+    async def columnar_response(request: Request, send, handle, binding_id: str, **kwargs):
+        try:
+            columns = await handle(binding_id, **kwargs)
+        except (ValueError, TypeError) as e:
+            await send_json(send, dict(description=str(e)), HTTPStatus.BAD_REQUEST)
+            return
+        except Exception as e:
+            await send_json(send, dict(description=str(e)), HTTPStatus.BAD_GATEWAY)
+            return
+        if columns is None:
+            await send_json(send, ErrorResponse(description="Not Found"), HTTPStatus.NOT_FOUND)
+            return
+        body, mimetype = data_access.encode(columns, request.headers.get("accept"))
+        await send_response(send, HTTPStatus.OK, body, mimetype)
+
+
+async def wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
@@ -0,0 +1,579 @@
+import _thread
+import argparse
+import functools
+import logging
+import signal
+import subprocess
+import sys
+import threading
+
+from urllib.parse import urlparse
+
+from openbrokerapi import errors
+from openbrokerapi.service_broker import (
+    ServiceBroker,
+    Service,
+    ProvisionedServiceSpec,
+    UpdateServiceSpec,
+    Binding,
+    DeprovisionServiceSpec,
+    LastOperation,
+    OperationState,
+    UnbindDetails,
+    ProvisionDetails,
+    ProvisionState,
+    UpdateDetails,
+    BindDetails,
+    DeprovisionDetails
+)
+
+from . import catalog
+from . import cluster
+from . import metrics
+from . import operations
+from . import spool
+from . import store
+from . import validation
+
+
+logger = logging.getLogger(__name__)
+
+# ua.OPC_TCP_SCHEME, which would import all of opcua before the broker serves
+OPC_TCP_SCHEME = "opc.tcp"
+
+
+class Deferred(object):
+    """
+    Stands in for what factory builds on a thread of its own, so that the
+    broker answers its catalog while the OPC UA modules are still being
+    imported. Attributes are looked up on the result, waiting for it the
+    first time. When factory fails the main thread is interrupted, and
+    every lookup raises the error.
+    """
+
+    def __init__(self, factory, name: str="deferred", **kwargs):
+        self._factory = factory
+        self._result = None
+        self._error = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._build, name=name, daemon=True).start()
+
+    def _build(self):
+        try:
+            self._result = self._factory()
+        except BaseException as e:
+            self._error = e
+            _thread.interrupt_main()
+        finally:
+            self._ready.set()
+
+    def result(self):
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def __getattr__(self, name: str):
+        return getattr(self.result(), name)
+
+
+class OpcuaServiceBroker(ServiceBroker):
+    def __init__(self,
+                 opcua_handler,
+                 operation_table: operations.OperationTable=None,
+                 service_catalog: catalog.Catalog=None):
+        self.opcua_handler = opcua_handler
+        self.operation_table = operation_table or operations.OperationTable()
+        self.service_catalog = service_catalog or catalog.Catalog.load()
+
+    def catalog(self) -> Service:
+        return self.service_catalog.service
+
+    @metrics.osb_request("provision")
+    def provision(self, instance_id: str, service_details: ProvisionDetails,
+                  async_allowed: bool) -> ProvisionedServiceSpec:
+        provision_instance = self._provision_instance(service_details.plan_id)
+        if provision_instance is None:
+            return ProvisionedServiceSpec(state="failed")
+        self.service_catalog.validate(service_details.plan_id, catalog.SERVICE_INSTANCE, service_details.parameters)
+
+        kwargs = dict(instance_id=instance_id,
+                      service_id=service_details.service_id,
+                      plan_id=service_details.plan_id,
+                      parameters=service_details.parameters)
+        kwargs.update(self._parse_parameters(service_details.plan_id, service_details.parameters))
+        if not async_allowed:
+            return provision_instance(**kwargs)
+
+        operation = self.operation_table.submit(instance_id, "provision",
+                                                functools.partial(provision_instance, **kwargs),
+                                                service_details.plan_id)
+        return ProvisionedServiceSpec(state=ProvisionState.IS_ASYNC, operation=operation.id)
+
+    def _parse_parameters(self, plan_id: str, parameters: dict) -> dict:
+        # node specs and references are parsed before answering, so that bad
+        # ones are a 400 in the background too rather than a failed operation
+        from . import node_management
+
+        kind = self.service_catalog.kind(plan_id)
+        parameters = parameters or dict()
+        if kind == catalog.NODE_MANAGEMENT and parameters.get("nodesToAdd"):
+            return dict(tree=node_management.NodeTree(parameters["nodesToAdd"]))
+        if kind == catalog.REFERENCE_MANAGEMENT and parameters.get("referencesToAdd"):
+            return dict(add_references_items=node_management.build_add_references_items(
+                parameters["referencesToAdd"]))
+        return dict()
+
+    def _provision_instance(self, plan_id: str):
+        kind = self.service_catalog.kind(plan_id)
+        if kind == catalog.DISCOVERY:
+            return self.opcua_handler.provision_discovery_instance
+        elif kind == catalog.NODE_MANAGEMENT:
+            return self.opcua_handler.provision_node_instance
+        elif kind == catalog.REFERENCE_MANAGEMENT:
+            return self.opcua_handler.provision_reference_instance
+        elif kind == catalog.DATA_CHANGE:
+            return self.opcua_handler.provision_subscription_instance
+        elif kind == catalog.EVENTS:
+            return self.opcua_handler.provision_event_instance
+        elif kind == catalog.HISTORY:
+            return self.opcua_handler.provision_history_instance
+        return None
+
+    def update(self, instance_id: str, details: UpdateDetails, async_allowed: bool) -> UpdateServiceSpec:
+        pass
+
+    @metrics.osb_request("deprovision")
+    def deprovision(self, instance_id: str, details: DeprovisionDetails,
+                    async_allowed: bool) -> DeprovisionServiceSpec:
+        deprovision_instance = self._deprovision_instance(details.plan_id)
+        if deprovision_instance is None:
+            return DeprovisionServiceSpec(is_async=False)
+
+        if not async_allowed:
+            return self._deprovision(deprovision_instance, instance_id)
+
+        operation = self.operation_table.submit(instance_id, "deprovision",
+                                                functools.partial(self._deprovision, deprovision_instance, instance_id),
+                                                details.plan_id)
+        return DeprovisionServiceSpec(is_async=True, operation=operation.id)
+
+    def _deprovision_instance(self, plan_id: str):
+        kind = self.service_catalog.kind(plan_id)
+        if kind == catalog.DISCOVERY:
+            return self.opcua_handler.deprovision_discovery_instance
+        elif kind == catalog.NODE_MANAGEMENT:
+            return self.opcua_handler.deprovision_node_instance
+        elif kind == catalog.REFERENCE_MANAGEMENT:
+            return self.opcua_handler.deprovision_reference_instance
+        elif kind in (catalog.DATA_CHANGE, catalog.EVENTS):
+            return self.opcua_handler.deprovision_subscription_instance
+        elif kind == catalog.HISTORY:
+            return self.opcua_handler.deprovision_history_instance
+        return None
+
+    def _deprovision(self, deprovision_instance, instance_id: str) -> DeprovisionServiceSpec:
+        spec = deprovision_instance(instance_id)
+        self._check_deprovisioned(instance_id)
+        return spec
+
+    def _check_deprovisioned(self, instance_id: str):
+        # deprovisioning keeps the instance registered when its nodes could not
+        # be removed, the platform must not forget it and leak them
+        if instance_id in self.opcua_handler.service_instances:
+            raise errors.ServiceExeption("service instance {0} could not be fully deprovisioned".format(instance_id))
+
+    @metrics.osb_request("bind")
+    def bind(self, instance_id: str, binding_id: str, details: BindDetails) -> Binding:
+        service_instance = self.opcua_handler.service_instances.get(instance_id)
+        if service_instance is None or service_instance.plan_id != details.plan_id:
+            return Binding(state="failed")
+
+        bind_instance = self._bind_instance(details.plan_id)
+        if bind_instance is None:
+            return Binding(state="failed")
+        self.service_catalog.validate(details.plan_id, catalog.SERVICE_BINDING, details.parameters)
+        return bind_instance(instance_id=instance_id,
+                             binding_id=binding_id,
+                             service_id=details.service_id,
+                             plan_id=details.plan_id,
+                             bind_resource=details.bind_resource,
+                             parameters=details.parameters)
+
+    def _bind_instance(self, plan_id: str):
+        kind = self.service_catalog.kind(plan_id)
+        if kind == catalog.DISCOVERY:
+            return self.opcua_handler.bind_discovery_instance
+        elif kind == catalog.NODE_MANAGEMENT:
+            return self.opcua_handler.bind_node_instance
+        elif kind in (catalog.DATA_CHANGE, catalog.EVENTS):
+            return self.opcua_handler.bind_subscription_instance
+        elif kind == catalog.HISTORY:
+            return self.opcua_handler.bind_history_instance
+        return None
+
+    @metrics.osb_request("unbind")
+    def unbind(self, instance_id: str, binding_id: str, details: UnbindDetails):
+        unbind_instance = self._unbind_instance(details.plan_id)
+        if unbind_instance is not None:
+            return unbind_instance(instance_id=instance_id, binding_id=binding_id)
+
+    def _unbind_instance(self, plan_id: str):
+        kind = self.service_catalog.kind(plan_id)
+        if kind == catalog.DISCOVERY:
+            return self.opcua_handler.unbind_discovery_instance
+        elif kind == catalog.NODE_MANAGEMENT:
+            return self.opcua_handler.unbind_node_instance
+        elif kind in (catalog.DATA_CHANGE, catalog.EVENTS):
+            return self.opcua_handler.unbind_subscription_instance
+        elif kind == catalog.HISTORY:
+            return self.opcua_handler.unbind_history_instance
+        return None
+
+    @metrics.osb_request("last_operation")
+    def last_operation(self, instance_id: str, operation_data: str) -> LastOperation:
+        operation = self.operation_table.get(instance_id, operation_data)
+        if operation is None:
+            return LastOperation(OperationState.FAILED, "unknown operation {0}".format(operation_data))
+        return operation.to_last_operation()
+
+
+class AsyncOpcuaServiceBroker(OpcuaServiceBroker):
+    """
+    OpcuaServiceBroker for the asyncio mode, driving an aio.AsyncOpcuaHandler
+    from the ASGI app of asgi.py. Asynchronous operations run as tasks on the
+    event loop instead of on the operation table's worker threads.
+    """
+
+    def __init__(self,
+                 aio_handler,
+                 operation_table: operations.OperationTable=None,
+                 service_catalog: catalog.Catalog=None):
+        super().__init__(aio_handler, operation_table, service_catalog)
+        self._tasks = set()
+
+    @metrics.osb_request("provision")
+    async def provision(self, instance_id: str, service_details: ProvisionDetails,
+                        async_allowed: bool) -> ProvisionedServiceSpec:
+        provision_instance = self._provision_instance(service_details.plan_id)
+        if provision_instance is None:
+            return ProvisionedServiceSpec(state="failed")
+        self.service_catalog.validate(service_details.plan_id, catalog.SERVICE_INSTANCE, service_details.parameters)
+
+        coroutine = provision_instance(instance_id=instance_id,
+                                       service_id=service_details.service_id,
+                                       plan_id=service_details.plan_id,
+                                       parameters=service_details.parameters,
+                                       **self._parse_parameters(service_details.plan_id,
+                                                                service_details.parameters))
+        if not async_allowed:
+            return await coroutine
+
+        operation = await self._start(instance_id, "provision", coroutine, service_details.plan_id)
+        return ProvisionedServiceSpec(state=ProvisionState.IS_ASYNC, operation=operation.id)
+
+    @metrics.osb_request("deprovision")
+    async def deprovision(self, instance_id: str, details: DeprovisionDetails,
+                          async_allowed: bool) -> DeprovisionServiceSpec:
+        deprovision_instance = self._deprovision_instance(details.plan_id)
+        if deprovision_instance is None:
+            return DeprovisionServiceSpec(is_async=False)
+
+        if not async_allowed:
+            return await self._deprovision(deprovision_instance, instance_id)
+
+        operation = await self._start(instance_id, "deprovision",
+                                      self._deprovision(deprovision_instance, instance_id), details.plan_id)
+        return DeprovisionServiceSpec(is_async=True, operation=operation.id)
+
+    async def _deprovision(self, deprovision_instance, instance_id: str) -> DeprovisionServiceSpec:
+        spec = await deprovision_instance(instance_id)
+        self._check_deprovisioned(instance_id)
+        return spec
+
+    @metrics.osb_request("bind")
+    async def bind(self, instance_id: str, binding_id: str, details: BindDetails) -> Binding:
+        service_instance = self.opcua_handler.service_instances.get(instance_id)
+        if service_instance is None or service_instance.plan_id != details.plan_id:
+            return Binding(state="failed")
+
+        bind_instance = self._bind_instance(details.plan_id)
+        if bind_instance is None:
+            return Binding(state="failed")
+        self.service_catalog.validate(details.plan_id, catalog.SERVICE_BINDING, details.parameters)
+        return await bind_instance(instance_id=instance_id,
+                                   binding_id=binding_id,
+                                   service_id=details.service_id,
+                                   plan_id=details.plan_id,
+                                   bind_resource=details.bind_resource,
+                                   parameters=details.parameters)
+
+    @metrics.osb_request("unbind")
+    async def unbind(self, instance_id: str, binding_id: str, details: UnbindDetails):
+        unbind_instance = self._unbind_instance(details.plan_id)
+        if unbind_instance is not None:
+            return await unbind_instance(instance_id=instance_id, binding_id=binding_id)
+
+    async def _start(self, instance_id: str, kind: str, coroutine, plan_id: str=None) -> operations.Operation:
+        import asyncio
+
+        # operations are written to the state store as they start and finish
+        loop = asyncio.get_event_loop()
+        try:
+            operation = await loop.run_in_executor(None, self.operation_table.start, instance_id, kind, plan_id)
+        except Exception:
+            coroutine.close()
+            raise
+        task = asyncio.ensure_future(self._run(operation, coroutine))
+        # the loop only keeps weak references to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return operation
+
+    async def _run(self, operation: operations.Operation, coroutine):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        try:
+            result = await coroutine
+        except Exception as e:
+            logger.exception("Operation %s of instance %s failed", operation.kind, operation.instance_id)
+            await loop.run_in_executor(None, functools.partial(self.operation_table.finish, operation, error=e))
+        else:
+            await loop.run_in_executor(None, self.operation_table.finish, operation, result)
+
+
+def parse_args(parser):
+    args = parser.parse_args()
+    if args.url and '://' not in args.url:
+        logger.info("Adding default scheme %s to URL %s", OPC_TCP_SCHEME, args.url)
+        args.url = OPC_TCP_SCHEME + '://' + args.url
+    return args
+
+
+def advertise_url(listen) -> str:
+    host = listen.hostname
+    if not host or host == '0.0.0.0':
+        host = '127.0.0.1'
+    return "http://{0}:{1}".format(host, listen.port or 5000)
+
+
+def start_replicas(replicas: int, listen) -> list:
+    # the other replicas of a local cluster run the broker again, on the
+    # ports following ours and with the same state file, which processes on
+    # one host may share
+    processes = []
+    for i in range(1, replicas):
+        port = "{0}://{1}:{2}".format(listen.scheme or 'http', listen.hostname or '0.0.0.0', (listen.port or 5000) + i)
+        processes.append(subprocess.Popen([sys.executable, "-m", __package__] + sys.argv[1:] +
+                                          ["--port", port, "--replicas", "1", "--cluster",
+                                           "--advertise-url", advertise_url(urlparse(port))]))
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p",
+                        "--port",
+                        default='http://0.0.0.0:5000',
+                        help="Use '--port' option to specify the port for broker to listen on")
+    parser.add_argument("-u",
+                        "--url",
+                        default='opu.tcp://localhost:4840',
+                        required=True,
+                        help="Use '--url' option to specify the client endpoint for broker to connect the backend")
+    parser.add_argument("--max-sessions",
+                        type=int,
+                        default=4,
+                        help="Use '--max-sessions' option to specify the max pooled OPC UA sessions per endpoint")
+    parser.add_argument("--session-idle-timeout",
+                        type=float,
+                        default=300,
+                        help="Use '--session-idle-timeout' option to specify the seconds before an idle session is closed")
+    parser.add_argument("--request-timeout",
+                        type=float,
+                        default=4,
+                        help="Use '--request-timeout' option to specify the seconds an OPC UA request may take")
+    parser.add_argument("--max-operations",
+                        type=int,
+                        default=8,
+                        help="Use '--max-operations' option to specify the max asynchronous operations run at once")
+    parser.add_argument("--discovery-ttl",
+                        type=float,
+                        default=300,
+                        help="Use '--discovery-ttl' option to specify the seconds discovery results are cached")
+    parser.add_argument("--discovery-refresh",
+                        type=float,
+                        default=None,
+                        help="Use '--discovery-refresh' option to refresh cached discovery results in the background")
+    parser.add_argument("--browse-depth",
+                        type=int,
+                        default=None,
+                        help="Use '--browse-depth' option to limit how many levels of the address space are indexed")
+    parser.add_argument("--asgi",
+                        action="store_true",
+                        help="Use '--asgi' option to serve the broker from an ASGI server on asyncio, with asyncua")
+    parser.add_argument("--state-file",
+                        default=None,
+                        help="Use '--state-file' option to specify the SQLite file that keeps broker state across restarts")
+    parser.add_argument("--state-url",
+                        default=None,
+                        help="Use '--state-url' option to specify the URL of the replica keeping the state of a cluster"
+                             " in its --state-file")
+    parser.add_argument("--cluster",
+                        action="store_true",
+                        help="Use '--cluster' option to run as one of several replicas sharing the state at --state-url")
+    parser.add_argument("--advertise-url",
+                        default=None,
+                        help="Use '--advertise-url' option to specify the URL other replicas reach this one on")
+    parser.add_argument("--replicas",
+                        type=int,
+                        default=1,
+                        help="Use '--replicas' option to start that many local replicas on consecutive ports")
+    parser.add_argument("--plans",
+                        default=None,
+                        help="Use '--plans' option to specify the JSON file defining the service and its plans")
+    parser.add_argument("--spool-dir",
+                        default=None,
+                        help="Use '--spool-dir' option to spool the notifications of data-change bindings to disk there")
+    parser.add_argument("--spool-max-bytes",
+                        type=int,
+                        default=spool.DEFAULT_MAX_BYTES,
+                        help="Use '--spool-max-bytes' option to specify the bytes kept in the spool of a binding")
+    parser.add_argument("--spool-max-age",
+                        type=float,
+                        default=None,
+                        help="Use '--spool-max-age' option to specify the seconds notifications are kept in a spool")
+    parser.add_argument("--spool-fsync-interval",
+                        type=float,
+                        default=1.0,
+                        help="Use '--spool-fsync-interval' option to specify the seconds between syncs of the spools")
+
+    args = parse_args(parser)
+    clustered = args.cluster or args.replicas > 1
+    listen = urlparse(args.port)
+    url = (args.advertise_url or advertise_url(listen)).rstrip("/")
+    state_url = (args.state_url or url).rstrip("/")
+    if clustered and not args.state_file and state_url == url:
+        parser.error("a cluster of replicas needs a --state-file, or the --state-url of the replica keeping it")
+    try:
+        service_catalog = catalog.Catalog.load(args.plans)
+    except (OSError, TypeError, ValueError) as e:
+        parser.error("invalid plans {0}: {1}".format(args.plans or catalog.DEFAULT_PLANS, e))
+    # SQLite must not be shared between hosts, so a single replica of a
+    # cluster keeps the state file and serves it to the others
+    state_store = None
+    keeps_state = False
+    if state_url != url:
+        state_store = store.RemoteStateStore(state_url)
+    elif args.state_file:
+        state_store = store.SqliteStateStore(args.state_file)
+        keeps_state = clustered
+    spool_directory = spool.SpoolDirectory(args.spool_dir, max_bytes=args.spool_max_bytes,
+                                           max_age=args.spool_max_age,
+                                           fsync_interval=args.spool_fsync_interval) if args.spool_dir else None
+
+    def build_handler():
+        # the handler, its session pool and the plans behind them are all
+        # that needs the OPC UA modules
+        from . import handler
+        from . import pool
+
+        # start the server without authentication
+        session_pool = pool.SessionPool(max_size=args.max_sessions, idle_timeout=args.session_idle_timeout,
+                                        timeout=args.request_timeout)
+        metrics.REGISTRY.register_collector(session_pool.collect_metrics)
+        return handler.OpcuaHandler(url=args.url,
+                                    session_pool=session_pool,
+                                    state_store=state_store,
+                                    discovery_ttl=args.discovery_ttl,
+                                    discovery_refresh=args.discovery_refresh,
+                                    browse_depth=args.browse_depth,
+                                    spool_directory=spool_directory)
+
+    broker_cluster = None
+    if clustered:
+        broker_cluster = cluster.Cluster(url, state_store)
+        metrics.REGISTRY.register_collector(broker_cluster.collect_metrics)
+    # operations are polled on whichever replica owns their instance by then
+    operation_table = operations.OperationTable(max_workers=args.max_operations, state_store=state_store,
+                                                replica=url if clustered else None,
+                                                members=broker_cluster.members if clustered else None)
+    metrics.REGISTRY.register_collector(operation_table.collect_metrics)
+
+    replicas = start_replicas(args.replicas, listen)
+    # exit through the finally below on SIGTERM too, so that local replicas
+    # are stopped with this process
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    opcua_handler = None
+    try:
+        if args.asgi:
+            import uvicorn
+
+            from . import aio
+            from . import asgi
+
+            opcua_handler = build_handler()
+            aio_handler = aio.AsyncOpcuaHandler(opcua_handler,
+                                                aio.AsyncSessionPool(max_size=args.max_sessions,
+                                                                     idle_timeout=args.session_idle_timeout,
+                                                                     timeout=args.request_timeout))
+            metrics.REGISTRY.register_collector(aio_handler.session_pool.collect_metrics)
+            metrics.REGISTRY.register_collector(aio_handler.subscriptions.collect_metrics)
+            app = asgi.App(AsyncOpcuaServiceBroker(aio_handler, operation_table, service_catalog), aio_handler,
+                           cluster=broker_cluster, state_store=state_store if keeps_state else None)
+            if broker_cluster is not None:
+                broker_cluster.start()
+            uvicorn.run(app, host=listen.hostname or '0.0.0.0', port=listen.port or 5000)
+        else:
+            from flask import Flask
+            from openbrokerapi import api
+            from openbrokerapi.log_util import basic_config
+
+            from . import routes
+
+            # the catalog is served while the handler is being built, anything
+            # else waits for it
+            opcua_handler = Deferred(build_handler, name="broker-start")
+            metrics.REGISTRY.register_collector(lambda: opcua_handler.subscriptions.collect_metrics())
+            app = Flask(__name__)
+            app.register_blueprint(routes.get_catalog_blueprint(service_catalog))
+            broker_blueprint = api.get_blueprint(OpcuaServiceBroker(opcua_handler, operation_table, service_catalog),
+                                                 None, basic_config())
+            # more specific than the blueprint's handler of any Exception, which answers 500
+            broker_blueprint.register_error_handler(validation.InvalidParameters, routes.invalid_parameters)
+            app.register_blueprint(broker_blueprint)
+            app.register_blueprint(routes.get_blueprint(opcua_handler))
+            if keeps_state:
+                app.register_blueprint(routes.get_state_blueprint(state_store))
+            if broker_cluster is not None:
+                app.register_blueprint(routes.get_cluster_blueprint(broker_cluster))
+                broker_cluster.add_listener(lambda *args: opcua_handler.rebalance(*args))
+                broker_cluster.start()
+            if spool_directory is not None:
+                # take over the subscriptions of spooled bindings left by the
+                # last run, and of those whose connection breaks from now on
+                threading.Thread(target=lambda: opcua_handler.watch_spools(), name="spool-watch", daemon=True).start()
+            # notification streams hold their request open, so serve every request on its own thread
+            app.run(listen.hostname or '0.0.0.0', listen.port or 5000, threaded=True)
+            # the server stops when building the handler failed too, raise its error then
+            opcua_handler.result()
+    finally:
+        for replica in replicas:
+            replica.terminate()
+        for replica in replicas:
+            replica.wait()
+        if broker_cluster is not None:
+            broker_cluster.stop()
+        operation_table.shutdown(wait=False)
+        try:
+            if opcua_handler is not None:
+                opcua_handler.close()
+                opcua_handler.session_pool.close()
+        finally:
+            if state_store is not None:
+                state_store.close()
+
+
+if __name__ == "__main__":
+    main()
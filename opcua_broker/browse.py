@@ -0,0 +1,348 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from opcua import ua
+from opcua.common.subscription import Subscription
+
+from . import metrics
+from . import node_management
+from .subscription import subscription_parameters
+
+
+logger = logging.getLogger(__name__)
+
+ROOT = ua.NodeId(ua.ObjectIds.RootFolder).to_string()
+
+
+def browse_description(node_id: ua.NodeId, direction: int=ua.BrowseDirection.Forward,
+                       reference_type_id: int=ua.ObjectIds.HierarchicalReferences) -> ua.BrowseDescription:
+    description = ua.BrowseDescription()
+    description.NodeId = node_id
+    description.BrowseDirection = direction
+    description.ReferenceTypeId = ua.TwoByteNodeId(reference_type_id)
+    description.IncludeSubtypes = True
+    description.NodeClassMask = 0
+    description.ResultMask = ua.BrowseResultMask.All
+    return description
+
+
+def browse(client, node_ids: list, direction: int=ua.BrowseDirection.Forward,
+           reference_type_id: int=ua.ObjectIds.HierarchicalReferences) -> list:
+    """
+    Browse the references of node_ids (hierarchical ones by default) with one
+    multi-node Browse request, following continuation points with batched
+    BrowseNext requests. Returns one list of ReferenceDescriptions per node
+    id, in input order.
+    """
+    params = ua.BrowseParameters()
+    params.RequestedMaxReferencesPerNode = 0
+    params.NodesToBrowse = [browse_description(node_id, direction, reference_type_id) for node_id in node_ids]
+    with metrics.opcua_request(client, "Browse"):
+        results = client.uaclient.browse(params)
+
+    references = []
+    pending = dict()
+    for i, result in enumerate(results):
+        references.append(list(result.References) if result.StatusCode.is_good() else [])
+        if result.ContinuationPoint:
+            pending[i] = result.ContinuationPoint
+    while pending:
+        params = ua.BrowseNextParameters()
+        params.ReleaseContinuationPoints = False
+        params.ContinuationPoints = list(pending.values())
+        indexes = list(pending.keys())
+        pending = dict()
+        with metrics.opcua_request(client, "BrowseNext"):
+            results = client.uaclient.browse_next(params)
+        for i, result in zip(indexes, results):
+            if not result.StatusCode.is_good():
+                continue
+            references[i].extend(result.References)
+            if result.ContinuationPoint:
+                pending[i] = result.ContinuationPoint
+    return references
+
+
+def browse_all(client, node_ids: list, max_per_call: int=None, concurrency: int=4,
+               direction: int=ua.BrowseDirection.Forward,
+               reference_type_id: int=ua.ObjectIds.HierarchicalReferences) -> list:
+    """
+    browse() any number of node ids in chunks of MaxNodesPerBrowse, with at
+    most concurrency requests in flight on the client's secure channel.
+    """
+    if max_per_call is None:
+        max_per_call = node_management.get_operation_limits(client).get("MaxNodesPerBrowse")
+    chunks = list(node_management.chunked(node_ids, max_per_call))
+    if len(chunks) <= 1 or concurrency <= 1:
+        return [references for chunk in chunks
+                for references in browse(client, chunk, direction, reference_type_id)]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as executor:
+        results = executor.map(lambda chunk: browse(client, chunk, direction, reference_type_id), chunks)
+        return [references for chunk_references in results for references in chunk_references]
+
+
+def existing_references(client, add_references_items: list) -> set:
+    """
+    The reference_key of every item of add_references_items the server
+    already has, found with one batched Browse of all their source nodes.
+    """
+    sources = list(dict.fromkeys(item.SourceNodeId.to_string() for item in add_references_items))
+    results = browse_all(client, [ua.NodeId.from_string(source) for source in sources],
+                         direction=ua.BrowseDirection.Both, reference_type_id=ua.ObjectIds.References)
+    existing = set()
+    for source, references in zip(sources, results):
+        for reference in references:
+            existing.add((source, reference.ReferenceTypeId.to_string(), reference.IsForward,
+                          reference.NodeId.to_string()))
+    return set(node_management.reference_key(item) for item in add_references_items).intersection(existing)
+
+
+class NodeEntry(object):
+    __slots__ = ("node_id", "browse_name", "display_name", "node_class", "parent", "children")
+
+    def __init__(self, node_id: str, browse_name: str=None, display_name: str=None, node_class: int=None,
+                 parent: str=None):
+        self.node_id = node_id
+        self.browse_name = browse_name
+        self.display_name = display_name
+        self.node_class = node_class
+        self.parent = parent
+        # None until the node has been browsed, or again once invalidated
+        self.children = None
+
+
+class NodeIndex(object):
+    """
+    In-memory index of the address space of one server, keyed by NodeId
+    string, with a lookup by browse path from the Root folder. Entries only
+    keep their parent, so paths are worked out when asked for.
+
+    update() browses breadth-first, one batched Browse wave per depth level,
+    and only browses nodes whose children are not known yet. invalidate()
+    forgets the children of a node so the next update() browses it again;
+    watch() calls it for every node named in the server's ModelChange events.
+    """
+
+    def __init__(self, max_depth: int=None, concurrency: int=4, **kwargs):
+        self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.entries = dict()
+        self._stale = set()
+        self._unresolved = set()
+        self._lock = threading.RLock()
+        self._update_lock = threading.Lock()
+        self.subscription = None
+        self.entries[ROOT] = NodeEntry(ROOT, "0:Root", "Root", ua.NodeClass.Object.value)
+
+    def update(self, client, roots: list=None, max_depth: int=None) -> int:
+        """
+        Browse everything below roots (the Root folder by default) up to
+        max_depth levels that is not in the index yet. Returns the number of
+        nodes browsed.
+        """
+        max_depth = self.max_depth if max_depth is None else max_depth
+        with self._update_lock:
+            browsed = self._refresh(client)
+            frontier = []
+            with self._lock:
+                for root in (roots or [ROOT]):
+                    root = node_management.to_node_id(root).to_string()
+                    if root not in self.entries:
+                        self.entries[root] = NodeEntry(root)
+                    frontier.append(root)
+
+            visited = set(frontier)
+            depth = 0
+            while frontier and (max_depth is None or depth < max_depth):
+                with self._lock:
+                    unknown = [node_id for node_id in frontier
+                               if node_id in self.entries and self.entries[node_id].children is None]
+                if unknown:
+                    results = browse_all(client, [ua.NodeId.from_string(node_id) for node_id in unknown],
+                                         concurrency=self.concurrency)
+                    browsed += len(unknown)
+                    with self._lock:
+                        for node_id, references in zip(unknown, results):
+                            self._add_children(node_id, references)
+
+                next_frontier = []
+                with self._lock:
+                    for node_id in frontier:
+                        entry = self.entries.get(node_id)
+                        for child in (entry.children or ()) if entry is not None else ():
+                            if child not in visited:
+                                visited.add(child)
+                                next_frontier.append(child)
+                frontier = next_frontier
+                depth += 1
+            return browsed
+
+    def _add_children(self, parent_id: str, references: list):
+        # must be called with the lock held
+        parent = self.entries.get(parent_id)
+        if parent is None:
+            return
+        children = []
+        for reference in references:
+            child_id = reference.NodeId.to_string()
+            if child_id in children:
+                continue
+            children.append(child_id)
+            child = self.entries.get(child_id)
+            if child is None:
+                child = self.entries[child_id] = NodeEntry(child_id)
+            elif child.browse_name is not None:
+                continue
+            # new, or only known as a root of an earlier update()
+            child.browse_name = reference.BrowseName.to_string()
+            child.display_name = reference.DisplayName.Text
+            child.node_class = reference.NodeClass.value
+            child.parent = parent_id
+        # children which went away since the last browse take their subtree along
+        for child_id in set(parent.children or ()).difference(children):
+            child = self.entries.get(child_id)
+            if child is not None and child.parent == parent_id:
+                self._drop(child)
+        parent.children = children
+        self._stale.discard(parent_id)
+
+    def get(self, node_id) -> NodeEntry:
+        with self._lock:
+            return self.entries.get(node_management.to_node_id(node_id).to_string())
+
+    def lookup(self, path) -> NodeEntry:
+        # "0:Objects/2:Plant/2:Temperature" or a list of qualified names
+        if isinstance(path, str):
+            path = [element for element in path.split("/") if element]
+        with self._lock:
+            entry = self.entries[ROOT]
+            for name in path:
+                entry = next((child for child in (self.entries.get(child_id) for child_id in entry.children or ())
+                              if child is not None and child.browse_name == name), None)
+                if entry is None:
+                    return None
+            return entry
+
+    def path(self, entry: NodeEntry) -> str:
+        """
+        The browse path of entry from the Root folder, or None when its
+        parents are not indexed.
+        """
+        names = []
+        with self._lock:
+            while entry is not None and entry.node_id != ROOT:
+                names.append(entry.browse_name)
+                entry = self.entries.get(entry.parent) if entry.parent is not None else None
+        if entry is None:
+            return None
+        return "/".join(reversed(names))
+
+    def to_dict(self, entry: NodeEntry) -> dict:
+        return dict(nodeId=entry.node_id, browseName=entry.browse_name, displayName=entry.display_name,
+                    nodeClass=entry.node_class, browsePath=self.path(entry))
+
+    def descendants(self, node_id, node_class: int=None) -> list:
+        """
+        The indexed nodes below node_id, breadth-first, optionally only those
+        of node_class.
+        """
+        with self._lock:
+            root = self.entries.get(node_management.to_node_id(node_id).to_string())
+            if root is None:
+                return []
+            found = []
+            frontier = [root]
+            visited = set([root.node_id])
+            while frontier:
+                next_frontier = []
+                for entry in frontier:
+                    for child_id in entry.children or ():
+                        child = self.entries.get(child_id)
+                        if child is None or child_id in visited:
+                            continue
+                        visited.add(child_id)
+                        if node_class is None or child.node_class == node_class:
+                            found.append(child)
+                        next_frontier.append(child)
+                frontier = next_frontier
+            return found
+
+    def invalidate(self, node_id, deleted: bool=False):
+        """
+        Mark the references of node_id for browsing again on the next
+        update(), or drop the node and its subtree when it was deleted. Nodes
+        the index has never seen are resolved to their parents first.
+        """
+        node_id = node_management.to_node_id(node_id).to_string()
+        with self._lock:
+            entry = self.entries.get(node_id)
+            if entry is None:
+                if not deleted:
+                    self._unresolved.add(node_id)
+                return
+            if not deleted:
+                self._stale.add(node_id)
+                return
+            parent = self.entries.get(entry.parent) if entry.parent is not None else None
+            if parent is not None and parent.children is not None:
+                parent.children = [child_id for child_id in parent.children if child_id != node_id]
+            self._drop(entry)
+
+    def _drop(self, entry: NodeEntry):
+        # must be called with the lock held
+        dropped = [entry]
+        while dropped:
+            entry = dropped.pop()
+            self.entries.pop(entry.node_id, None)
+            self._stale.discard(entry.node_id)
+            for child_id in entry.children or ():
+                child = self.entries.get(child_id)
+                if child is not None and child.parent == entry.node_id:
+                    dropped.append(child)
+
+    def _refresh(self, client) -> int:
+        with self._lock:
+            unresolved = list(self._unresolved)
+            self._unresolved = set()
+        if unresolved:
+            # nodes added since the last update are found through their parents
+            results = browse_all(client, [ua.NodeId.from_string(node_id) for node_id in unresolved],
+                                 concurrency=self.concurrency, direction=ua.BrowseDirection.Inverse)
+            with self._lock:
+                for references in results:
+                    for reference in references:
+                        if reference.NodeId.to_string() in self.entries:
+                            self._stale.add(reference.NodeId.to_string())
+
+        with self._lock:
+            stale = list(self._stale)
+        if not stale:
+            return 0
+        results = browse_all(client, [ua.NodeId.from_string(node_id) for node_id in stale],
+                             concurrency=self.concurrency)
+        with self._lock:
+            for node_id, references in zip(stale, results):
+                self._add_children(node_id, references)
+        return len(stale)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def watch(self, client, publishing_interval: float=1000):
+        """
+        Subscribe to the GeneralModelChangeEvents of the server and invalidate
+        the nodes they name.
+        """
+        self.subscription = Subscription(client.uaclient, subscription_parameters(publishing_interval), self)
+        self.subscription.subscribe_events(ua.ObjectIds.Server, ua.ObjectIds.GeneralModelChangeEventType)
+
+    def event_notification(self, event):
+        # runs on the client's receive thread, so only the in-memory index is
+        # touched here and browsing waits for the next update()
+        for change in getattr(event, "Changes", None) or ():
+            deleted = bool(change.Verb & ua.ModelChangeStructureVerbMask.NodeDeleted)
+            self.invalidate(change.Affected, deleted=deleted)
+
+    def status_change_notification(self, status):
+        logger.warning("Model change subscription changed status to %s", status)
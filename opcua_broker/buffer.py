@@ -0,0 +1,80 @@
+import threading
+from collections import deque
+from itertools import islice
+
+
+class RingBuffer(object):
+    """
+    Bounded buffer of notifications numbered by a monotonically increasing
+    sequence number.
+
+    Writers never block: once full, the oldest notifications are overwritten.
+    Readers keep their own cursor and learn from read() how many notifications
+    they missed because they fell more than capacity behind, which is also
+    added to the dropped counter if given. A cursor past the tail, one from
+    before the buffer was recreated, reads on from the tail. Readers which
+    cannot block a thread, like those on an event loop, register a listener
+    instead, which is called after every extend() and on close().
+    """
+
+    def __init__(self, capacity: int=10000, dropped=None, **kwargs):
+        self.capacity = capacity
+        self.dropped = dropped
+        self._items = deque(maxlen=capacity)
+        self._next = 0
+        self._cond = threading.Condition()
+        self._listeners = []
+        self.closed = False
+
+    @property
+    def head(self) -> int:
+        return self._next - len(self._items)
+
+    @property
+    def tail(self) -> int:
+        return self._next
+
+    def extend(self, items: list):
+        with self._cond:
+            self._items.extend(items)
+            self._next += len(items)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def add_listener(self, listener):
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def read(self, cursor: int=None, max_items: int=1000, timeout: float=None) -> tuple:
+        with self._cond:
+            if cursor is None:
+                cursor = self.head
+            cursor = min(cursor, self._next)
+            if cursor >= self._next and not self.closed:
+                self._cond.wait(timeout)
+            head = self.head
+            missed = max(0, head - cursor)
+            if missed and self.dropped is not None:
+                self.dropped.inc(missed)
+            cursor = max(cursor, head)
+            start = cursor - head
+            items = list(islice(self._items, start, start + max_items))
+            return items, cursor + len(items), missed
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+
+from openbrokerapi.catalog import ServicePlan, Schemas
+from openbrokerapi.response import CatalogResponse
+from openbrokerapi.service_broker import Service
+
+from .validation import Validator
+
+
+DEFAULT_PLANS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plans.json")
+
+# the implementations a plan may be served by
+DISCOVERY = "discovery"
+NODE_MANAGEMENT = "node-management"
+REFERENCE_MANAGEMENT = "reference-management"
+DATA_CHANGE = "data-change"
+EVENTS = "events"
+HISTORY = "history"
+KINDS = (DISCOVERY, NODE_MANAGEMENT, REFERENCE_MANAGEMENT, DATA_CHANGE, EVENTS, HISTORY)
+
+SERVICE_INSTANCE = "service_instance"
+SERVICE_BINDING = "service_binding"
+
+
+def todict(obj):
+    # the same conversion of response objects openbrokerapi's blueprint does
+    if isinstance(obj, dict):
+        return dict((key, todict(value)) for key, value in obj.items())
+    elif hasattr(obj, "__iter__") and not isinstance(obj, str):
+        return [todict(value) for value in obj]
+    elif hasattr(obj, "__dict__"):
+        return dict((key, todict(value)) for key, value in obj.__dict__.items()
+                    if not callable(value) and not key.startswith('_') and value is not None)
+    return obj
+
+
+class Catalog(object):
+    """
+    The service and plans the broker offers, built once from their
+    definitions: a service object of the OSB catalog whose plans also name
+    the kind of instance they provision. The catalog response is serialized
+    once too, and answered from the cached bytes with an ETag, so that
+    platforms polling /v2/catalog get a 304 while nothing changed.
+
+    The create parameter schemas of the plans are compiled into validators
+    up front, which check provision and bind parameters before any request
+    goes to a server.
+    """
+
+    def __init__(self, definition: dict, **kwargs):
+        definition = dict(definition)
+        plans = []
+        self.kinds = dict()
+        self.validators = dict()
+        for plan in definition.pop("plans", []):
+            plan = dict(plan)
+            kind = plan.pop("kind", plan.get("name"))
+            if kind not in KINDS:
+                raise ValueError("plan {0} is of unknown kind {1}, choose from {2}".format(
+                    plan.get("id"), kind, ", ".join(KINDS)))
+            if plan.get("schemas") is not None:
+                for target in (SERVICE_INSTANCE, SERVICE_BINDING):
+                    schema = ((plan["schemas"].get(target) or dict()).get("create") or dict()).get("parameters")
+                    if schema is not None:
+                        self.validators[(plan.get("id"), target)] = Validator(schema)
+                plan["schemas"] = Schemas(**plan["schemas"])
+            plans.append(ServicePlan(**plan))
+            self.kinds[plan["id"]] = kind
+        self.service = Service(plans=plans, **definition)
+        self.body = json.dumps(todict(CatalogResponse([self.service]))).encode("utf-8")
+        self.etag = '"{0}"'.format(hashlib.sha1(self.body).hexdigest())
+
+    @classmethod
+    def load(cls, path: str=None):
+        with open(path or DEFAULT_PLANS) as f:
+            return cls(json.load(f))
+
+    def kind(self, plan_id: str) -> str:
+        return self.kinds.get(plan_id)
+
+    def validate(self, plan_id: str, target: str, parameters: dict):
+        """
+        Raise validation.InvalidParameters with all the ways parameters
+        violate the create schema of target, a service instance or binding,
+        of the plan.
+        """
+        validator = self.validators.get((plan_id, target))
+        if validator is not None:
+            validator.validate(parameters if parameters is not None else dict())
+
+    def not_modified(self, if_none_match: str) -> bool:
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        # If-None-Match compares weakly
+        return "*" in tags or any((tag[2:] if tag.startswith("W/") else tag) == self.etag for tag in tags)
@@ -0,0 +1,326 @@
+import bisect
+import hashlib
+import http.client
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+FORWARDED_HEADER = "X-Opcua-Broker-Forwarded"
+HOP_BY_HOP_HEADERS = ("connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade", "te",
+                      "trailer", "content-length", "host")
+
+INSTANCE_PATH = re.compile("/v2/service_instances/(?P<instance_id>[^/]+)(?:/.*)?")
+BINDING_PATH = re.compile("/opcua/bindings/(?P<binding_id>[^/]+)/.*")
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of replica urls, each placed on the ring vnodes
+    times so that keys spread evenly and only about 1/n of them move when a
+    replica comes or goes.
+    """
+
+    def __init__(self, members: list=(), vnodes: int=64, **kwargs):
+        self.members = tuple(sorted(set(members)))
+        points = sorted((ring_hash("{0}#{1}".format(member, i)), member)
+                        for member in self.members for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key: str) -> str:
+        if not self._hashes:
+            return None
+        return self._owners[bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)]
+
+
+class LRUCache(object):
+    def __init__(self, max_size: int=100000, **kwargs):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key: str):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class Cluster(object):
+    """
+    Membership and request routing of a broker replica among several sharing
+    one state store.
+
+    Replicas announce themselves with a heartbeat record in the store and
+    every replica builds the same hash ring from the ones seen within
+    member_ttl seconds. Each service instance is assigned a partition key
+    when it is provisioned, the url of its OPC UA endpoint, so all instances,
+    bindings, sessions and subscriptions of one server end up on the replica
+    owning that url on the ring. route() tells which replica a request
+    belongs to; requests for another one are forwarded to it.
+
+    When the membership changes the listeners are called with owns_instance,
+    so that a replica reloads its registries from the store and drops the
+    subscriptions of instances it no longer owns.
+    """
+
+    REPLICA = "replica"
+    PARTITION = "partition"
+
+    def __init__(self,
+                 url: str,
+                 state_store,
+                 vnodes: int=64,
+                 heartbeat_interval: float=2,
+                 member_ttl: float=10,
+                 forward_timeout: float=60,
+                 sweep_interval: float=60,
+                 retention: float=3600,
+                 **kwargs):
+        self.url = url.rstrip("/")
+        self.state_store = state_store
+        self.vnodes = vnodes
+        self.heartbeat_interval = heartbeat_interval
+        self.member_ttl = member_ttl
+        self.forward_timeout = forward_timeout
+        self.sweep_interval = sweep_interval
+        self.retention = retention
+        self.ring = HashRing([self.url], vnodes)
+        self._partitions = LRUCache()
+        self._bindings = LRUCache()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._swept = time.time()
+        self._thread = None
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def start(self):
+        self.heartbeat()
+        self.refresh()
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="opcua-cluster")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        # leave the ring right away instead of after member_ttl
+        try:
+            self.state_store.delete(self.REPLICA, self.url)
+        except OSError as e:
+            logger.info("Leaving the cluster after member_ttl, the state store is unavailable: %s", e)
+
+    def heartbeat(self):
+        seen = time.time()
+        self.state_store.save(self.REPLICA, self.url, dict(url=self.url, seen=seen), dict(seen=seen))
+
+    def refresh(self) -> bool:
+        now = time.time()
+        members = {self.url}
+        for url, index in self.state_store.load_index(self.REPLICA):
+            if index.get("seen", 0) >= now - self.member_ttl:
+                members.add(url)
+            elif index.get("seen", 0) < now - 2 * self.member_ttl and url != self.url:
+                self.state_store.delete(self.REPLICA, url)
+        if tuple(sorted(members)) == self.ring.members:
+            return False
+
+        logger.info("Cluster members changed from %s to %s", ", ".join(self.ring.members),
+                    ", ".join(sorted(members)))
+        self.ring = HashRing(members, self.vnodes)
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(self.owns_instance)
+            except Exception:
+                logger.exception("Failed to rebalance after a membership change")
+        return True
+
+    def members(self) -> tuple:
+        return self.ring.members
+
+    def collect_metrics(self) -> list:
+        return [("opcua_broker_cluster_members", "gauge", "Live replicas of the broker cluster",
+                 [(dict(), len(self.ring.members))])]
+
+    def owner(self, key: str) -> str:
+        return self.ring.owner(key)
+
+    def owns_instance(self, instance_id: str) -> bool:
+        return self.owner(self.partition_key(instance_id)) == self.url
+
+    def assign(self, instance_id: str, key: str) -> str:
+        """
+        The partition key of instance_id, which is key unless the instance
+        already has one.
+        """
+        record = self.state_store.load(self.PARTITION, instance_id)
+        if record is not None:
+            key = record["key"]
+        else:
+            self.state_store.save(self.PARTITION, instance_id, dict(key=key), dict(key=key, created=time.time()))
+        self._partitions.put(instance_id, key)
+        return key
+
+    def partition_key(self, instance_id: str) -> str:
+        key = self._partitions.get(instance_id)
+        if key is not None:
+            return key
+        record = self.state_store.load(self.PARTITION, instance_id)
+        if record is not None:
+            key = record["key"]
+        else:
+            # instances provisioned before the broker ran as a cluster
+            record = self.state_store.load("instance", instance_id)
+            params = (record or dict()).get("params") or dict()
+            key = params.get("url") or params.get("discovery_url")
+            if key is None:
+                return instance_id
+        self._partitions.put(instance_id, key)
+        return key
+
+    def binding_instance(self, binding_id: str) -> str:
+        instance_id = self._bindings.get(binding_id)
+        if instance_id is None:
+            record = self.state_store.load("binding", binding_id)
+            if record is None:
+                return None
+            instance_id = record["instance_id"]
+            self._bindings.put(binding_id, instance_id)
+        return instance_id
+
+    def route(self, method: str, path: str, headers, body: bytes=None) -> str:
+        """
+        The url of the replica which has to serve a request, or None if this
+        one does. Requests already forwarded by another replica are always
+        served here, so replicas briefly disagreeing on the membership never
+        bounce a request back and forth.
+        """
+        if headers.get(FORWARDED_HEADER) or headers.get(FORWARDED_HEADER.lower()):
+            return None
+
+        match = INSTANCE_PATH.fullmatch(path)
+        if match is not None:
+            instance_id = match.group("instance_id")
+            if method == "PUT" and path.count("/") == 3:
+                try:
+                    parameters = json.loads(body.decode("utf-8")).get("parameters") or dict()
+                except (AttributeError, ValueError):
+                    parameters = dict()
+                key = self.assign(instance_id, parameters.get("url") or parameters.get("discovery_url") or
+                                  instance_id)
+            else:
+                key = self.partition_key(instance_id)
+        else:
+            match = BINDING_PATH.fullmatch(path)
+            if match is None:
+                return None
+            instance_id = self.binding_instance(match.group("binding_id"))
+            if instance_id is None:
+                return None
+            key = self.partition_key(instance_id)
+
+        owner = self.owner(key)
+        return None if owner == self.url else owner
+
+    def forward(self, owner: str, method: str, target: str, headers, body: bytes=None):
+        """
+        Send a request to the replica at owner and return its
+        http.client.HTTPResponse, to be read by the caller.
+        """
+        location = urlparse(owner)
+        conn = http.client.HTTPConnection(location.hostname, location.port, timeout=self.forward_timeout)
+        conn.request(method, target, body=body or None, headers=self.forward_headers(headers))
+        return conn.getresponse()
+
+    async def forward_async(self, owner: str, method: str, target: str, headers, body: bytes=None) -> tuple:
+        """
+        forward() on the event loop. The request is sent as HTTP/1.0, so the
+        response comes without chunked encoding and ends when the replica
+        closes the connection; returns the status, the headers and the
+        asyncio streams, the writer to be closed once the body is read.
+        """
+        # only the asyncio mode forwards on the event loop, the broker starts
+        # faster without importing asyncio
+        import asyncio
+
+        location = urlparse(owner)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(location.hostname, location.port),
+                                                self.forward_timeout)
+        lines = ["{0} {1} HTTP/1.0".format(method, target), "Host: {0}".format(location.netloc)]
+        lines.extend("{0}: {1}".format(name, value) for name, value in self.forward_headers(headers).items())
+        lines.append("Content-Length: {0}".format(len(body or b"")))
+        try:
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b""))
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.forward_timeout)
+            head = head.decode("latin-1").split("\r\n")
+            status = int(head[0].split(" ")[1])
+        except Exception:
+            writer.close()
+            raise
+        response_headers = []
+        for line in head[1:]:
+            if ":" not in line:
+                continue
+            name, value = line.split(":", 1)
+            if name.strip().lower() not in HOP_BY_HOP_HEADERS:
+                response_headers.append((name.strip(), value.strip()))
+        return status, response_headers, reader, writer
+
+    def forward_headers(self, headers) -> dict:
+        forwarded = dict((name, value) for name, value in headers.items()
+                         if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != FORWARDED_HEADER.lower())
+        forwarded[FORWARDED_HEADER] = self.url
+        return forwarded
+
+    def _heartbeat_loop(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat()
+                self.refresh()
+                if time.time() - self._swept >= self.sweep_interval:
+                    self._sweep()
+            except Exception:
+                logger.exception("Cluster heartbeat failed")
+
+    def _sweep(self):
+        # partition records outlive failed provisions and deprovisioned
+        # instances; each replica drops the stale ones it owns
+        self._swept = time.time()
+        instances = set(key for key, _ in self.state_store.load_index("instance"))
+        expired = self._swept - self.retention
+        for instance_id, index in self.state_store.load_index(self.PARTITION):
+            if instance_id in instances or index.get("created", 0) >= expired:
+                continue
+            if self.owner(index["key"]) == self.url:
+                self.state_store.delete(self.PARTITION, instance_id)
+                self._partitions.pop(instance_id)
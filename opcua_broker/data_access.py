@@ -0,0 +1,156 @@
+import base64
+import json
+import uuid
+
+from dateutil import parser as date_parser
+
+from opcua import ua
+
+from . import metrics
+from . import node_management
+from .subscription import to_json_value
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def parse_browse_path(path) -> list:
+    # "0:Objects/2:Plant/2:Temperature" or ["0:Objects", "2:Plant", "2:Temperature"],
+    # relative to the Root folder
+    if isinstance(path, str):
+        path = [element for element in path.split("/") if element]
+    return [ua.QualifiedName.from_string(element) for element in path]
+
+
+def resolve(client, nodes: list=None, paths: list=None) -> list:
+    """
+    Turn node ids and browse paths into NodeIds, in that order. Browse paths
+    are translated with chunked multi-path TranslateBrowsePathsToNodeIds
+    requests and the results are kept on the client for later calls.
+    """
+    node_ids = [node_management.to_node_id(node) for node in (nodes or [])]
+    if not paths:
+        return node_ids
+
+    resolved = getattr(client, "resolved_paths", None)
+    if resolved is None:
+        resolved = client.resolved_paths = dict()
+    keys = ["/".join(path) if isinstance(path, list) else path for path in paths]
+    missing = [key for key in dict.fromkeys(keys) if key not in resolved]
+
+    limit = node_management.get_operation_limits(client).get("MaxNodesPerTranslateBrowsePathsToNodeIds")
+    for chunk in node_management.chunked(missing, limit):
+        browse_paths = []
+        for key in chunk:
+            browse_path = ua.BrowsePath()
+            browse_path.StartingNode = ua.TwoByteNodeId(ua.ObjectIds.RootFolder)
+            for name in parse_browse_path(key):
+                element = ua.RelativePathElement()
+                element.ReferenceTypeId = ua.TwoByteNodeId(ua.ObjectIds.HierarchicalReferences)
+                element.IsInverse = False
+                element.IncludeSubtypes = True
+                element.TargetName = name
+                browse_path.RelativePath.Elements.append(element)
+            browse_paths.append(browse_path)
+        with metrics.opcua_request(client, "TranslateBrowsePathsToNodeIds"):
+            results = client.uaclient.translate_browsepaths_to_nodeids(browse_paths)
+        for key, result in zip(chunk, results):
+            if not result.StatusCode.is_good() or not result.Targets:
+                raise ValueError("browse path {0} could not be resolved: {1}".format(key, result.StatusCode.name))
+            resolved[key] = result.Targets[0].TargetId
+    return node_ids + [resolved[key] for key in keys]
+
+
+def read_values(client, node_ids: list) -> dict:
+    """
+    Read the Value attribute of node_ids with as few Read requests as the
+    server's MaxNodesPerRead allows and return the results column by column.
+    """
+    columns = dict(nodeId=[], value=[], sourceTimestamp=[], statusCode=[])
+    for node_id, result in zip(node_ids, node_management.read(client, node_ids)):
+        columns["nodeId"].append(node_id.to_string())
+        columns["value"].append(to_json_value(result.Value.Value if result.Value is not None else None))
+        columns["sourceTimestamp"].append(to_json_value(result.SourceTimestamp))
+        columns["statusCode"].append(result.StatusCode.name)
+    return columns
+
+
+def variant_types(client, node_ids: list) -> list:
+    # A value written must carry the exact variant type of the variable, so
+    # the types are learnt from one batched Read of the current values and
+    # kept on the client like the operation limits.
+    known = getattr(client, "variant_types", None)
+    if known is None:
+        known = client.variant_types = dict()
+    missing = list(dict.fromkeys(node_id for node_id in node_ids if node_id not in known))
+    for node_id, result in zip(missing, node_management.read(client, missing)):
+        if result.StatusCode.is_good() and result.Value is not None \
+                and result.Value.VariantType != ua.VariantType.Null:
+            known[node_id] = result.Value.VariantType
+    return [known.get(node_id) for node_id in node_ids]
+
+
+def to_variant(value, variant_type: ua.VariantType) -> ua.Variant:
+    if variant_type is None:
+        return ua.Variant(value)
+    if isinstance(value, list):
+        return ua.Variant([from_json_value(v, variant_type) for v in value], variant_type)
+    return ua.Variant(from_json_value(value, variant_type), variant_type)
+
+
+def from_json_value(value, variant_type: ua.VariantType):
+    if value is None:
+        return None
+    if variant_type == ua.VariantType.DateTime:
+        return date_parser.parse(value)
+    if variant_type == ua.VariantType.ByteString:
+        return base64.b64decode(value)
+    if variant_type == ua.VariantType.Guid:
+        return uuid.UUID(value)
+    if variant_type in (ua.VariantType.NodeId, ua.VariantType.ExpandedNodeId):
+        return ua.NodeId.from_string(value)
+    if variant_type == ua.VariantType.QualifiedName:
+        return ua.QualifiedName.from_string(value)
+    if variant_type == ua.VariantType.LocalizedText:
+        return ua.LocalizedText(value)
+    if variant_type in (ua.VariantType.Float, ua.VariantType.Double):
+        return float(value)
+    return value
+
+
+def write_values(client, node_ids: list, values: list) -> dict:
+    """
+    Write values to the Value attribute of node_ids with chunked multi-node
+    Write requests, limited by MaxNodesPerWrite, and return a status code
+    column.
+    """
+    if len(node_ids) != len(values):
+        raise ValueError("{0} values given for {1} nodes".format(len(values), len(node_ids)))
+    types = variant_types(client, node_ids)
+    items = list(zip(node_ids, values, types))
+    results = []
+    for chunk in node_management.chunked(items, node_management.get_operation_limits(client).get("MaxNodesPerWrite")):
+        params = ua.WriteParameters()
+        for node_id, value, variant_type in chunk:
+            write_value = ua.WriteValue()
+            write_value.NodeId = node_id
+            write_value.AttributeId = ua.AttributeIds.Value
+            write_value.Value = ua.DataValue(to_variant(value, variant_type))
+            params.NodesToWrite.append(write_value)
+        with metrics.opcua_request(client, "Write"):
+            results.extend(client.uaclient.write(params))
+    return dict(nodeId=[node_id.to_string() for node_id in node_ids],
+                statusCode=[result.name for result in results])
+
+
+def encode(columns: dict, accept: str=None) -> tuple:
+    # MessagePack is only offered when the client asks for it and the
+    # optional msgpack package is installed
+    if msgpack is not None and accept and any(mimetype in accept for mimetype in MSGPACK_MIMETYPES):
+        return msgpack.packb(columns, use_bin_type=True), "application/msgpack"
+    return json.dumps(columns, separators=(",", ":")), "application/json"
@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from opcua import Client
+from opcua import ua
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def endpoint_to_dict(endpoint: ua.EndpointDescription) -> dict:
+    return dict(endpointUrl=endpoint.EndpointUrl,
+                securityMode=endpoint.SecurityMode.name.rstrip("_"),
+                securityPolicyUri=endpoint.SecurityPolicyUri,
+                securityLevel=endpoint.SecurityLevel,
+                transportProfileUri=endpoint.TransportProfileUri,
+                server=application_to_dict(endpoint.Server),
+                userIdentityTokens=[dict(policyId=token.PolicyId, tokenType=token.TokenType.name)
+                                    for token in endpoint.UserIdentityTokens])
+
+
+def application_to_dict(application: ua.ApplicationDescription) -> dict:
+    return dict(applicationUri=application.ApplicationUri,
+                applicationName=application.ApplicationName.Text,
+                applicationType=application.ApplicationType.name,
+                discoveryUrls=application.DiscoveryUrls)
+
+
+def server_on_network_to_dict(server: ua.ServerOnNetwork) -> dict:
+    return dict(recordId=server.RecordId,
+                serverName=server.ServerName,
+                discoveryUrl=server.DiscoveryUrl,
+                serverCapabilities=server.ServerCapabilities)
+
+
+def discover(url: str, security_string: str=None, find_servers: bool=False, find_servers_on_network: bool=False,
+             timeout: float=4) -> dict:
+    """
+    Run GetEndpoints and, when asked for, FindServers and FindServersOnNetwork
+    against a discovery server (usually an LDS) over one secure channel.
+    Discovery services need no session, which an LDS or a server taking
+    only some user identities would reject, and are never pooled, so they
+    take no session of the pool from provisioning.
+    """
+    client = Client(url, timeout=timeout)
+    if security_string:
+        client.set_security_string(security_string)
+    with metrics.opcua_request(client, "connect"):
+        client.connect_socket()
+        try:
+            client.send_hello()
+            client.open_secure_channel()
+        except Exception:
+            client.disconnect_socket()
+            raise
+    try:
+        with metrics.opcua_request(client, "GetEndpoints"):
+            result = dict(endpoints=[endpoint_to_dict(endpoint) for endpoint in client.get_endpoints()])
+        if find_servers:
+            with metrics.opcua_request(client, "FindServers"):
+                result["servers"] = [application_to_dict(server) for server in client.find_servers()]
+        if find_servers_on_network:
+            with metrics.opcua_request(client, "FindServersOnNetwork"):
+                result["serversOnNetwork"] = [server_on_network_to_dict(server)
+                                              for server in client.find_servers_on_network().Servers]
+        client.close_secure_channel()
+    finally:
+        client.disconnect_socket()
+    return result
+
+
+class Flight(object):
+    def __init__(self, **kwargs):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CacheEntry(object):
+    def __init__(self, value, ttl: float, **kwargs):
+        now = time.time()
+        self.value = value
+        self.fetched = now
+        self.expires = now + ttl
+        self.last_access = now
+
+
+class DiscoveryCache(object):
+    """
+    LRU cache of discovery results keyed by discovery url and options.
+
+    Entries live for ttl seconds. Concurrent misses for one key share a single
+    fetch. With refresh_interval set, a background thread re-fetches entries
+    that were used since their last fetch before they expire, so hot keys are
+    never served from a cold cache.
+    """
+
+    def __init__(self,
+                 fetch,
+                 ttl: float=300,
+                 max_entries: int=256,
+                 refresh_interval: float=None,
+                 **kwargs):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        self._entries = OrderedDict()
+        self._flights = dict()
+        self._lock = threading.Lock()
+        self._closed = False
+        if refresh_interval:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="opcua-discovery-refresh")
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > time.time():
+                entry.last_access = time.time()
+                self._entries.move_to_end(key)
+                return entry.value
+        return self._load(key)
+
+    def invalidate(self, key: tuple):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            self._entries.clear()
+
+    def _load(self, key: tuple):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self.fetch(*key)
+            self._store(key, flight.value)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.value
+
+    def _store(self, key: tuple, value):
+        with self._lock:
+            self._entries[key] = CacheEntry(value, self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _refresh_loop(self):
+        while not self._closed:
+            time.sleep(self.refresh_interval)
+            deadline = time.time() + self.refresh_interval
+            with self._lock:
+                due = [key for key, entry in self._entries.items()
+                       if entry.expires <= deadline and entry.last_access > entry.fetched]
+            for key in due:
+                try:
+                    self._load(key)
+                except Exception as e:
+                    logger.info("Background refresh of discovery results for %s failed: %s", key[0], e)
@@ -0,0 +1,773 @@
+import logging
+import threading
+import time
+from operator import attrgetter
+
+from openbrokerapi.service_broker import (
+    ProvisionedServiceSpec,
+    Binding,
+    DeprovisionServiceSpec,
+    BindResource
+)
+
+from opcua import ua
+
+from . import browse
+from . import data_access
+from . import history
+from . import node_management
+from .browse import NodeIndex
+from .discovery import DiscoveryCache, discover
+from .pipeline import Pipeline, build_pipeline
+from .pool import SessionPool
+from .registry import Registry
+from .spool import SpoolDirectory
+from .store import StateStore
+from .subscription import DATA_CHANGE, EVENTS, RingBuffer, SubscriptionManager
+
+
+logger = logging.getLogger(__name__)
+
+
+class OpcuaServiceInstance:
+    def __init__(self,
+                 instance_id: str,
+                 service_id: str,
+                 plan_id: str,
+                 params: dict=None,
+                 **kwargs):
+        self.id = instance_id
+        self.service_id = service_id
+        self.plan_id = plan_id
+        self.params = params
+
+    def to_dict(self) -> dict:
+        return dict(instance_id=self.id, service_id=self.service_id, plan_id=self.plan_id, params=self.params)
+
+    @staticmethod
+    def from_dict(record: dict):
+        return OpcuaServiceInstance(**record)
+
+
+class OpcuaServiceBinding:
+    def __init__(self,
+                 binding_id: str,
+                 instance_id: str,
+                 service_id: str,
+                 plan_id: str,
+                 bind_resource: BindResource,
+                 params: dict=None,
+                 **kwargs):
+        self.id = binding_id
+        self.instance_id = instance_id
+        self.service_id = service_id
+        self.plan_id = plan_id
+        self.bind_resource = bind_resource
+        self.params = params
+
+    def to_dict(self) -> dict:
+        bind_resource = None
+        if self.bind_resource is not None:
+            bind_resource = dict(app_guid=self.bind_resource.app_guid, route=self.bind_resource.route)
+        return dict(binding_id=self.id, instance_id=self.instance_id, service_id=self.service_id,
+                    plan_id=self.plan_id, bind_resource=bind_resource, params=self.params)
+
+    @staticmethod
+    def from_dict(record: dict):
+        record = dict(record)
+        if record.get("bind_resource") is not None:
+            record["bind_resource"] = BindResource(**record["bind_resource"])
+        return OpcuaServiceBinding(**record)
+
+
+def instance_url(service_instance: OpcuaServiceInstance) -> str:
+    params = service_instance.params or dict()
+    return params.get("url") or params.get("discovery_url")
+
+
+def discovery_key(parameters: dict) -> tuple:
+    return (parameters.get("discovery_url"),
+            parameters.get("security") or None,
+            bool(parameters.get("findServers")),
+            bool(parameters.get("findServersOnNetwork")))
+
+
+def spool_options(kind: str, parameters: dict) -> dict:
+    # the retention of the spool of a data-change binding, None for no spool
+    spool = parameters.get("spool", True)
+    if kind != DATA_CHANGE or spool is False:
+        return None
+    spool = spool if isinstance(spool, dict) else dict()
+    return dict(max_bytes=spool.get("maxBytes"), max_age=spool.get("maxAge"))
+
+
+def binding_pipeline(kind: str, parameters: dict) -> Pipeline:
+    # the stages the records of a data-change binding pass, None for none
+    return build_pipeline(parameters) if kind == DATA_CHANGE else None
+
+
+def released_bindings(binding_ids: list, service_bindings: Registry, owns_instance) -> list:
+    released = []
+    for binding_id in binding_ids:
+        service_binding = service_bindings.get(binding_id)
+        if service_binding is None or not owns_instance(service_binding.instance_id):
+            released.append(binding_id)
+    return released
+
+
+class OpcuaHandler(object):
+    def __init__(self,
+                 url: str,
+                 service_instances: Registry=None,
+                 service_bindings: Registry=None,
+                 session_pool: SessionPool=None,
+                 state_store: StateStore=None,
+                 discovery_ttl: float=300,
+                 discovery_refresh: float=None,
+                 browse_depth: int=None,
+                 spool_directory: SpoolDirectory=None,
+                 **kwargs):
+        self.url = url
+        self.state_store = state_store
+        self.spool_directory = spool_directory
+        self.discovery_cache = DiscoveryCache(self._discover, ttl=discovery_ttl, refresh_interval=discovery_refresh)
+        self.service_instances = service_instances or Registry(indexes=dict(plan_id=attrgetter("plan_id"),
+                                                                            url=instance_url),
+                                                               store=state_store,
+                                                               kind="instance",
+                                                               dump=OpcuaServiceInstance.to_dict,
+                                                               load=OpcuaServiceInstance.from_dict)
+        self.service_bindings = service_bindings or Registry(indexes=dict(plan_id=attrgetter("plan_id"),
+                                                                          instance_id=attrgetter("instance_id")),
+                                                             store=state_store,
+                                                             kind="binding",
+                                                             dump=OpcuaServiceBinding.to_dict,
+                                                             load=OpcuaServiceBinding.from_dict)
+        self.session_pool = session_pool or SessionPool()
+        self.subscriptions = SubscriptionManager(self.session_pool, spool_directory)
+        self._subscription_lock = threading.Lock()
+        self.browse_depth = browse_depth
+        self.node_indexes = dict()
+        self._node_index_lock = threading.Lock()
+        self.service_instances.restore()
+        self.service_bindings.restore()
+
+    def provision_discovery_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                     parameters: dict=None) -> ProvisionedServiceSpec:
+        url = parameters.get("discovery_url")
+        if not url:
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("Performing discovery at %s", url)
+        try:
+            discovered = self.discovery_cache.get(discovery_key(parameters))
+
+            service_instance = OpcuaServiceInstance(instance_id, service_id, plan_id, parameters)
+            service_instance.params.update(discovered)
+
+            self.service_instances.put(instance_id, service_instance)
+        except Exception:
+            logger.exception("Failed to provision discovery service instance %s", instance_id)
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("Discovery service instance %s is provisioned successfully", instance_id)
+        return ProvisionedServiceSpec()
+
+    def _discover(self, url: str, security: str, find_servers: bool, find_servers_on_network: bool) -> dict:
+        return discover(url, security, find_servers, find_servers_on_network, timeout=self.session_pool.timeout)
+
+    def deprovision_discovery_instance(self, instance_id: str) -> DeprovisionServiceSpec:
+        if self.service_instances.pop(instance_id) is None:
+            return DeprovisionServiceSpec(is_async=False)
+
+        logger.info("Discovery service instance %s is deprovisioned successfully", instance_id)
+        return DeprovisionServiceSpec(is_async=False)
+
+    def bind_discovery_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str,
+                                bind_resource: BindResource, parameters: dict=None):
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return Binding(state="failed")
+
+        try:
+            credentials = dict(self.discovery_cache.get(discovery_key(service_instance.params)))
+        except Exception as e:
+            logger.warning("%s, binding with the endpoints discovered at provisioning", e)
+            credentials = dict()
+            credentials["endpoints"] = service_instance.params["endpoints"]
+        service_binding = OpcuaServiceBinding(binding_id, instance_id, service_id, plan_id, bind_resource,
+                                              parameters or dict())
+        service_binding.params["credentials"] = credentials
+
+        self.service_bindings.put(binding_id, service_binding)
+
+        logger.info("Discovery service binding %s is bound to service instance %s successfully",
+                    binding_id, instance_id)
+        return Binding(credentials=credentials)
+
+    def unbind_discovery_instance(self, instance_id: str, binding_id: str):
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None:
+            return
+
+        if not instance_id == service_binding.instance_id:
+            logger.info("Discovery service binding %s was not bound to service instance %s",
+                        binding_id, instance_id)
+            return
+
+        self.service_bindings.pop(binding_id)
+
+        logger.info("Discovery service binding %s is unbound to service instance %s successfully",
+                    binding_id, instance_id)
+        return
+
+    def provision_node_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                parameters: dict=None,
+                                tree: node_management.NodeTree=None) -> ProvisionedServiceSpec:
+        url = parameters.get("url")
+        if not url:
+            logger.error("url not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+        nodes_to_add = parameters.get("nodesToAdd")
+        if not nodes_to_add:
+            logger.error("nodes_to_add not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+
+        # every bad node spec is reported at once, before a session is opened,
+        # unless the broker parsed them before answering already
+        if tree is None:
+            tree = node_management.NodeTree(nodes_to_add)
+
+        nodes = []
+        failures = []
+        try:
+            with self.session_pool.session(url, parameters.get("security")) as client:
+                # results arrive level by level, parents before their children,
+                # so nodes holds everything added so far if a later wave fails
+                # and has to be rolled back
+                for index, result in node_management.add_node_tree(client, tree):
+                    if result.StatusCode.is_good():
+                        nodes.append(result.AddedNodeId.to_string())
+                    else:
+                        logger.error("failed to add node %s: %s", tree.names[index], result.StatusCode.name)
+                        failures.append(dict(browseName=tree.names[index], statusCode=result.StatusCode.name))
+                if not nodes:
+                    raise RuntimeError("none of the {0} nodes could be added".format(len(tree)))
+
+            service_instance = OpcuaServiceInstance(instance_id, service_id, plan_id, parameters)
+            service_instance.params["nodes"] = nodes
+            service_instance.params["failedNodes"] = failures
+
+            self.service_instances.put(instance_id, service_instance)
+            self._invalidate_nodes(url, parameters.get("security"), nodes)
+        except Exception:
+            logger.exception("Failed to provision node management service instance %s", instance_id)
+            self._rollback_nodes(url, parameters.get("security"), [ua.NodeId.from_string(node) for node in nodes])
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("Node management service instance %s is provisioned successfully", instance_id)
+        return ProvisionedServiceSpec()
+
+    def deprovision_node_instance(self, instance_id: str) -> DeprovisionServiceSpec:
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return DeprovisionServiceSpec(is_async=False)
+
+        url = service_instance.params.get("url")
+        nodes = service_instance.params.get("nodes")
+
+        try:
+            with self.session_pool.session(url, service_instance.params.get("security")) as client:
+                # children go before their parents, so walk the nodes backwards
+                nodes = list(reversed(nodes))
+                results = node_management.delete_nodes(client, [ua.NodeId.from_string(node) for node in nodes])
+        except Exception:
+            logger.exception("Failed to deprovision node management service instance %s", instance_id)
+            return DeprovisionServiceSpec(is_async=False)
+
+        self._invalidate_nodes(url, service_instance.params.get("security"), nodes, deleted=True)
+        remaining = [node for node, result in zip(nodes, results) if not node_management.is_deleted(result)]
+        if remaining:
+            logger.error("%d nodes of service instance %s could not be deleted", len(remaining), instance_id)
+            service_instance.params["nodes"] = list(reversed(remaining))
+            self.service_instances.put(instance_id, service_instance)
+            return DeprovisionServiceSpec(is_async=False)
+
+        self.service_instances.pop(instance_id)
+
+        logger.info("Node service instance %s is deprovisioned successfully", instance_id)
+        return DeprovisionServiceSpec(is_async=False)
+
+    def provision_reference_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                     parameters: dict=None,
+                                     add_references_items: list=None) -> ProvisionedServiceSpec:
+        url = parameters.get("url")
+        if not url:
+            logger.error("url not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+        references_to_add = parameters.get("referencesToAdd")
+        if not references_to_add:
+            logger.error("referencesToAdd not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+
+        if add_references_items is None:
+            add_references_items = node_management.build_add_references_items(references_to_add)
+
+        references = []
+        existing_references = []
+        failures = []
+        try:
+            with self.session_pool.session(url, parameters.get("security")) as client:
+                # references the server already has are not added again, so
+                # provisioning the same hierarchy twice creates no duplicates
+                existing = browse.existing_references(client, add_references_items)
+                seen = set()
+                for item in add_references_items:
+                    key = node_management.reference_key(item)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if key in existing:
+                        existing_references.append(list(key))
+                    else:
+                        references.append(item)
+                results = node_management.add_references(client, references)
+
+            added = []
+            for item, result in zip(references, results):
+                if result.is_good():
+                    added.append(list(node_management.reference_key(item)))
+                else:
+                    logger.error("failed to add reference %s: %s", node_management.reference_key(item),
+                                 result.name)
+                    failures.append(dict(reference=list(node_management.reference_key(item)),
+                                         statusCode=result.name))
+            if not added and not existing_references:
+                raise RuntimeError("none of the {0} references could be added".format(len(add_references_items)))
+
+            service_instance = OpcuaServiceInstance(instance_id, service_id, plan_id, parameters)
+            service_instance.params["references"] = added
+            service_instance.params["existingReferences"] = existing_references
+            service_instance.params["failedReferences"] = failures
+
+            self.service_instances.put(instance_id, service_instance)
+            self._invalidate_nodes(url, parameters.get("security"), [item.SourceNodeId for item in references])
+        except Exception:
+            logger.exception("Failed to provision reference management service instance %s", instance_id)
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("Reference management service instance %s is provisioned successfully", instance_id)
+        return ProvisionedServiceSpec()
+
+    def deprovision_reference_instance(self, instance_id: str) -> DeprovisionServiceSpec:
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return DeprovisionServiceSpec(is_async=False)
+
+        url = service_instance.params.get("url")
+        # only the references this instance added are deleted, never those
+        # which were there before
+        references = [tuple(reference) for reference in service_instance.params.get("references") or []]
+
+        try:
+            with self.session_pool.session(url, service_instance.params.get("security")) as client:
+                results = node_management.delete_references(client, references)
+        except Exception:
+            logger.exception("Failed to deprovision reference management service instance %s", instance_id)
+            return DeprovisionServiceSpec(is_async=False)
+
+        self._invalidate_nodes(url, service_instance.params.get("security"),
+                               [reference[0] for reference in references])
+        remaining = [list(reference) for reference, result in zip(references, results)
+                     if not node_management.is_reference_deleted(result)]
+        if remaining:
+            logger.error("%d references of service instance %s could not be deleted",
+                         len(remaining), instance_id)
+            service_instance.params["references"] = remaining
+            self.service_instances.put(instance_id, service_instance)
+            return DeprovisionServiceSpec(is_async=False)
+
+        self.service_instances.pop(instance_id)
+
+        logger.info("Reference management service instance %s is deprovisioned successfully", instance_id)
+        return DeprovisionServiceSpec(is_async=False)
+
+    def bind_node_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str,
+                           bind_resource: BindResource, parameters: dict=None):
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return Binding(state="failed")
+
+        credentials = dict(read="/opcua/bindings/{0}/read".format(binding_id),
+                           write="/opcua/bindings/{0}/write".format(binding_id),
+                           nodes=service_instance.params.get("nodes"))
+        try:
+            credentials["tags"] = self.list_tags(service_instance.params["url"], service_instance.params.get("security"),
+                                                 service_instance.params.get("nodes"))
+        except Exception as e:
+            logger.warning("%s, binding without the tags of the instance", e)
+        service_binding = OpcuaServiceBinding(binding_id, instance_id, service_id, plan_id, bind_resource,
+                                              parameters or dict())
+        service_binding.params["credentials"] = credentials
+        self.service_bindings.put(binding_id, service_binding)
+
+        logger.info("Node management service binding %s is bound to service instance %s successfully",
+                    binding_id, instance_id)
+        return Binding(credentials=credentials)
+
+    def unbind_node_instance(self, instance_id: str, binding_id: str):
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None or not instance_id == service_binding.instance_id:
+            return
+
+        self.service_bindings.pop(binding_id)
+
+        logger.info("Node management service binding %s is unbound to service instance %s successfully",
+                    binding_id, instance_id)
+        return
+
+    def read_binding_values(self, binding_id: str, nodes: list=None, paths: list=None) -> dict:
+        service_instance = self._binding_instance(binding_id, "nodesToAdd")
+        if service_instance is None:
+            return None
+        with self.session_pool.session(service_instance.params["url"],
+                                       service_instance.params.get("security")) as client:
+            return data_access.read_values(client, data_access.resolve(client, nodes, paths))
+
+    def write_binding_values(self, binding_id: str, values: list, nodes: list=None, paths: list=None) -> dict:
+        service_instance = self._binding_instance(binding_id, "nodesToAdd")
+        if service_instance is None:
+            return None
+        with self.session_pool.session(service_instance.params["url"],
+                                       service_instance.params.get("security")) as client:
+            return data_access.write_values(client, data_access.resolve(client, nodes, paths), values)
+
+    def _binding_instance(self, binding_id: str, param: str) -> OpcuaServiceInstance:
+        # the instance behind binding_id, if it is of the plan keeping param
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None:
+            return None
+        service_instance = self.service_instances.get(service_binding.instance_id)
+        if service_instance is None or param not in service_instance.params:
+            return None
+        return service_instance
+
+    def node_index(self, url: str, security: str=None) -> NodeIndex:
+        key = self.session_pool.make_key(url, security)
+        with self._node_index_lock:
+            index = self.node_indexes.get(key)
+            if index is not None:
+                return index
+            index = self.node_indexes[key] = NodeIndex(max_depth=self.browse_depth)
+        try:
+            session = self.session_pool.acquire_shared(url, security)
+            index.watch(session.client)
+        except Exception as e:
+            logger.warning("%s, model changes of %s are not watched", e, url)
+        return index
+
+    def list_tags(self, url: str, security: str=None, nodes: list=None) -> list:
+        """
+        The variables below nodes, or in the whole address space without
+        nodes, from the node index of the server at url. Only the parts of the
+        address space the index does not know yet are browsed.
+        """
+        index = self.node_index(url, security)
+        with self.session_pool.session(url, security) as client:
+            index.update(client, roots=nodes)
+        variables = dict()
+        for node in (nodes or [browse.ROOT]):
+            entry = index.get(node)
+            if entry is not None and entry.node_class == node_management.VARIABLE_NODE_CLASS:
+                variables[entry.node_id] = entry
+            for child in index.descendants(node, node_management.VARIABLE_NODE_CLASS):
+                variables[child.node_id] = child
+        return [index.to_dict(entry) for entry in variables.values()]
+
+    def _invalidate_nodes(self, url: str, security: str, nodes: list, deleted: bool=False):
+        index = self.node_indexes.get(self.session_pool.make_key(url, security))
+        if index is None:
+            return
+        for node in nodes:
+            index.invalidate(node, deleted=deleted)
+
+    def _rollback_nodes(self, url: str, security: str, nodes: list):
+        if not nodes:
+            return
+        try:
+            with self.session_pool.session(url, security) as client:
+                node_management.delete_nodes(client, list(reversed(nodes)))
+        except Exception:
+            logger.exception("Failed to roll back %d added nodes on %s", len(nodes), url)
+
+    def provision_subscription_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                        parameters: dict=None) -> ProvisionedServiceSpec:
+        return self._provision_subscription(DATA_CHANGE, instance_id, service_id, plan_id, parameters)
+
+    def provision_event_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                 parameters: dict=None) -> ProvisionedServiceSpec:
+        return self._provision_subscription(EVENTS, instance_id, service_id, plan_id, parameters)
+
+    def _provision_subscription(self, kind: str, instance_id: str, service_id: str, plan_id: str,
+                                parameters: dict=None) -> ProvisionedServiceSpec:
+        url = parameters.get("url")
+        if not url:
+            logger.error("url not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+        nodes = parameters.get("nodes") if kind == DATA_CHANGE else [parameters.get("sourceNodeId", ua.ObjectIds.Server)]
+        if not nodes:
+            logger.error("nodes not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+
+        # monitored items are only created once apps bind, provisioning just
+        # checks that the server knows every node, in one batched Read
+        try:
+            node_ids = [node_management.to_node_id(node) for node in nodes]
+            with self.session_pool.session(url, parameters.get("security")) as client:
+                results = node_management.read(client, node_ids, ua.AttributeIds.NodeClass)
+            unknown = [node_id.to_string() for node_id, result in zip(node_ids, results)
+                       if not result.StatusCode.is_good()]
+            if unknown:
+                raise RuntimeError("unknown nodes {0}".format(", ".join(unknown[:10])))
+
+            service_instance = OpcuaServiceInstance(instance_id, service_id, plan_id, parameters)
+            service_instance.params["kind"] = kind
+            self.service_instances.put(instance_id, service_instance)
+        except Exception:
+            logger.exception("Failed to provision subscription service instance %s", instance_id)
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("Subscription service instance %s is provisioned successfully", instance_id)
+        return ProvisionedServiceSpec()
+
+    def deprovision_subscription_instance(self, instance_id: str) -> DeprovisionServiceSpec:
+        if self.service_instances.pop(instance_id) is None:
+            return DeprovisionServiceSpec(is_async=False)
+        for service_binding in self.service_bindings.find("instance_id", instance_id):
+            self.subscriptions.unsubscribe(service_binding.id, discard=True)
+
+        logger.info("Subscription service instance %s is deprovisioned successfully", instance_id)
+        return DeprovisionServiceSpec(is_async=False)
+
+    def bind_subscription_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str,
+                                   bind_resource: BindResource, parameters: dict=None):
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return Binding(state="failed")
+
+        service_binding = OpcuaServiceBinding(binding_id, instance_id, service_id, plan_id, bind_resource,
+                                              parameters or dict())
+        try:
+            self._subscribe(service_instance, service_binding)
+        except Exception:
+            logger.exception("Failed to bind subscription service binding %s to service instance %s",
+                             binding_id, instance_id)
+            return Binding(state="failed")
+
+        credentials = dict(stream="/opcua/bindings/{0}/stream".format(binding_id))
+        service_binding.params["credentials"] = credentials
+        self.service_bindings.put(binding_id, service_binding)
+
+        logger.info("Subscription service binding %s is bound to service instance %s successfully",
+                    binding_id, instance_id)
+        return Binding(credentials=credentials)
+
+    def _subscribe(self, service_instance: OpcuaServiceInstance, service_binding: OpcuaServiceBinding) -> RingBuffer:
+        params = service_instance.params
+        nodes = params.get("nodes")
+        if params["kind"] == EVENTS:
+            nodes = [params["sourceNodeId"]] if params.get("sourceNodeId") is not None else None
+        return self.subscriptions.subscribe(service_binding.id, params["kind"], params["url"],
+                                            security=params.get("security"),
+                                            nodes=nodes,
+                                            publishing_interval=params.get("publishingInterval", 500),
+                                            sampling_interval=params.get("samplingInterval"),
+                                            queue_size=params.get("queueSize", 0),
+                                            event_types=params.get("eventTypes"),
+                                            capacity=service_binding.params.get("bufferSize", 10000),
+                                            spool=spool_options(params["kind"], service_binding.params),
+                                            pipeline=binding_pipeline(params["kind"], service_binding.params))
+
+    def unbind_subscription_instance(self, instance_id: str, binding_id: str):
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None or not instance_id == service_binding.instance_id:
+            return
+
+        self.service_bindings.pop(binding_id)
+        self.subscriptions.unsubscribe(binding_id, discard=True)
+
+        logger.info("Subscription service binding %s is unbound to service instance %s successfully",
+                    binding_id, instance_id)
+        return
+
+    def provision_history_instance(self, instance_id: str, service_id: str, plan_id: str,
+                                   parameters: dict=None) -> ProvisionedServiceSpec:
+        url = parameters.get("url")
+        if not url:
+            logger.error("url not contained in provision parameters!")
+            return ProvisionedServiceSpec(state="failed")
+
+        # bindings read the history of nodes on demand, provisioning just checks
+        # the server is there and knows the nodes the instance is limited to
+        try:
+            node_ids = [node_management.to_node_id(node) for node in parameters.get("nodes") or []]
+            with self.session_pool.session(url, parameters.get("security")) as client:
+                node_management.get_operation_limits(client)
+                results = node_management.read(client, node_ids, ua.AttributeIds.NodeClass) if node_ids else []
+            unknown = [node_id.to_string() for node_id, result in zip(node_ids, results)
+                       if not result.StatusCode.is_good()]
+            if unknown:
+                raise RuntimeError("unknown nodes {0}".format(", ".join(unknown[:10])))
+
+            service_instance = OpcuaServiceInstance(instance_id, service_id, plan_id, parameters)
+            service_instance.params["kind"] = history.HISTORY
+            self.service_instances.put(instance_id, service_instance)
+        except Exception:
+            logger.exception("Failed to provision history service instance %s", instance_id)
+            return ProvisionedServiceSpec(state="failed")
+
+        logger.info("History service instance %s is provisioned successfully", instance_id)
+        return ProvisionedServiceSpec()
+
+    def deprovision_history_instance(self, instance_id: str) -> DeprovisionServiceSpec:
+        if self.service_instances.pop(instance_id) is None:
+            return DeprovisionServiceSpec(is_async=False)
+
+        logger.info("History service instance %s is deprovisioned successfully", instance_id)
+        return DeprovisionServiceSpec(is_async=False)
+
+    def bind_history_instance(self, instance_id: str, binding_id: str, service_id: str, plan_id: str,
+                              bind_resource: BindResource, parameters: dict=None):
+        service_instance = self.service_instances.get(instance_id)
+        if service_instance is None:
+            return Binding(state="failed")
+
+        credentials = dict(history="/opcua/bindings/{0}/history".format(binding_id),
+                           nodes=service_instance.params.get("nodes"))
+        service_binding = OpcuaServiceBinding(binding_id, instance_id, service_id, plan_id, bind_resource,
+                                              parameters or dict())
+        service_binding.params["credentials"] = credentials
+        self.service_bindings.put(binding_id, service_binding)
+
+        logger.info("History service binding %s is bound to service instance %s successfully",
+                    binding_id, instance_id)
+        return Binding(credentials=credentials)
+
+    def unbind_history_instance(self, instance_id: str, binding_id: str):
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None or not instance_id == service_binding.instance_id:
+            return
+
+        self.service_bindings.pop(binding_id)
+
+        logger.info("History service binding %s is unbound to service instance %s successfully",
+                    binding_id, instance_id)
+        return
+
+    def read_binding_history(self, binding_id: str, query: dict, nodes: list=None, paths: list=None):
+        """
+        The history query of a history binding as a generator of NDJSON
+        lines, one per page of a node, or None for an unknown binding. The
+        generator holds a pooled session while it runs, reads page by page
+        as it is consumed, and raises ValueError for a bad query or nodes
+        the instance does not offer before yielding anything.
+        """
+        service_instance = self._binding_instance(binding_id, "kind")
+        if service_instance is None or service_instance.params["kind"] != history.HISTORY:
+            return None
+        return self._history_lines(service_instance, history.HistoryQuery.from_dict(query), nodes, paths)
+
+    def _history_lines(self, service_instance: OpcuaServiceInstance, query: history.HistoryQuery,
+                       nodes: list=None, paths: list=None):
+        allowed = service_instance.params.get("nodes")
+        if not nodes and not paths:
+            nodes = allowed
+        if not nodes and not paths:
+            raise ValueError("nodes or paths are required")
+        with self.session_pool.session(service_instance.params["url"],
+                                       service_instance.params.get("security")) as client:
+            node_ids = data_access.resolve(client, nodes, paths)
+            if allowed:
+                offered = set(node_management.to_node_id(node) for node in allowed)
+                refused = [node_id.to_string() for node_id in node_ids if node_id not in offered]
+                if refused:
+                    raise ValueError("nodes {0} are not offered by the instance".format(", ".join(refused[:10])))
+            for line in history.ndjson_pages(client, node_ids, query):
+                yield line
+
+    def rebalance(self, owns_instance) -> list:
+        """
+        Called when the replicas of a broker cluster change. Reloads the
+        registries from the shared state store, which other replicas wrote
+        to while they owned the instances now owned here, and unsubscribes
+        the bindings of instances owned elsewhere now; their apps reconnect
+        through the service and subscribe again on the new owner, where
+        their spools start over.
+        """
+        self.service_instances.restore(reset=True)
+        self.service_bindings.restore(reset=True)
+        moved = released_bindings(self.subscriptions.binding_ids(), self.service_bindings, owns_instance)
+        for binding_id in moved:
+            self.subscriptions.unsubscribe(binding_id, discard=True)
+        return moved
+
+    def binding_buffer(self, binding_id: str) -> RingBuffer:
+        buffer = self.subscriptions.buffer(binding_id)
+        if buffer is not None:
+            return buffer
+        service_binding = self.service_bindings.get(binding_id)
+        if service_binding is None:
+            return None
+        # subscriptions live in the server session only, so a binding restored
+        # from the state store subscribes again once its app reconnects
+        service_instance = self.service_instances.get(service_binding.instance_id)
+        if service_instance is None or service_instance.params.get("kind") not in (DATA_CHANGE, EVENTS):
+            return None
+        with self._subscription_lock:
+            buffer = self.subscriptions.buffer(binding_id)
+            if buffer is None:
+                buffer = self._subscribe(service_instance, service_binding)
+        return buffer
+
+    def resume_spools(self) -> list:
+        """
+        Subscribe the bindings with a spool which are not subscribed, after
+        a restart or a lost connection, rather than once their apps
+        reconnect: their subscriptions are taken over and what the servers
+        published meanwhile is spooled, before the subscriptions expire on
+        the servers. Spools of bindings which are gone are deleted.
+
+        Subscriptions taken over hand the notifications they held to their
+        bindings only once all of these are subscribed again.
+        """
+        resumed = []
+        if self.spool_directory is None:
+            return resumed
+        for binding_id in self.spool_directory.binding_ids():
+            if self.service_bindings.get(binding_id) is None:
+                self.spool_directory.discard(binding_id)
+                continue
+            try:
+                if self.binding_buffer(binding_id) is not None:
+                    resumed.append(binding_id)
+            except Exception as e:
+                logger.info("Failed to resume the spool of binding %s: %s", binding_id, e)
+        self.subscriptions.finish_resumes()
+        return resumed
+
+    def watch_spools(self, interval: float=5):
+        """
+        Resume the spools of bindings every interval seconds, dropping the
+        subscriptions which lost their connection first, until the spool
+        directory is closed.
+        """
+        while not self.spool_directory.closed:
+            self.subscriptions.drop_broken()
+            self.resume_spools()
+            time.sleep(interval)
+
+    def close(self):
+        self.discovery_cache.close()
+        self.subscriptions.close()
+        if self.spool_directory is not None:
+            self.spool_directory.close()
@@ -0,0 +1,183 @@
+import datetime
+import json
+import logging
+
+from dateutil import parser as date_parser
+
+from opcua import ua
+
+from . import metrics
+from . import node_management
+from .subscription import to_json_value
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY = "history"
+
+
+def parse_time(value) -> datetime.datetime:
+    # ISO 8601 times, naive in UTC as python-opcua encodes them
+    if value is None:
+        return None
+    try:
+        parsed = date_parser.parse(value) if isinstance(value, str) else None
+    except (ValueError, OverflowError):
+        parsed = None
+    if parsed is None:
+        raise ValueError("invalid time {0!r}".format(value))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def to_aggregate(value) -> ua.NodeId:
+    # "Average", "Minimum", ... or the node id of an aggregate function
+    if isinstance(value, str) and value.isidentifier():
+        identifier = getattr(ua.ObjectIds, "AggregateFunction_" + value, None)
+        if isinstance(identifier, int):
+            return ua.NodeId(identifier)
+    try:
+        return node_management.to_node_id(value)
+    except ValueError:
+        raise ValueError("invalid aggregate {0!r}".format(value))
+
+
+class HistoryQuery(object):
+    """
+    What a history request asks for: the raw values of nodes between start
+    and end, at most page_size of them per node and response, or with
+    aggregate the values of that aggregate function over every
+    processing_interval milliseconds.
+    """
+
+    def __init__(self, start: datetime.datetime, end: datetime.datetime=None, page_size: int=1000,
+                 return_bounds: bool=False, aggregate: ua.NodeId=None, processing_interval: float=None,
+                 **kwargs):
+        self.start = start
+        self.end = end or datetime.datetime.utcnow()
+        self.page_size = page_size
+        self.return_bounds = return_bounds
+        self.aggregate = aggregate
+        self.processing_interval = processing_interval
+
+    @classmethod
+    def from_dict(cls, body: dict):
+        """
+        The query of a request body with start, end (ISO 8601, now by
+        default), pageSize and returnBounds, or aggregate and
+        processingInterval for processed values, raising ValueError for bad
+        ones.
+        """
+        start = parse_time(body.get("start"))
+        if start is None:
+            raise ValueError("start is required")
+        end = parse_time(body.get("end"))
+        if end is not None and end < start:
+            raise ValueError("end is before start")
+        page_size = body.get("pageSize", 1000)
+        if not isinstance(page_size, int) or isinstance(page_size, bool) or page_size <= 0:
+            raise ValueError("invalid pageSize {0!r}".format(page_size))
+        aggregate = body.get("aggregate")
+        if aggregate is None:
+            return cls(start, end, page_size, bool(body.get("returnBounds", False)))
+        processing_interval = body.get("processingInterval")
+        if not isinstance(processing_interval, (int, float)) or isinstance(processing_interval, bool) or \
+                processing_interval <= 0:
+            raise ValueError("a positive processingInterval is required with an aggregate")
+        return cls(start, end, page_size, aggregate=to_aggregate(aggregate),
+                   processing_interval=float(processing_interval))
+
+    @property
+    def processed(self) -> bool:
+        return self.aggregate is not None
+
+    def details(self, count: int):
+        # processed reads name the aggregate once per node read
+        if self.processed:
+            details = ua.ReadProcessedDetails()
+            details.StartTime = self.start
+            details.EndTime = self.end
+            details.ProcessingInterval = self.processing_interval
+            details.AggregateType = [self.aggregate] * count
+            return details
+        details = ua.ReadRawModifiedDetails()
+        details.IsReadModified = False
+        details.StartTime = self.start
+        details.EndTime = self.end
+        details.NumValuesPerNode = self.page_size
+        details.ReturnBounds = self.return_bounds
+        return details
+
+
+def history_read(client, details, nodes: list, release: bool=False) -> list:
+    # nodes are (NodeId, continuation point) pairs
+    params = ua.HistoryReadParameters()
+    params.HistoryReadDetails = details
+    params.TimestampsToReturn = ua.TimestampsToReturn.Both
+    params.ReleaseContinuationPoints = release
+    for node_id, continuation_point in nodes:
+        read_value_id = ua.HistoryReadValueId()
+        read_value_id.NodeId = node_id
+        read_value_id.ContinuationPoint = continuation_point
+        params.NodesToRead.append(read_value_id)
+    with metrics.opcua_request(client, "HistoryRead"):
+        return client.uaclient.history_read(params)
+
+
+def read_pages(client, node_ids: list, query: HistoryQuery, max_nodes: int=100):
+    """
+    Read the history of node_ids, yielding (NodeId, HistoryReadResult) for
+    every page the server answers with, and following continuation points
+    until each node is done. Nodes are read max_nodes at a time, or fewer if
+    the server's MaxNodesPerHistoryReadData says so, so only one page of
+    that many nodes is held at once however long the time range is. If the
+    reader stops early the server is told to release the continuation
+    points still open.
+    """
+    limit = node_management.get_operation_limits(client).get("MaxNodesPerHistoryReadData")
+    if limit and (not max_nodes or limit < max_nodes):
+        max_nodes = limit
+    for chunk in node_management.chunked(node_ids, max_nodes):
+        pending = [(node_id, None) for node_id in chunk]
+        # the continuation points the server holds for the reader
+        continued = []
+        try:
+            while pending:
+                results = history_read(client, query.details(len(pending)), pending)
+                continued = [(node_id, result.ContinuationPoint) for (node_id, _), result in zip(pending, results)
+                             if result.StatusCode.is_good() and result.ContinuationPoint]
+                for (node_id, _), result in zip(pending, results):
+                    yield node_id, result
+                pending, continued = continued, []
+        finally:
+            if continued:
+                try:
+                    history_read(client, query.details(len(continued)), continued, release=True)
+                except Exception as e:
+                    logger.info("Failed to release %d continuation points: %s", len(continued), e)
+
+
+def to_columns(node_id: ua.NodeId, result) -> dict:
+    """
+    A page of history as columnar JSON: the value, timestamps and status
+    code columns of the node, or its status code alone if it failed.
+    """
+    if not result.StatusCode.is_good():
+        return dict(nodeId=node_id.to_string(), error=result.StatusCode.name)
+    data_values = getattr(result.HistoryData, "DataValues", None) or []
+    return dict(nodeId=node_id.to_string(),
+                value=[to_json_value(data_value.Value.Value if data_value.Value is not None else None)
+                       for data_value in data_values],
+                sourceTimestamp=[to_json_value(data_value.SourceTimestamp) for data_value in data_values],
+                serverTimestamp=[to_json_value(data_value.ServerTimestamp) for data_value in data_values],
+                statusCode=[data_value.StatusCode.name for data_value in data_values],
+                more=bool(result.ContinuationPoint))
+
+
+def ndjson_pages(client, node_ids: list, query: HistoryQuery, max_nodes: int=100):
+    """
+    The pages of read_pages as lines of newline delimited JSON.
+    """
+    for node_id, result in read_pages(client, node_ids, query, max_nodes):
+        yield json.dumps(to_columns(node_id, result), separators=(",", ":")) + "\n"
@@ -0,0 +1,285 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class CounterChild(object):
+    def __init__(self, **kwargs):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> list:
+        return [("", (), self.value)]
+
+
+class HistogramChild(object):
+    def __init__(self, buckets: tuple, **kwargs):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> list:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            samples.append(("_bucket", (("le", format_value(bound)),), cumulative))
+        samples.append(("_sum", (), total))
+        samples.append(("_count", (), cumulative))
+        return samples
+
+
+class Metric(object):
+    """
+    A metric family, with one child per combination of label values. Hot
+    paths look the child up once with labels() and keep it.
+    """
+
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple=(), registry=None, **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = dict()
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._child()
+        return child
+
+    def _child(self):
+        raise NotImplementedError()
+
+    def collect(self) -> list:
+        with self._lock:
+            children = list(self._children.items())
+        return [(self.name + suffix, tuple(zip(self.labelnames, values)) + extra, value)
+                for values, child in children for suffix, extra, value in child.samples()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _child(self):
+        return CounterChild()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple=(), buckets: tuple=DEFAULT_BUCKETS,
+                 **kwargs):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, **kwargs)
+
+    def _child(self):
+        return HistogramChild(self.buckets)
+
+
+class MetricsRegistry(object):
+    """
+    Metrics rendered in the Prometheus text format by /metrics.
+
+    Counters and histograms are updated where things happen. Gauges of
+    state kept elsewhere, like session pool sizes or buffer depths, come from
+    collectors, functions called at scrape time that return a list of
+    (name, kind, documentation, [(labels dict, value)]).
+    """
+
+    def __init__(self, **kwargs):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def register_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+            for name, labels, value in metric.collect():
+                lines.append(format_sample(name, labels, value))
+        for collector in collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append("# HELP {0} {1}".format(name, documentation))
+                lines.append("# TYPE {0} {1}".format(name, kind))
+                for labels, value in samples:
+                    lines.append(format_sample(name, tuple(labels.items()), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_sample(name: str, labels: tuple, value: float) -> str:
+    if not labels:
+        return "{0} {1}".format(name, format_value(value))
+    return "{0}{{{1}}} {2}".format(name, ",".join('{0}="{1}"'.format(label, escape(label_value))
+                                                  for label, label_value in labels), format_value(value))
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+@functools.lru_cache(maxsize=1024)
+def endpoint_label(url: str) -> str:
+    # endpoint urls may carry credentials, which must not end up in metrics
+    location = urlparse(url)
+    if location.hostname is None:
+        return url
+    netloc = location.hostname if location.port is None else "{0}:{1}".format(location.hostname, location.port)
+    return "{0}://{1}{2}".format(location.scheme, netloc, location.path)
+
+
+def client_endpoint(client) -> str:
+    server_url = getattr(client, "server_url", None)
+    return endpoint_label(server_url.geturl()) if server_url is not None else ""
+
+
+@contextmanager
+def opcua_request(client, service: str):
+    """
+    Time an OPC UA service call of client, for the request histogram of its
+    endpoint. Works around awaits too.
+    """
+    endpoint = client_endpoint(client)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        OPCUA_REQUEST_ERRORS.labels(endpoint, service).inc()
+        raise
+    finally:
+        OPCUA_REQUEST_SECONDS.labels(endpoint, service).observe(time.perf_counter() - start)
+
+
+def osb_request(operation: str):
+    """
+    Decorator timing a ServiceBroker method, plain or coroutine, by the plan
+    of the details it is called with.
+    """
+    def plan_of(args: tuple) -> str:
+        for arg in args:
+            plan_id = getattr(arg, "plan_id", None)
+            if plan_id is not None:
+                return plan_id
+        return ""
+
+    def observe(plan_id: str, start: float, result=None, failed: bool=False):
+        OSB_REQUEST_SECONDS.labels(operation, plan_id).observe(time.perf_counter() - start)
+        if failed or getattr(result, "state", None) == "failed":
+            OSB_REQUEST_ERRORS.labels(operation, plan_id).inc()
+
+    def decorate(method):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def timed(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await method(self, *args, **kwargs)
+                except Exception:
+                    observe(plan_of(args), start, failed=True)
+                    raise
+                observe(plan_of(args), start, result)
+                return result
+        else:
+            @functools.wraps(method)
+            def timed(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = method(self, *args, **kwargs)
+                except Exception:
+                    observe(plan_of(args), start, failed=True)
+                    raise
+                observe(plan_of(args), start, result)
+                return result
+        return timed
+
+    return decorate
+
+
+REGISTRY = MetricsRegistry()
+
+OSB_REQUEST_SECONDS = Histogram("opcua_broker_osb_request_seconds",
+                                "Latency of Open Service Broker requests by operation and plan",
+                                ("operation", "plan"))
+OSB_REQUEST_ERRORS = Counter("opcua_broker_osb_request_errors_total",
+                             "Open Service Broker requests which failed, by operation and plan",
+                             ("operation", "plan"))
+OPERATION_SECONDS = Histogram("opcua_broker_operation_seconds",
+                              "Duration of asynchronous operations by kind, plan and final state",
+                              ("kind", "plan", "state"))
+OPCUA_REQUEST_SECONDS = Histogram("opcua_broker_opcua_request_seconds",
+                                  "Latency of OPC UA connects, session activations and service calls by endpoint",
+                                  ("endpoint", "service"))
+OPCUA_REQUEST_ERRORS = Counter("opcua_broker_opcua_request_errors_total",
+                               "OPC UA connects, session activations and service calls which failed, by endpoint",
+                               ("endpoint", "service"))
+SESSION_WAIT_SECONDS = Histogram("opcua_broker_session_wait_seconds",
+                                 "Time spent waiting for a free pooled session by endpoint",
+                                 ("endpoint",))
+NOTIFICATIONS = Counter("opcua_broker_notifications_total",
+                        "Notifications received from OPC UA subscriptions by endpoint and kind",
+                        ("endpoint", "kind"))
+NOTIFICATIONS_DELIVERED = Counter("opcua_broker_notifications_delivered_total",
+                                  "Notification records appended to binding buffers by endpoint and kind",
+                                  ("endpoint", "kind"))
+NOTIFICATIONS_DROPPED = Counter("opcua_broker_notifications_dropped_total",
+                                "Notifications overwritten in binding buffers before a stream read them",
+                                ("endpoint", "kind"))
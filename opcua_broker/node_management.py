@@ -0,0 +1,705 @@
+import datetime
+import functools
+
+from opcua import ua
+from opcua.ua.ua_binary import struct_from_binary
+
+from . import metrics
+from .validation import InvalidParameters
+
+
+OBJECT_NODE_CLASS = 1
+VARIABLE_NODE_CLASS = 2
+METHOD_NODE_CLASS = 4
+
+OPERATION_LIMITS = (
+    "MaxNodesPerRead",
+    "MaxNodesPerWrite",
+    "MaxNodesPerBrowse",
+    "MaxNodesPerNodeManagement",
+    "MaxNodesPerTranslateBrowsePathsToNodeIds",
+    "MaxMonitoredItemsPerCall",
+    "MaxNodesPerHistoryReadData",
+)
+
+# Requests to a server reporting no limit (0) for a service still carry at
+# most this many items, as a single request for a large deprovision would
+# outlast the request timeout, and fail again on every retry.
+DEFAULT_MAX_PER_CALL = 500
+
+# The items a bulk request may carry per request timeout; larger requests
+# are given the timeout once for every ITEMS_PER_TIMEOUT items they carry.
+ITEMS_PER_TIMEOUT = 100
+
+
+def to_node_id(value) -> ua.NodeId:
+    if isinstance(value, ua.NodeId):
+        return value
+    if isinstance(value, int):
+        return ua.NodeId(value)
+    if isinstance(value, str):
+        if value.isdigit():
+            return ua.NodeId(int(value))
+        try:
+            return ua.NodeId.from_string(value)
+        except ua.UaError:
+            pass
+    raise ValueError("invalid node id {0!r}".format(value))
+
+
+def chunked(items: list, size: int):
+    if not size or size <= 0:
+        size = DEFAULT_MAX_PER_CALL
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def batch_timeout(timeout: float, items: int) -> float:
+    return timeout * max(1, -(-items // ITEMS_PER_TIMEOUT))
+
+
+def send_request(client, request, response_class, items: int):
+    """
+    Send request on the session of client and return its checked response,
+    waiting batch_timeout rather than the request timeout of the session
+    for the answer to a request carrying items items.
+    """
+    uasocket = client.uaclient._uasocket
+    timeout = batch_timeout(uasocket.timeout, items)
+    data = uasocket._send_request(request, timeout=int(timeout * 1000)).result(timeout)
+    uasocket.check_answer(data, " in response to " + request.__class__.__name__)
+    response = struct_from_binary(response_class, data)
+    response.ResponseHeader.ServiceResult.check()
+    return response
+
+
+def get_operation_limits(client) -> dict:
+    # Operation limits never change for a session, so they are read once in a
+    # single multi-node Read and kept on the client object. A limit of 0 means
+    # the server does not restrict that service.
+    limits = getattr(client, "operation_limits", None)
+    if limits is not None:
+        return limits
+
+    params = ua.ReadParameters()
+    for name in OPERATION_LIMITS:
+        rv = ua.ReadValueId()
+        rv.NodeId = ua.NodeId(getattr(ua.ObjectIds, "Server_ServerCapabilities_OperationLimits_" + name))
+        rv.AttributeId = ua.AttributeIds.Value
+        params.NodesToRead.append(rv)
+
+    limits = dict()
+    try:
+        results = client.uaclient.read(params)
+    except ua.UaStatusCodeError:
+        results = []
+    for name, result in zip(OPERATION_LIMITS, results):
+        if result.StatusCode.is_good() and result.Value is not None and result.Value.Value:
+            limits[name] = int(result.Value.Value)
+        else:
+            limits[name] = 0
+    client.operation_limits = limits
+    return limits
+
+
+def node_class_templates() -> dict:
+    # the item fields and attributes each node class starts from; the NodeIds
+    # are shared by all items built from a template, as they are only ever
+    # serialized
+    templates = dict()
+    for node_class, item_class, reference_type, type_definition, attributes in (
+            (VARIABLE_NODE_CLASS, ua.NodeClass.Variable, ua.ObjectIds.HasComponent, ua.ObjectIds.BaseDataVariableType,
+             ua.VariableAttributes),
+            (METHOD_NODE_CLASS, ua.NodeClass.Method, ua.ObjectIds.HasComponent, None, ua.MethodAttributes),
+            (OBJECT_NODE_CLASS, ua.NodeClass.Object, ua.ObjectIds.HasComponent, ua.ObjectIds.BaseObjectType,
+             ua.ObjectAttributes),
+            # anything else is provisioned as a folder, as it always has been
+            (None, ua.NodeClass.Object, ua.ObjectIds.Organizes, ua.ObjectIds.FolderType, ua.ObjectAttributes)):
+        item = ua.AddNodesItem()
+        item.NodeClass = item_class
+        item.ReferenceTypeId = ua.NodeId(reference_type)
+        if type_definition is not None:
+            item.TypeDefinition = ua.NodeId(type_definition)
+        attrs = attributes()
+        if node_class == VARIABLE_NODE_CLASS:
+            attrs.DataType = ua.NodeId(ua.ObjectIds.BaseDataType)
+            attrs.ValueRank = ua.ValueRank.Scalar
+            attrs.AccessLevel = ua.AccessLevel.CurrentRead.mask
+            attrs.UserAccessLevel = ua.AccessLevel.CurrentRead.mask
+        elif node_class == METHOD_NODE_CLASS:
+            attrs.Executable = True
+            attrs.UserExecutable = True
+        else:
+            attrs.EventNotifier = 0
+        templates[node_class] = (item, attrs)
+    return templates
+
+
+NODE_CLASS_TEMPLATES = node_class_templates()
+
+
+def clone(template):
+    # a shallow copy, several times faster than copy.copy for these structures
+    copied = template.__class__.__new__(template.__class__)
+    copied.__dict__.update(template.__dict__)
+    return copied
+
+
+def cached_node_ids():
+    # node ids repeat a lot across large node specs (parents, reference
+    # types), so each distinct one is parsed once
+    cache = dict()
+
+    def node_id(value) -> ua.NodeId:
+        try:
+            return cache[value]
+        except KeyError:
+            parsed = cache[value] = to_node_id(value)
+            return parsed
+        except TypeError:
+            return to_node_id(value)
+    return node_id
+
+
+@functools.lru_cache(maxsize=1024)
+def to_type_id(value) -> ua.NodeId:
+    # data types, type definitions and reference types may be given by their
+    # standard name, "Double" or "HasProperty", as well as by node id; the
+    # same few repeat over whole trees, and their NodeIds are only serialized
+    if isinstance(value, str) and value.isidentifier():
+        identifier = getattr(ua.ObjectIds, value, None)
+        if isinstance(identifier, int):
+            return ua.NodeId(identifier)
+    return to_node_id(value)
+
+
+def to_datetime(value) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, str):
+        text = value[:-1] if value.endswith("Z") else value
+        for layout in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+            try:
+                return datetime.datetime.strptime(text, layout)
+            except ValueError:
+                pass
+    raise ValueError("invalid date time {0!r}".format(value))
+
+
+# how JSON values become the python values each built-in data type is
+# encoded from
+CONVERSIONS = dict(
+    [(variant_type, int) for variant_type in (ua.VariantType.SByte, ua.VariantType.Byte, ua.VariantType.Int16,
+                                              ua.VariantType.UInt16, ua.VariantType.Int32, ua.VariantType.UInt32,
+                                              ua.VariantType.Int64, ua.VariantType.UInt64)] +
+    [(ua.VariantType.Float, float), (ua.VariantType.Double, float), (ua.VariantType.Boolean, bool),
+     (ua.VariantType.String, str), (ua.VariantType.DateTime, to_datetime),
+     (ua.VariantType.NodeId, to_node_id), (ua.VariantType.LocalizedText, ua.LocalizedText),
+     (ua.VariantType.QualifiedName, ua.QualifiedName.from_string)])
+
+
+def to_argument(argument: dict) -> ua.Argument:
+    if "name" not in argument:
+        raise ValueError("argument name is required")
+    result = ua.Argument()
+    result.Name = str(argument["name"])
+    result.DataType = to_type_id(argument.get("dataType", ua.ObjectIds.BaseDataType))
+    result.ValueRank = int(argument.get("valueRank", ua.ValueRank.Scalar))
+    result.ArrayDimensions = [int(dimension) for dimension in argument.get("arrayDimensions", [])]
+    result.Description = ua.LocalizedText(argument.get("description", ""))
+    return result
+
+
+def to_variant(value, data_type: ua.NodeId) -> ua.Variant:
+    identifier = data_type.Identifier if data_type.NamespaceIndex == 0 else None
+    if identifier == ua.ObjectIds.Argument:
+        if isinstance(value, list):
+            return ua.Variant([to_argument(argument) for argument in value], ua.VariantType.ExtensionObject)
+        return ua.Variant(to_argument(value), ua.VariantType.ExtensionObject)
+    # the node ids of the built-in data types up to LocalizedText are their
+    # variant types
+    if isinstance(identifier, int) and 1 <= identifier <= 21:
+        variant_type = ua.VariantType(identifier)
+        convert = CONVERSIONS.get(variant_type)
+        if convert is not None:
+            value = [convert(item) for item in value] if isinstance(value, list) else convert(value)
+        return ua.Variant(value, variant_type)
+    return ua.Variant(value)
+
+
+def to_access_level(value) -> int:
+    # a mask, or the names of its bits: ["CurrentRead", "CurrentWrite"]
+    if isinstance(value, int):
+        return value
+    mask = 0
+    for name in value:
+        try:
+            mask |= ua.AccessLevel[name].mask
+        except KeyError:
+            raise ValueError("invalid access level {0!r}".format(name))
+    return mask
+
+
+def build_add_nodes_item(node_to_add: dict, node_id=to_node_id) -> ua.AddNodesItem:
+    get = node_to_add.get
+    template, template_attrs = NODE_CLASS_TEMPLATES.get(get("nodeClass"), NODE_CLASS_TEMPLATES[None])
+    add_nodes_item = clone(template)
+
+    parent_node_id = get("parentNodeId")
+    if parent_node_id is not None:
+        add_nodes_item.ParentNodeId = node_id(parent_node_id)
+    requested_new_node_id = get("requestedNewNodeId")
+    if requested_new_node_id is not None:
+        add_nodes_item.RequestedNewNodeId = node_id(requested_new_node_id)
+    reference_type_id = get("referenceTypeId")
+    if reference_type_id is not None:
+        add_nodes_item.ReferenceTypeId = to_type_id(reference_type_id)
+    type_definition = get("typeDefinition")
+    if type_definition is not None:
+        add_nodes_item.TypeDefinition = to_type_id(type_definition)
+    browse_name = str(get("browseName", ""))
+    try:
+        add_nodes_item.BrowseName = ua.QualifiedName.from_string(browse_name)
+    except ua.UaError:
+        raise ValueError("invalid browse name {0!r}".format(browse_name))
+
+    attrs = clone(template_attrs)
+    attrs.DisplayName = ua.LocalizedText(get("displayName", add_nodes_item.BrowseName.Name))
+    attrs.Description = ua.LocalizedText(get("description", attrs.DisplayName.Text))
+    if "writeMask" in node_to_add:
+        attrs.WriteMask = attrs.UserWriteMask = int(get("writeMask"))
+    if add_nodes_item.NodeClass == ua.NodeClass.Variable:
+        build_variable_attributes(node_to_add, attrs)
+    elif add_nodes_item.NodeClass == ua.NodeClass.Object and "eventNotifier" in node_to_add:
+        attrs.EventNotifier = int(get("eventNotifier"))
+    add_nodes_item.NodeAttributes = attrs
+    return add_nodes_item
+
+
+def build_variable_attributes(node_to_add: dict, attrs: ua.VariableAttributes):
+    get = node_to_add.get
+    if "dataType" in node_to_add:
+        attrs.DataType = to_type_id(get("dataType"))
+    value = get("value")
+    if "valueRank" in node_to_add:
+        attrs.ValueRank = int(get("valueRank"))
+    elif isinstance(value, list):
+        attrs.ValueRank = ua.ValueRank.OneDimension
+    if "arrayDimensions" in node_to_add:
+        attrs.ArrayDimensions = [int(dimension) for dimension in get("arrayDimensions")]
+    elif isinstance(value, list):
+        attrs.ArrayDimensions = [len(value)]
+    if value is not None:
+        attrs.Value = to_variant(value, attrs.DataType)
+        if "dataType" not in node_to_add:
+            # as add_variable does, the data type follows from the value
+            attrs.DataType = ua.NodeId(attrs.Value.VariantType.value)
+    if "accessLevel" in node_to_add:
+        attrs.AccessLevel = attrs.UserAccessLevel = to_access_level(get("accessLevel"))
+    if "userAccessLevel" in node_to_add:
+        attrs.UserAccessLevel = to_access_level(get("userAccessLevel"))
+    if "minimumSamplingInterval" in node_to_add:
+        attrs.MinimumSamplingInterval = float(get("minimumSamplingInterval"))
+    if "historizing" in node_to_add:
+        attrs.Historizing = bool(get("historizing"))
+
+
+def is_template(value) -> bool:
+    if isinstance(value, str):
+        return "{" in value
+    if isinstance(value, list):
+        return any(is_template(item) for item in value)
+    if isinstance(value, dict):
+        return any(is_template(item) for item in value.values())
+    return False
+
+
+def expand(value, names: dict):
+    # fill in the indices of the enclosing repeats, "Machine{i}"
+    if isinstance(value, str):
+        if "{" not in value:
+            return value
+        try:
+            return value.format(**names)
+        except KeyError as e:
+            raise ValueError("{0!r} names no enclosing repeat index".format(e.args[0]))
+    if isinstance(value, list):
+        return [expand(item, names) for item in value]
+    if isinstance(value, dict):
+        return dict((key, expand(item, names)) for key, item in value.items())
+    return value
+
+
+def method_arguments(node_to_add: dict) -> list:
+    # the InputArguments and OutputArguments properties of a method, added
+    # below it like any other child
+    children = []
+    for key, browse_name in (("inputArguments", "0:InputArguments"), ("outputArguments", "0:OutputArguments")):
+        arguments = node_to_add.get(key)
+        if arguments:
+            for i, argument in enumerate(arguments):
+                try:
+                    to_argument(argument)
+                except (AttributeError, TypeError, ValueError) as e:
+                    raise ValueError("{0}[{1}]: {2}".format(key, i, e))
+            children.append(dict(browseName=browse_name, nodeClass=VARIABLE_NODE_CLASS,
+                                 referenceTypeId=ua.ObjectIds.HasProperty, typeDefinition=ua.ObjectIds.PropertyType,
+                                 dataType=ua.ObjectIds.Argument, valueRank=ua.ValueRank.OneDimension,
+                                 arrayDimensions=[len(arguments)], value=arguments))
+    return children
+
+
+class NodeTree(object):
+    """
+    The nodes of nodesToAdd ordered into the levels of the tree they form,
+    so that each level can be added in one wave of AddNodes requests once
+    the level above it is in place, whatever the order of the specs.
+
+    A node spec is the parent of another when it is nested in its children,
+    or when its requestedNewNodeId is the other's parentNodeId. A spec with
+    repeat: n (or {"count": n, "from": 0, "index": "i"}) stands for n nodes
+    and their children, with "{i}" in their strings replaced by the index.
+    Methods get their inputArguments and outputArguments as properties.
+
+    items holds an AddNodesItem per node, names its browse name and parents
+    the index of its parent node, if that is added as well. Expanding to
+    more than max_nodes nodes is refused.
+    """
+
+    def __init__(self, nodes_to_add: list, name: str="nodesToAdd", max_nodes: int=1000000, **kwargs):
+        self.items = []
+        self.names = []
+        self.parents = []
+        self.levels = []
+        self.max_nodes = max_nodes
+        self._name = name
+        self._paths = []
+        self._node_id = cached_node_ids()
+        errors = []
+        self._add(nodes_to_add, name, None, dict(), errors)
+        if not errors:
+            self._order(errors)
+        if errors:
+            raise InvalidParameters(errors)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _add(self, nodes_to_add: list, path: str, parent: int, names: dict, errors: list):
+        if not isinstance(nodes_to_add, list):
+            errors.append("{0}: expected array".format(path))
+            return
+        for i, node_to_add in enumerate(nodes_to_add):
+            node_path = "{0}[{1}]".format(path, i)
+            if not isinstance(node_to_add, dict):
+                errors.append("{0}: expected object".format(node_path))
+                continue
+            try:
+                spec = dict((key, value) for key, value in node_to_add.items() if key not in ("repeat", "children"))
+                templated = []
+                if names or "repeat" in node_to_add:
+                    # only the fields with placeholders are copied for every index
+                    templated = [key for key, value in spec.items() if is_template(value)]
+                for index_names in self._repeats(node_to_add.get("repeat"), names):
+                    node_spec = dict(spec)
+                    for key in templated:
+                        node_spec[key] = expand(spec[key], index_names)
+                    self._add_node(node_spec, node_path, parent, index_names, errors,
+                                   node_to_add.get("children") or [])
+            except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+                errors.append("{0}: {1}".format(node_path, e))
+
+    @staticmethod
+    def _repeats(repeat, names: dict) -> list:
+        if repeat is None:
+            return [names]
+        if isinstance(repeat, dict):
+            count, start, index = repeat["count"], repeat.get("from", 0), repeat.get("index", "i")
+        else:
+            count, start, index = repeat, 0, "i"
+        if not isinstance(count, int) or not isinstance(start, int) or count < 0:
+            raise ValueError("invalid repeat {0!r}".format(repeat))
+        return [dict(names, **{index: i}) for i in range(start, start + count)]
+
+    def _add_node(self, node_to_add: dict, path: str, parent: int, names: dict, errors: list, children: list):
+        if len(self.items) >= self.max_nodes:
+            raise InvalidParameters(["{0}: expands to more than {1} nodes".format(self._name, self.max_nodes)])
+        if names:
+            path = "{0}({1})".format(path, ",".join("{0}={1}".format(*name) for name in sorted(names.items())))
+        try:
+            item = build_add_nodes_item(node_to_add, self._node_id)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            errors.append("{0}: {1}".format(path, e))
+            return
+        if "parentNodeId" in node_to_add:
+            parent = None
+        elif parent is not None:
+            # replaced by the id the server gave the parent before the wave
+            item.ParentNodeId = self.items[parent].RequestedNewNodeId
+        self.items.append(item)
+        self.names.append(node_to_add.get("browseName"))
+        self.parents.append(parent)
+        self._paths.append(path)
+        own = len(self.items) - 1
+        if node_to_add.get("nodeClass") == METHOD_NODE_CLASS:
+            try:
+                children = list(children) + method_arguments(node_to_add)
+            except (AttributeError, TypeError, ValueError) as e:
+                errors.append("{0}: {1}".format(path, e))
+        self._add(children, path + ".children", own, names, errors)
+
+    def _order(self, errors: list):
+        requested = dict()
+        for index, item in enumerate(self.items):
+            if item.RequestedNewNodeId.is_null():
+                continue
+            key = item.RequestedNewNodeId.to_string()
+            if key in requested:
+                errors.append("{0}: requestedNewNodeId {1} is requested by {2} as well".format(
+                    self._paths[index], key, self._paths[requested[key]]))
+            requested[key] = index
+        for index, item in enumerate(self.items):
+            if self.parents[index] is None and not item.ParentNodeId.is_null():
+                self.parents[index] = requested.get(item.ParentNodeId.to_string())
+
+        depths = [None] * len(self.items)
+        for index in range(len(self.items)):
+            chain = []
+            node = index
+            while node is not None and depths[node] is None:
+                if node in chain:
+                    errors.append("{0}: is its own ancestor".format(self._paths[node]))
+                    return
+                chain.append(node)
+                node = self.parents[node]
+            depth = -1 if node is None else depths[node]
+            for node in reversed(chain):
+                depth += 1
+                depths[node] = depth
+        self.levels = [[] for _ in range(max(depths) + 1)] if depths else []
+        for index, depth in enumerate(depths):
+            self.levels[depth].append(index)
+
+    def wave(self, level: int, added: dict) -> tuple:
+        """
+        The nodes of level that can be sent now, with the ids their parents
+        were added with (added maps index to NodeId) filled in, and those
+        that cannot as their parent was not added.
+        """
+        send = []
+        orphans = []
+        for index in self.levels[level]:
+            parent = self.parents[index]
+            if parent is None:
+                send.append(index)
+            elif parent in added:
+                self.items[index].ParentNodeId = added[parent]
+                send.append(index)
+            else:
+                orphans.append(index)
+        return send, orphans
+
+
+def orphan_result() -> ua.AddNodesResult:
+    result = ua.AddNodesResult()
+    result.StatusCode = ua.StatusCode(ua.StatusCodes.BadParentNodeIdInvalid)
+    return result
+
+
+def add_nodes(client, add_nodes_items: list, max_per_call: int=None) -> list:
+    """
+    Send add_nodes_items as chunked multi-item AddNodes requests and return
+    one AddNodesResult per item, in input order. The chunks are pipelined:
+    all of them go out on the session before the first answer is awaited,
+    so a large wave costs about one round trip. When a chunk fails the
+    results are on the exception as e.results, with None for the items of
+    the chunks that failed, for rolling back the others.
+    """
+    if max_per_call is None:
+        max_per_call = get_operation_limits(client).get("MaxNodesPerNodeManagement")
+    uasocket = client.uaclient._uasocket
+    error = None
+    results = []
+    with metrics.opcua_request(client, "AddNodes"):
+        sent = []
+        for chunk in chunked(add_nodes_items, max_per_call):
+            request = ua.AddNodesRequest()
+            request.Parameters.NodesToAdd = chunk
+            timeout = batch_timeout(uasocket.timeout, len(chunk))
+            try:
+                sent.append((chunk, timeout, uasocket._send_request(request, timeout=int(timeout * 1000))))
+            except Exception as e:
+                error = e
+                break
+        for chunk, timeout, future in sent:
+            try:
+                data = future.result(timeout)
+                uasocket.check_answer(data, " in response to AddNodesRequest")
+                response = struct_from_binary(ua.AddNodesResponse, data)
+                response.ResponseHeader.ServiceResult.check()
+                results.extend(response.Results)
+            except Exception as e:
+                error = error or e
+                results.extend([None] * len(chunk))
+        if error is not None:
+            error.results = results
+            raise error
+    return results
+
+
+def add_node_tree(client, tree: NodeTree, max_per_call: int=None):
+    """
+    Add the nodes of tree level by level, one pipelined wave of AddNodes
+    requests per level, yielding (index, AddNodesResult) for every node as
+    soon as its wave is answered. Nodes whose parent failed are not sent
+    and fail with BadParentNodeIdInvalid.
+    """
+    added = dict()
+    for level in range(len(tree.levels)):
+        send, orphans = tree.wave(level, added)
+        for index in orphans:
+            yield index, orphan_result()
+        error = None
+        try:
+            results = add_nodes(client, [tree.items[index] for index in send], max_per_call) if send else []
+        except Exception as e:
+            error = e
+            results = getattr(e, "results", [])
+        for index, result in zip(send, results):
+            if result is None:
+                continue
+            if result.StatusCode.is_good():
+                added[index] = result.AddedNodeId
+            yield index, result
+        if error is not None:
+            raise error
+
+
+def delete_nodes(client, node_ids: list, max_per_call: int=None,
+                 delete_target_references: bool=True) -> list:
+    """
+    Send node_ids as chunked multi-item DeleteNodes requests and return one
+    StatusCode per node id, in input order.
+    """
+    if max_per_call is None:
+        max_per_call = get_operation_limits(client).get("MaxNodesPerNodeManagement")
+    results = []
+    for chunk in chunked(node_ids, max_per_call):
+        request = ua.DeleteNodesRequest()
+        for node_id in chunk:
+            item = ua.DeleteNodesItem()
+            item.NodeId = node_id
+            item.DeleteTargetReferences = delete_target_references
+            request.Parameters.NodesToDelete.append(item)
+        with metrics.opcua_request(client, "DeleteNodes"):
+            results.extend(send_request(client, request, ua.DeleteNodesResponse, len(chunk)).Results)
+    return results
+
+
+def read(client, node_ids: list, attribute_id: int=ua.AttributeIds.Value, max_per_call: int=None) -> list:
+    """
+    Read one attribute of node_ids with chunked multi-node Read requests and
+    return one DataValue per node id, in input order.
+    """
+    if max_per_call is None:
+        max_per_call = get_operation_limits(client).get("MaxNodesPerRead")
+    results = []
+    for chunk in chunked(node_ids, max_per_call):
+        params = ua.ReadParameters()
+        for node_id in chunk:
+            rv = ua.ReadValueId()
+            rv.NodeId = node_id
+            rv.AttributeId = attribute_id
+            params.NodesToRead.append(rv)
+        with metrics.opcua_request(client, "Read"):
+            results.extend(client.uaclient.read(params))
+    return results
+
+
+def is_deleted(status: ua.StatusCode) -> bool:
+    return status.is_good() or status.value == ua.StatusCodes.BadNodeIdUnknown
+
+
+def build_add_references_item(reference_to_add: dict, node_id=to_node_id) -> ua.AddReferencesItem:
+    add_references_item = ua.AddReferencesItem()
+    add_references_item.SourceNodeId = node_id(reference_to_add["sourceNodeId"])
+    add_references_item.ReferenceTypeId = node_id(reference_to_add.get("referenceTypeId", ua.ObjectIds.Organizes))
+    add_references_item.IsForward = bool(reference_to_add.get("isForward", True))
+    add_references_item.TargetNodeId = node_id(reference_to_add["targetNodeId"])
+    add_references_item.TargetNodeClass = ua.NodeClass(reference_to_add.get("targetNodeClass", 0))
+    return add_references_item
+
+
+def build_add_references_items(references_to_add: list, name: str="referencesToAdd") -> list:
+    """
+    build_add_references_item for all of references_to_add, reporting every
+    bad one at once like NodeTree.
+    """
+    node_id = cached_node_ids()
+    add_references_items = []
+    errors = []
+    for i, reference_to_add in enumerate(references_to_add):
+        try:
+            add_references_items.append(build_add_references_item(reference_to_add, node_id))
+        except KeyError as e:
+            errors.append("{0}[{1}]: {2} is required".format(name, i, e))
+        except (AttributeError, TypeError, ValueError) as e:
+            errors.append("{0}[{1}]: {2}".format(name, i, e))
+    if errors:
+        raise InvalidParameters(errors)
+    return add_references_items
+
+
+def reference_key(item) -> tuple:
+    # identifies a reference across AddReferencesItem, DeleteReferencesItem
+    # and what Browse returns for its source node
+    return (item.SourceNodeId.to_string(), item.ReferenceTypeId.to_string(), item.IsForward,
+            item.TargetNodeId.to_string())
+
+
+def add_references(client, add_references_items: list, max_per_call: int=None) -> list:
+    """
+    Send add_references_items as chunked multi-item AddReferences requests
+    and return one StatusCode per item, in input order.
+    """
+    if max_per_call is None:
+        max_per_call = get_operation_limits(client).get("MaxNodesPerNodeManagement")
+    results = []
+    for chunk in chunked(add_references_items, max_per_call):
+        request = ua.AddReferencesRequest()
+        request.Parameters.ReferencesToAdd = chunk
+        with metrics.opcua_request(client, "AddReferences"):
+            results.extend(send_request(client, request, ua.AddReferencesResponse, len(chunk)).Results)
+    return results
+
+
+def delete_references(client, references: list, max_per_call: int=None, delete_bidirectional: bool=True) -> list:
+    """
+    Delete references, given as reference_key tuples, with chunked multi-item
+    DeleteReferences requests and return one StatusCode per reference, in
+    input order.
+    """
+    if max_per_call is None:
+        max_per_call = get_operation_limits(client).get("MaxNodesPerNodeManagement")
+    results = []
+    for chunk in chunked(references, max_per_call):
+        request = ua.DeleteReferencesRequest()
+        for source, reference_type, is_forward, target in chunk:
+            item = ua.DeleteReferencesItem()
+            item.SourceNodeId = ua.NodeId.from_string(source)
+            item.ReferenceTypeId = ua.NodeId.from_string(reference_type)
+            item.IsForward = is_forward
+            item.TargetNodeId = ua.NodeId.from_string(target)
+            item.DeleteBidirectional = delete_bidirectional
+            request.Parameters.ReferencesToDelete.append(item)
+        with metrics.opcua_request(client, "DeleteReferences"):
+            response = send_request(client, request, ua.DeleteReferencesResponse, len(chunk))
+            results.extend(response.Parameters.Results)
+    return results
+
+
+def is_reference_deleted(status: ua.StatusCode) -> bool:
+    # a reference whose source or target node is gone is gone as well
+    return status.is_good() or status.value in (ua.StatusCodes.BadNotFound,
+                                                ua.StatusCodes.BadSourceNodeIdInvalid,
+                                                ua.StatusCodes.BadTargetNodeIdInvalid)
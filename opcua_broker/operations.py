@@ -0,0 +1,219 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from openbrokerapi.service_broker import (
+    LastOperation,
+    OperationState
+)
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Operation(object):
+    def __init__(self,
+                 operation_id: str,
+                 instance_id: str,
+                 kind: str,
+                 plan_id: str=None,
+                 **kwargs):
+        self.id = operation_id
+        self.instance_id = instance_id
+        self.kind = kind
+        self.plan_id = plan_id
+        self.state = OperationState.IN_PROGRESS
+        self.description = "{0} in progress".format(kind)
+        self.created = time.time()
+        self.finished = None
+        self.replica = None
+
+    def to_last_operation(self) -> LastOperation:
+        return LastOperation(self.state, self.description)
+
+    def to_record(self) -> dict:
+        return dict(id=self.id, instance_id=self.instance_id, kind=self.kind, plan_id=self.plan_id,
+                    state=self.state.value, description=self.description, created=self.created,
+                    finished=self.finished, replica=self.replica)
+
+    @classmethod
+    def from_record(cls, record: dict):
+        operation = cls(record["id"], record["instance_id"], record["kind"], record.get("plan_id"))
+        operation.state = OperationState(record["state"])
+        operation.description = record["description"]
+        operation.created = record["created"]
+        operation.finished = record.get("finished")
+        operation.replica = record.get("replica")
+        return operation
+
+
+class OperationTable(object):
+    """
+    Runs long OPC UA operations on a bounded pool of worker threads and keeps
+    their state for last_operation polling.
+
+    At most max_workers operations run at once and at most max_pending are
+    queued behind them; submit blocks for up to submit_timeout seconds when
+    the queue is full. Finished operations are kept for retention seconds.
+
+    With a state store, operations are also written to it as they start and
+    finish, so that a replica of a cluster answers the polls of operations
+    another replica runs, such as after a rebalance moved the instance. An
+    operation left in progress by this replica before a restart, or by one
+    which is no longer among members(), is reported as failed.
+    """
+
+    KIND = "operation"
+
+    def __init__(self,
+                 max_workers: int=8,
+                 max_pending: int=256,
+                 submit_timeout: float=5,
+                 retention: float=3600,
+                 state_store=None,
+                 replica: str=None,
+                 members=None,
+                 sweep_interval: float=60,
+                 **kwargs):
+        self.retention = retention
+        self.submit_timeout = submit_timeout
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.state_store = state_store
+        self.replica = replica
+        self.members = members
+        self.sweep_interval = sweep_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._operations = dict()
+        self._lock = threading.Lock()
+        self._swept = 0
+
+    def submit(self, instance_id: str, kind: str, fn, plan_id: str=None) -> Operation:
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            raise RuntimeError("too many pending operations, {0} of instance {1} rejected".format(kind, instance_id))
+
+        try:
+            operation = self.start(instance_id, kind, plan_id)
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            self._executor.submit(self._run, operation, fn)
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self._operations.pop(operation.id, None)
+            raise
+        return operation
+
+    def start(self, instance_id: str, kind: str, plan_id: str=None) -> Operation:
+        """
+        Register an operation run by the caller rather than by the worker
+        threads, such as a coroutine on the event loop of the asyncio mode.
+        The caller reports its outcome with finish().
+        """
+        operation = Operation(str(uuid.uuid4()), instance_id, kind, plan_id)
+        operation.replica = self.replica
+        self._save(operation)
+        with self._lock:
+            self._purge()
+            self._operations[operation.id] = operation
+        self._sweep()
+        return operation
+
+    def finish(self, operation: Operation, result=None, error: Exception=None):
+        if error is not None:
+            operation.state = OperationState.FAILED
+            operation.description = "{0} failed: {1}".format(operation.kind, error)
+        elif getattr(result, "state", None) == "failed":
+            operation.state = OperationState.FAILED
+            operation.description = "{0} failed".format(operation.kind)
+        else:
+            operation.state = OperationState.SUCCEEDED
+            operation.description = "{0} succeeded".format(operation.kind)
+        operation.finished = time.time()
+        metrics.OPERATION_SECONDS.labels(operation.kind, operation.plan_id or "",
+                                         operation.state.value).observe(operation.finished - operation.created)
+        try:
+            self._save(operation)
+        except Exception:
+            # polls on this replica still get the outcome from memory
+            logger.exception("Failed to store the outcome of operation %s", operation.id)
+
+    def get(self, instance_id: str, operation_id: str) -> Operation:
+        with self._lock:
+            operation = self._operations.get(operation_id)
+        if operation is None and self.state_store is not None and operation_id:
+            operation = self._load(operation_id)
+        if operation is None or operation.instance_id != instance_id:
+            return None
+        return operation
+
+    def _save(self, operation: Operation):
+        if self.state_store is not None:
+            self.state_store.save(self.KIND, operation.id, operation.to_record(),
+                                  dict(created=operation.created, finished=operation.finished))
+
+    def _load(self, operation_id: str) -> Operation:
+        record = self.state_store.load(self.KIND, operation_id)
+        if record is None:
+            return None
+        operation = Operation.from_record(record)
+        if operation.state == OperationState.IN_PROGRESS and not self._running(operation):
+            operation.state = OperationState.FAILED
+            operation.description = "{0} failed: interrupted by the loss of replica {1}".format(
+                operation.kind, operation.replica or "")
+        return operation
+
+    def _running(self, operation: Operation) -> bool:
+        # operations of this replica are in memory for as long as it runs
+        if operation.replica == self.replica:
+            return False
+        return self.members is None or operation.replica in self.members()
+
+    def collect_metrics(self) -> list:
+        with self._lock:
+            in_progress = sum(1 for operation in self._operations.values()
+                              if operation.state == OperationState.IN_PROGRESS)
+        return [("opcua_broker_operations_in_progress", "gauge",
+                 "Asynchronous operations running or queued", [(dict(), in_progress)]),
+                ("opcua_broker_operations_capacity", "gauge", "Asynchronous operations which may run or queue at once",
+                 [(dict(), self.max_workers + self.max_pending)])]
+
+    def shutdown(self, wait: bool=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, operation: Operation, fn):
+        try:
+            result = fn()
+        except Exception as e:
+            logger.exception("Operation %s of instance %s failed", operation.kind, operation.instance_id)
+            self.finish(operation, error=e)
+        else:
+            self.finish(operation, result)
+        finally:
+            self._slots.release()
+
+    def _purge(self):
+        expired = time.time() - self.retention
+        for operation_id, operation in list(self._operations.items()):
+            if operation.finished is not None and operation.finished < expired:
+                self._operations.pop(operation_id)
+
+    def _sweep(self):
+        # the stored operations of every replica, interrupted ones never finish
+        now = time.time()
+        expired = now - self.retention
+        if self.state_store is not None and now - self._swept >= self.sweep_interval:
+            self._swept = now
+            try:
+                for operation_id, index in self.state_store.load_index(self.KIND):
+                    if (index.get("finished") or index.get("created", now)) < expired:
+                        self.state_store.delete(self.KIND, operation_id)
+            except Exception:
+                logger.exception("Failed to sweep the stored operations")
@@ -0,0 +1,189 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+
+AGGREGATES = ("min", "max", "avg")
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class ChangeOnly(object):
+    """
+    Drops the records whose value and status are those of the last record
+    passed for their node.
+    """
+
+    def __init__(self, **kwargs):
+        self._last = dict()
+
+    def process(self, records: list, now: float) -> list:
+        passed = []
+        last = self._last
+        for record in records:
+            current = (record[1], record[3])
+            if last.get(record[0]) == current:
+                continue
+            last[record[0]] = current
+            passed.append(record)
+        return passed
+
+
+class Deadband(object):
+    """
+    Drops the numeric values within the deadband of the last value passed
+    for their node: absolute, or percent of range (low, high) as an OPC UA
+    percent deadband is of the EURange, or of the last value without one.
+    With both a value has to leave the wider band. Records whose status
+    changed always pass.
+    """
+
+    def __init__(self, absolute: float=None, percent: float=None, range: list=None, **kwargs):
+        self.absolute = absolute or 0
+        self.percent = percent
+        self.span = abs(range[1] - range[0]) if range else None
+        self._last = dict()
+
+    def band(self, last: float) -> float:
+        if self.percent is None:
+            return self.absolute
+        span = self.span if self.span is not None else abs(last)
+        return max(self.absolute, span * self.percent / 100.0)
+
+    def process(self, records: list, now: float) -> list:
+        passed = []
+        last = self._last
+        for record in records:
+            value = record[1]
+            previous = last.get(record[0])
+            if previous is not None and previous[1] == record[3] and is_number(value) and is_number(previous[0]) \
+                    and abs(value - previous[0]) <= self.band(previous[0]):
+                continue
+            last[record[0]] = (value, record[3])
+            passed.append(record)
+        return passed
+
+
+class Sample(object):
+    """
+    Downsamples each node to the first record of every interval seconds.
+    Records whose status changed always pass.
+    """
+
+    def __init__(self, interval: float, **kwargs):
+        self.interval = interval
+        self._next = dict()
+
+    def process(self, records: list, now: float) -> list:
+        passed = []
+        scheduled = self._next
+        for record in records:
+            previous = scheduled.get(record[0])
+            if previous is not None and now < previous[0] and previous[1] == record[3]:
+                continue
+            scheduled[record[0]] = (now + self.interval, record[3])
+            passed.append(record)
+        return passed
+
+
+class Window(object):
+    """
+    Aggregates the numeric values of each node over windows of interval
+    seconds, aligned to the clock, into one record per node and window:
+    [node, {"min": ..., "max": ..., "avg": ..., "count": n}, start, status],
+    with the status Good if all values were. A window is emitted by the
+    first batch after it ended; other values pass as they are.
+    """
+
+    windowed = True
+
+    def __init__(self, interval: float, aggregates: list=AGGREGATES, **kwargs):
+        self.interval = interval
+        self.aggregates = tuple(aggregates)
+        # the values of every node by window start, oldest window first
+        self._windows = OrderedDict()
+
+    def process(self, records: list, now: float) -> list:
+        passed = self.flush(now)
+        start = now - now % self.interval
+        window = self._windows.get(start)
+        for record in records:
+            if not is_number(record[1]):
+                passed.append(record)
+                continue
+            if window is None:
+                window = self._windows[start] = dict()
+            values = window.get(record[0])
+            if values is None:
+                values = window[record[0]] = ([], [])
+            values[0].append(record[1])
+            if record[3] != "Good":
+                values[1].append(record[3])
+        return passed
+
+    def flush(self, now: float) -> list:
+        records = []
+        while self._windows:
+            start = next(iter(self._windows))
+            if start + self.interval > now:
+                break
+            window = self._windows.pop(start)
+            timestamp = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).isoformat()
+            for node, (values, statuses) in window.items():
+                records.append([node, self.aggregate(values), timestamp, "Uncertain" if statuses else "Good"])
+        return records
+
+    def aggregate(self, values: list) -> dict:
+        result = dict()
+        for name in self.aggregates:
+            if name == "min":
+                result[name] = min(values)
+            elif name == "max":
+                result[name] = max(values)
+            elif name == "avg":
+                result[name] = sum(values) / len(values)
+        result["count"] = len(values)
+        return result
+
+
+class Pipeline(object):
+    """
+    The stages a binding's data-change records pass before they are
+    appended to its buffer, in the order change-only, deadband, sampling
+    and window. Stages keep their state per node; process() is called
+    with every batch of the subscription, empty ones included when
+    windowed, so that ended windows are emitted without waiting for a
+    value of their node.
+    """
+
+    def __init__(self, stages: list, **kwargs):
+        self.stages = stages
+        self.windowed = any(getattr(stage, "windowed", False) for stage in stages)
+        self._lock = threading.Lock()
+
+    def process(self, records: list, now: float=None) -> list:
+        if now is None:
+            now = time.time()
+        with self._lock:
+            for stage in self.stages:
+                records = stage.process(records, now)
+        return records
+
+
+def build_pipeline(parameters: dict) -> Pipeline:
+    # the pipeline the parameters of a data-change binding ask for, None if no stages
+    stages = []
+    if parameters.get("changeOnly"):
+        stages.append(ChangeOnly())
+    deadband = parameters.get("deadband")
+    if deadband:
+        stages.append(Deadband(deadband.get("absolute"), deadband.get("percent"), deadband.get("range")))
+    if parameters.get("sampleInterval"):
+        stages.append(Sample(parameters["sampleInterval"] / 1000.0))
+    window = parameters.get("window")
+    if window:
+        stages.append(Window(window["interval"] / 1000.0, window.get("aggregates") or AGGREGATES))
+    return Pipeline(stages) if stages else None
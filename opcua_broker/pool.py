@@ -0,0 +1,346 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from contextlib import contextmanager
+
+from opcua import Client
+from opcua import ua
+from opcua.common.utils import SocketClosedException
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Status codes which mean the session or secure channel behind a client is gone,
+# as opposed to a service-level error on an otherwise healthy session.
+BROKEN_SESSION_CODES = (
+    ua.StatusCodes.BadSessionIdInvalid,
+    ua.StatusCodes.BadSessionClosed,
+    ua.StatusCodes.BadSessionNotActivated,
+    ua.StatusCodes.BadSecureChannelIdInvalid,
+    ua.StatusCodes.BadSecureChannelClosed,
+    ua.StatusCodes.BadConnectionClosed,
+    ua.StatusCodes.BadServerNotConnected,
+    ua.StatusCodes.BadCommunicationError,
+    ua.StatusCodes.BadTimeout,
+)
+
+# Errors of the connection itself: python-opcua times out waiting for a
+# response, and cancels the requests still waiting when its socket closes.
+TRANSPORT_ERRORS = (
+    OSError,
+    TimeoutError,
+    futures.TimeoutError,
+    futures.CancelledError,
+    SocketClosedException,
+)
+
+
+def is_broken_session_error(e: Exception) -> bool:
+    # any other error, like a bad node id in a request, leaves the session
+    # as healthy as it was
+    if isinstance(e, ua.UaStatusCodeError):
+        return e.code in BROKEN_SESSION_CODES
+    return isinstance(e, TRANSPORT_ERRORS)
+
+
+def is_connected(client: Client) -> bool:
+    # the thread receiving the responses of python-opcua ends with its connection
+    socket = client.uaclient._uasocket
+    return socket is not None and socket._thread is not None and socket._thread.is_alive()
+
+
+class PooledSession(object):
+    def __init__(self,
+                 key: tuple,
+                 client: Client,
+                 **kwargs):
+        self.key = key
+        self.client = client
+        self.created = time.time()
+        self.last_used = self.created
+        self.last_checked = self.created
+        self.broken = False
+        self.shared_count = 0
+        # close the session without deleting its subscriptions, which another
+        # session is going to take over
+        self.keep_subscriptions = False
+
+
+class EndpointPool(object):
+    def __init__(self, key: tuple, **kwargs):
+        self.key = key
+        self.idle = deque()
+        self.in_use = 0
+
+    @property
+    def size(self):
+        return self.in_use + len(self.idle)
+
+
+class SessionPool(object):
+    """
+    Long-lived OPC UA client sessions keyed by endpoint url and security string.
+
+    Each endpoint holds at most max_size sessions. Idle sessions are health
+    checked on checkout once health_check_interval has passed, reconnected when
+    their channel is broken and evicted by a reaper thread after idle_timeout.
+    """
+
+    def __init__(self,
+                 max_size: int=4,
+                 idle_timeout: float=300,
+                 health_check_interval: float=30,
+                 acquire_timeout: float=10,
+                 timeout: float=4,
+                 **kwargs):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.timeout = timeout
+        self._pools = dict()
+        self._shared = dict()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._reaper = threading.Thread(target=self._reap_loop, name="opcua-session-reaper")
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    @staticmethod
+    def make_key(url: str, security_string: str=None) -> tuple:
+        return url, security_string or ""
+
+    def acquire(self, url: str, security_string: str=None) -> PooledSession:
+        key = self.make_key(url, security_string)
+        start = time.time()
+        deadline = start + self.acquire_timeout
+        with self._cond:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = EndpointPool(key)
+                self._pools[key] = pool
+            while True:
+                if self._closed:
+                    raise RuntimeError("session pool is closed")
+                if pool.idle:
+                    session = pool.idle.pop()
+                    pool.in_use += 1
+                    break
+                if pool.size < self.max_size:
+                    session = None
+                    pool.in_use += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("no free OPC UA session for {0} within {1}s"
+                                       .format(url, self.acquire_timeout))
+                self._cond.wait(remaining)
+        metrics.SESSION_WAIT_SECONDS.labels(metrics.endpoint_label(url)).observe(time.time() - start)
+
+        # Connecting and health checking happen outside the pool lock so that a
+        # slow endpoint never blocks checkouts for other endpoints.
+        try:
+            if session is None:
+                session = PooledSession(key, self._connect(url, security_string))
+            elif session.broken or not self._check(session):
+                self._reconnect(session)
+        except Exception:
+            with self._cond:
+                pool.in_use -= 1
+                self._cond.notify_all()
+            raise
+
+        session.last_used = time.time()
+        return session
+
+    def release(self, session: PooledSession):
+        session.last_used = time.time()
+        with self._cond:
+            pool = self._pools.get(session.key)
+            if pool is not None:
+                pool.in_use -= 1
+            if session.broken or self._closed or pool is None:
+                discard = True
+            else:
+                discard = False
+                pool.idle.append(session)
+            self._cond.notify_all()
+        if discard:
+            self._disconnect(session)
+
+    def acquire_shared(self, url: str, security_string: str=None) -> PooledSession:
+        """
+        Check out the session of an endpoint shared by long-lived users such as
+        subscriptions. It stays checked out until every user released it.
+        """
+        key = self.make_key(url, security_string)
+        with self._cond:
+            session = self._shared.get(key)
+            if session is not None and not session.broken:
+                session.shared_count += 1
+                return session
+
+        session = self.acquire(url, security_string)
+        with self._cond:
+            current = self._shared.get(key)
+            if current is not None and not current.broken:
+                current.shared_count += 1
+                duplicate, session = session, current
+            else:
+                duplicate = None
+                session.shared_count = 1
+                self._shared[key] = session
+        if duplicate is not None:
+            self.release(duplicate)
+        return session
+
+    def release_shared(self, session: PooledSession):
+        with self._cond:
+            session.shared_count -= 1
+            if session.shared_count > 0:
+                return
+            if self._shared.get(session.key) is session:
+                self._shared.pop(session.key)
+        self.release(session)
+
+    @contextmanager
+    def session(self, url: str, security_string: str=None):
+        session = self.acquire(url, security_string)
+        try:
+            yield session.client
+        except Exception as e:
+            if is_broken_session_error(e):
+                session.broken = True
+            raise
+        finally:
+            self.release(session)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict((key, dict(in_use=pool.in_use, idle=len(pool.idle)))
+                        for key, pool in self._pools.items())
+
+    def collect_metrics(self) -> list:
+        sessions = []
+        with self._cond:
+            for key, pool in self._pools.items():
+                endpoint = metrics.endpoint_label(key[0])
+                sessions.append((dict(endpoint=endpoint, state="in_use"), pool.in_use))
+                sessions.append((dict(endpoint=endpoint, state="idle"), len(pool.idle)))
+            shared = [(dict(endpoint=metrics.endpoint_label(key[0])), session.shared_count)
+                      for key, session in self._shared.items()]
+        return [("opcua_broker_sessions", "gauge", "Pooled OPC UA sessions by endpoint and state", sessions),
+                ("opcua_broker_sessions_max", "gauge", "Max pooled OPC UA sessions per endpoint",
+                 [(dict(), self.max_size)]),
+                ("opcua_broker_shared_session_users", "gauge",
+                 "Long-lived users of the shared session of each endpoint", shared)]
+
+    def evict_idle(self, now: float=None):
+        now = now or time.time()
+        expired = []
+        with self._cond:
+            for key, pool in list(self._pools.items()):
+                keep = deque()
+                for session in pool.idle:
+                    if now - session.last_used > self.idle_timeout:
+                        expired.append(session)
+                    else:
+                        keep.append(session)
+                pool.idle = keep
+                if not pool.size:
+                    self._pools.pop(key)
+        for session in expired:
+            logger.debug("Evicting idle OPC UA session to %s", session.key[0])
+            self._disconnect(session)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            sessions = [s for pool in self._pools.values() for s in pool.idle]
+            sessions.extend(self._shared.values())
+            self._pools = dict()
+            self._shared = dict()
+            self._cond.notify_all()
+        for session in sessions:
+            self._disconnect(session)
+
+    def _connect(self, url: str, security_string: str=None) -> Client:
+        client = Client(url, timeout=self.timeout)
+        if security_string:
+            client.set_security_string(security_string)
+        # the steps of Client.connect, timed apart so that reaching the
+        # server and setting up the session show up as separate metrics
+        with metrics.opcua_request(client, "connect"):
+            client.connect_socket()
+            try:
+                client.send_hello()
+                client.open_secure_channel()
+            except Exception:
+                client.disconnect_socket()
+                raise
+        try:
+            with metrics.opcua_request(client, "session"):
+                client.create_session()
+                try:
+                    client.activate_session(username=client._username, password=client._password,
+                                            certificate=client.user_certificate)
+                except Exception:
+                    client.close_session()
+                    raise
+        except Exception:
+            try:
+                client.close_secure_channel()
+            finally:
+                client.disconnect_socket()
+            raise
+        logger.debug("Opened OPC UA session to %s", url)
+        return client
+
+    def _check(self, session: PooledSession) -> bool:
+        now = time.time()
+        if now - session.last_checked < self.health_check_interval:
+            return True
+        session.last_checked = now
+        try:
+            state = session.client.get_node(ua.NodeId(ua.ObjectIds.Server_ServerStatus_State)).get_value()
+        except Exception as e:
+            logger.info("Health check of OPC UA session to %s failed: %s", session.key[0], e)
+            return False
+        return state == ua.ServerState.Running
+
+    def _reconnect(self, session: PooledSession):
+        logger.info("Reconnecting OPC UA session to %s", session.key[0])
+        self._disconnect(session)
+        session.client = self._connect(*session.key)
+        session.created = session.last_checked = time.time()
+        session.broken = False
+
+    @staticmethod
+    def _disconnect(session: PooledSession):
+        try:
+            if session.keep_subscriptions:
+                # Client.close_session() stops the keepalive thread too, but
+                # always deletes the subscriptions
+                keepalive = session.client.keepalive
+                if keepalive is not None and keepalive.is_alive():
+                    keepalive.stop()
+                    keepalive.join()
+                try:
+                    session.client.uaclient.close_session(False)
+                    session.client.close_secure_channel()
+                finally:
+                    session.client.disconnect_socket()
+            else:
+                session.client.disconnect()
+        except Exception as e:
+            logger.debug("Error while closing OPC UA session to %s: %s", session.key[0], e)
+
+    def _reap_loop(self):
+        interval = max(1.0, min(self.idle_timeout, self.health_check_interval) / 2)
+        while not self._closed:
+            time.sleep(interval)
+            self.evict_idle()
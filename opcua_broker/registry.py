@@ -0,0 +1,181 @@
+import threading
+
+
+class Unloaded(object):
+    # Placeholder for an entry known from the state store index whose full
+    # record has not been read yet.
+    def __init__(self, index_values: dict, **kwargs):
+        self.index_values = index_values
+
+
+class Shard(object):
+    def __init__(self, **kwargs):
+        self.lock = threading.Lock()
+        self.items = dict()
+
+
+class Registry(object):
+    """
+    Thread-safe map of service instances or bindings by id.
+
+    Entries are spread over shards, each with its own lock, so concurrent
+    writers for different ids rarely contend. Secondary indexes map the value
+    returned by each index function to the set of ids having it.
+
+    With a store, every put and pop is written through to it as kind records
+    before the in-memory map changes. restore() rebuilds the ids and indexes
+    from the store index only; records are read and passed to load on first
+    access. restore(reset=True) also replaces the entries already in memory,
+    for brokers sharing the store with others.
+    """
+
+    def __init__(self,
+                 indexes: dict=None,
+                 shards: int=16,
+                 store=None,
+                 kind: str=None,
+                 dump=None,
+                 load=None,
+                 **kwargs):
+        self._shards = [Shard() for _ in range(shards)]
+        self._indexes = dict((name, dict()) for name in (indexes or dict()))
+        self._index_functions = dict(indexes or dict())
+        self._index_lock = threading.Lock()
+        self.store = store
+        self.kind = kind
+        self._dump = dump
+        self._load = load
+
+    def restore(self, reset: bool=False) -> int:
+        if self.store is None:
+            return 0
+        entries = self.store.load_index(self.kind)
+        if reset:
+            # other brokers sharing the store may have changed it, forget
+            # whatever it no longer has
+            keys = set(key for key, _ in entries)
+            for shard in self._shards:
+                with shard.lock:
+                    for key, value in list(shard.items.items()):
+                        if key not in keys:
+                            shard.items.pop(key)
+                            with self._index_lock:
+                                self._unindex(key, value)
+        for key, index_values in entries:
+            shard = self._shard(key)
+            with shard.lock:
+                previous = shard.items.get(key)
+                if previous is not None and not reset:
+                    continue
+                value = Unloaded(index_values)
+                shard.items[key] = value
+                with self._index_lock:
+                    if previous is not None:
+                        self._unindex(key, previous)
+                    self._index(key, value)
+        return len(entries)
+
+    def _shard(self, key: str) -> Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def put(self, key: str, value):
+        shard = self._shard(key)
+        with shard.lock:
+            if self.store is not None:
+                self.store.save(self.kind, key, self._dump(value), self.index_values(value))
+            previous = shard.items.get(key)
+            shard.items[key] = value
+            # index updates stay under the shard lock so that two writers of the
+            # same id cannot interleave their index changes
+            with self._index_lock:
+                if previous is not None:
+                    self._unindex(key, previous)
+                self._index(key, value)
+
+    def get(self, key: str, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            value = self._materialize(shard, key)
+        return default if value is None else value
+
+    def pop(self, key: str, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            value = self._materialize(shard, key)
+            if value is None:
+                return default
+            if self.store is not None:
+                self.store.delete(self.kind, key)
+            shard.items.pop(key)
+            with self._index_lock:
+                self._unindex(key, value)
+        return value
+
+    def index_values(self, value) -> dict:
+        if isinstance(value, Unloaded):
+            return dict(value.index_values)
+        return dict((name, index_function(value)) for name, index_function in self._index_functions.items())
+
+    def find(self, index: str, value) -> list:
+        with self._index_lock:
+            keys = list(self._indexes[index].get(value, ()))
+        return [item for item in (self.get(key) for key in keys) if item is not None]
+
+    def keys(self) -> list:
+        keys = []
+        for shard in self._shards:
+            with shard.lock:
+                keys.extend(shard.items.keys())
+        return keys
+
+    def values(self) -> list:
+        values = []
+        for shard in self._shards:
+            with shard.lock:
+                for key in list(shard.items.keys()):
+                    value = self._materialize(shard, key)
+                    if value is not None:
+                        values.append(value)
+        return values
+
+    def __getitem__(self, key: str):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        shard = self._shard(key)
+        with shard.lock:
+            return key in shard.items
+
+    def __len__(self) -> int:
+        return sum(len(shard.items) for shard in self._shards)
+
+    def _materialize(self, shard: Shard, key: str):
+        # must be called with the shard lock held
+        value = shard.items.get(key)
+        if not isinstance(value, Unloaded):
+            return value
+        record = self.store.load(self.kind, key)
+        if record is None:
+            shard.items.pop(key)
+            with self._index_lock:
+                self._unindex(key, value)
+            return None
+        loaded = self._load(record)
+        shard.items[key] = loaded
+        return loaded
+
+    def _index(self, key: str, value):
+        for name, index_value in self.index_values(value).items():
+            if index_value is not None:
+                self._indexes[name].setdefault(index_value, set()).add(key)
+
+    def _unindex(self, key: str, value):
+        for name, index_value in self.index_values(value).items():
+            keys = self._indexes[name].get(index_value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    self._indexes[name].pop(index_value)
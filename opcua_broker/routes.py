@@ -0,0 +1,297 @@
+import http.client
+import itertools
+import json
+import logging
+
+from flask import Blueprint, Response, abort, request
+
+from . import metrics
+from .cluster import HOP_BY_HOP_HEADERS
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_blueprint(opcua_handler, keepalive: float=15, max_batch: int=1000) -> Blueprint:
+    """
+    Blueprint with the endpoints bound apps use besides the OSB api.
+
+    GET /opcua/bindings/<binding_id>/stream streams the notifications of a
+    data-change or events binding as server-sent events, or as newline
+    delimited JSON with ?format=ndjson. The stream pulls from the binding's
+    ring buffer only as fast as the client reads, so a slow client never
+    holds up the subscription; it is told how many notifications it missed
+    instead. An id past the end of the buffer, kept by a client from before
+    the binding's buffer was recreated on a restart or another replica, is
+    answered with a reset to the buffer's end.
+
+    POST /opcua/bindings/<binding_id>/read and /write read or write the values
+    of many nodes of a node-management binding's server at once, answering
+    with columnar JSON, or MessagePack if asked for in the Accept header.
+
+    POST /opcua/bindings/<binding_id>/history streams the history of the
+    nodes of a history binding's server as newline delimited JSON, a line
+    of columns per page of a node, read from the server only as fast as the
+    client takes them.
+
+    GET /metrics exposes the metrics of metrics.py in the Prometheus text
+    format.
+    """
+    blueprint = Blueprint("opcua", __name__)
+
+    @blueprint.route("/opcua/bindings/<binding_id>/stream", methods=["GET"])
+    def stream(binding_id):
+        try:
+            buffer = opcua_handler.binding_buffer(binding_id)
+        except Exception as e:
+            return Response(json.dumps(dict(description=str(e))), status=503, mimetype="application/json")
+        if buffer is None:
+            abort(404)
+
+        try:
+            cursor = parse_cursor(request.args.get("after", request.headers.get("Last-Event-ID")))
+        except ValueError as e:
+            return Response(json.dumps(dict(description=str(e))), status=400, mimetype="application/json")
+        if request.args.get("format") == "ndjson":
+            return Response(ndjson_stream(buffer, cursor, keepalive, max_batch), mimetype="application/x-ndjson")
+        return Response(event_stream(buffer, cursor, keepalive, max_batch), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @blueprint.route("/metrics", methods=["GET"])
+    def metrics_text():
+        return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+    @blueprint.route("/opcua/bindings/<binding_id>/read", methods=["POST"])
+    def read(binding_id):
+        body = request.get_json(force=True, silent=True) or dict()
+        return columnar_response(opcua_handler.read_binding_values, binding_id,
+                                 nodes=body.get("nodes"), paths=body.get("paths"))
+
+    @blueprint.route("/opcua/bindings/<binding_id>/write", methods=["POST"])
+    def write(binding_id):
+        body = request.get_json(force=True, silent=True) or dict()
+        return columnar_response(opcua_handler.write_binding_values, binding_id, values=body.get("values") or [],
+                                 nodes=body.get("nodes"), paths=body.get("paths"))
+
+    @blueprint.route("/opcua/bindings/<binding_id>/history", methods=["POST"])
+    def read_history(binding_id):
+        body = request.get_json(force=True, silent=True) or dict()
+        try:
+            lines = opcua_handler.read_binding_history(binding_id, body, nodes=body.get("nodes"),
+                                                       paths=body.get("paths"))
+        except (ValueError, TypeError) as e:
+            return Response(json.dumps(dict(description=str(e))), status=400, mimetype="application/json")
+        if lines is None:
+            abort(404)
+        # the first page is read before answering, so that a bad request or an
+        # unavailable server still gets its status code
+        try:
+            first = next(lines, "")
+        except (ValueError, TypeError) as e:
+            return Response(json.dumps(dict(description=str(e))), status=400, mimetype="application/json")
+        except Exception as e:
+            return Response(json.dumps(dict(description=str(e))), status=502, mimetype="application/json")
+        return Response(itertools.chain([first], lines), mimetype="application/x-ndjson")
+
+    return blueprint
+
+
+def get_catalog_blueprint(service_catalog, min_version: tuple=(2, 13)) -> Blueprint:
+    """
+    Blueprint answering GET /v2/catalog from the cached bytes of
+    service_catalog, ahead of openbrokerapi's blueprint which would build
+    and serialize the catalog again on every request.
+    """
+    blueprint = Blueprint("opcua_catalog", __name__)
+
+    @blueprint.before_app_request
+    def catalog():
+        if request.method != "GET" or request.path != "/v2/catalog":
+            return None
+
+        version = request.headers.get("X-Broker-Api-Version")
+        if not version:
+            return Response(json.dumps(dict(description="No X-Broker-Api-Version found.")),
+                            status=400, mimetype="application/json")
+        if min_version > tuple(map(int, version.split("."))):
+            return Response(json.dumps(dict(description="Service broker requires version %d.%d+." % min_version)),
+                            status=412, mimetype="application/json")
+
+        headers = {"ETag": service_catalog.etag}
+        if service_catalog.not_modified(request.headers.get("If-None-Match")):
+            return Response(status=304, headers=headers)
+        return Response(service_catalog.body, mimetype="application/json", headers=headers)
+
+    return blueprint
+
+
+def invalid_parameters(e) -> Response:
+    return Response(json.dumps(dict(description=str(e))), status=400, mimetype="application/json")
+
+
+def get_cluster_blueprint(cluster) -> Blueprint:
+    """
+    Blueprint forwarding the requests of instances and bindings owned by
+    another replica of a broker cluster to that replica, and streaming its
+    response back.
+    """
+    blueprint = Blueprint("opcua_cluster", __name__)
+
+    @blueprint.before_app_request
+    def forward():
+        body = request.get_data()
+        owner = cluster.route(request.method, request.path, request.headers, body)
+        if owner is None:
+            return None
+
+        target = request.path
+        if request.query_string:
+            target += "?" + request.query_string.decode("latin-1")
+        try:
+            response = cluster.forward(owner, request.method, target, request.headers, body)
+        except OSError as e:
+            return Response(json.dumps(dict(description="replica {0} is unavailable: {1}".format(owner, e))),
+                            status=503, mimetype="application/json")
+        headers = [(name, value) for name, value in response.getheaders()
+                   if name.lower() not in HOP_BY_HOP_HEADERS]
+        return Response(relay(response), status=response.status, headers=headers)
+
+    return blueprint
+
+
+def get_state_blueprint(state_store) -> Blueprint:
+    """
+    Blueprint serving state_store to the other replicas of a broker cluster,
+    whose store.RemoteStateStore reads and writes it here, so that a single
+    replica writes the SQLite file. Keys, urls among them, are passed in the
+    query string.
+    """
+    blueprint = Blueprint("opcua_state", __name__)
+
+    @blueprint.route("/opcua/state/<kind>", methods=["GET", "PUT", "DELETE"])
+    def state(kind):
+        key = request.args.get("key")
+        if key is None:
+            if request.method != "GET":
+                return Response(json.dumps(dict(description="key missing")), status=400, mimetype="application/json")
+            return Response(json.dumps(state_store.load_index(kind)), mimetype="application/json")
+        if request.method == "GET":
+            # a missing record is null, a 404 means no state is kept here
+            return Response(json.dumps(state_store.load(kind, key)), mimetype="application/json")
+        if request.method == "DELETE":
+            state_store.delete(kind, key)
+            return Response(status=204)
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("record"), dict):
+            return Response(json.dumps(dict(description="record missing")), status=400, mimetype="application/json")
+        state_store.save(kind, key, body["record"], body.get("index") or dict())
+        return Response(status=204)
+
+    return blueprint
+
+
+def relay(response, chunk_size: int=65536):
+    try:
+        while True:
+            try:
+                chunk = response.read1(chunk_size)
+            except (OSError, http.client.HTTPException) as e:
+                # the owner went away mid-stream, end ours the same way
+                logger.info("Forwarded response cut short: %s", e)
+                return
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        response.close()
+
+
+def columnar_response(handle, binding_id: str, **kwargs) -> Response:
+    # the OPC UA modules are loaded by the time a binding reads or writes
+    from . import data_access
+
+    try:
+        columns = handle(binding_id, **kwargs)
+    except (ValueError, TypeError) as e:
+        return Response(json.dumps(dict(description=str(e))), status=400, mimetype="application/json")
+    except Exception as e:
+        return Response(json.dumps(dict(description=str(e))), status=502, mimetype="application/json")
+    if columns is None:
+        abort(404)
+    body, mimetype = data_access.encode(columns, request.headers.get("Accept"))
+    return Response(body, mimetype=mimetype)
+
+
+def parse_cursor(value: str) -> int:
+    if value is None:
+        return None
+    try:
+        cursor = int(value)
+    except ValueError:
+        cursor = -1
+    if cursor < 0:
+        raise ValueError("Invalid notification id {0!r}".format(value))
+    return cursor
+
+
+def reset_cursor(buffer, cursor: int) -> int:
+    # ids count from 0 again in a buffer recreated after a restart or a
+    # rebalance, those of the old one must not hold the stream back
+    if cursor is not None and cursor > buffer.tail:
+        return buffer.tail
+    return None
+
+
+def event_stream(buffer, cursor: int=None, keepalive: float=15, max_batch: int=1000):
+    reset = reset_cursor(buffer, cursor)
+    if reset is not None:
+        cursor = reset
+        yield event_reset_chunk(cursor)
+    while True:
+        items, cursor, missed = buffer.read(cursor, max_batch, keepalive)
+        if not items and not missed and buffer.closed:
+            return
+        yield event_chunk(items, cursor, missed)
+
+
+def ndjson_stream(buffer, cursor: int=None, keepalive: float=15, max_batch: int=1000):
+    reset = reset_cursor(buffer, cursor)
+    if reset is not None:
+        cursor = reset
+        yield ndjson_reset_chunk(cursor)
+    while True:
+        items, cursor, missed = buffer.read(cursor, max_batch, keepalive)
+        if not items and not missed and buffer.closed:
+            return
+        yield ndjson_chunk(items, cursor, missed)
+
+
+def event_chunk(items: list, cursor: int, missed: int) -> str:
+    chunk = ""
+    if missed:
+        chunk += "event: dropped\ndata: {0}\n\n".format(missed)
+    if items:
+        chunk += "id: {0}\ndata: {1}\n\n".format(cursor, json.dumps(items, separators=(",", ":")))
+    elif not missed:
+        chunk += ": keepalive\n\n"
+    return chunk
+
+
+def event_reset_chunk(cursor: int) -> str:
+    # the id moves the client's Last-Event-ID back to the buffer's end
+    return "event: reset\nid: {0}\ndata: {0}\n\n".format(cursor)
+
+
+def ndjson_reset_chunk(cursor: int) -> str:
+    return json.dumps(dict(reset=cursor)) + "\n"
+
+
+def ndjson_chunk(items: list, cursor: int, missed: int) -> str:
+    chunk = ""
+    if missed:
+        chunk += json.dumps(dict(dropped=missed)) + "\n"
+    if items:
+        chunk += "".join(json.dumps(item, separators=(",", ":")) + "\n" for item in items)
+    elif not missed:
+        chunk += "\n"
+    return chunk
@@ -0,0 +1,421 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from itertools import islice
+from urllib.parse import quote, unquote
+
+from .buffer import RingBuffer
+
+
+logger = logging.getLogger(__name__)
+
+# every record is its payload length and CRC-32 followed by the payload, the
+# JSON of one notification
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".seg"
+SEGMENT_BYTES = 4 * 1024 * 1024
+MIN_SEGMENT_BYTES = 64 * 1024
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+BINDINGS = "bindings"
+SUBSCRIPTIONS = "subscriptions"
+
+
+def segment_bytes(max_bytes: int=None) -> int:
+    # retention drops whole segments, so a spool keeps at least eight of them
+    if not max_bytes:
+        return SEGMENT_BYTES
+    return max(MIN_SEGMENT_BYTES, min(SEGMENT_BYTES, max_bytes // 8))
+
+
+class Segment(object):
+    """
+    One file of a spool, named after the offset of its first record and
+    memory-mapped at a fixed size. Records are appended to the map, so
+    writing them is a memory copy; they reach the disk when the segment is
+    synced. Reopening a segment scans it up to the first empty or corrupt
+    record header, which drops whatever a crash left half written.
+    """
+
+    def __init__(self, path: str, base: int, size: int=SEGMENT_BYTES, **kwargs):
+        self.path = path
+        self.base = base
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            else:
+                size = os.fstat(fd).st_size
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.positions = array("I")
+        self.end = 0
+        self.last_append = None
+        self._synced = 0
+        self._scan()
+
+    @property
+    def next(self) -> int:
+        return self.base + len(self.positions)
+
+    @property
+    def dirty(self) -> bool:
+        return self._synced < self.end
+
+    def _scan(self):
+        position = 0
+        while position + RECORD_HEADER.size <= self.size:
+            length, crc = RECORD_HEADER.unpack_from(self._map, position)
+            start = position + RECORD_HEADER.size
+            if not length or start + length > self.size or zlib.crc32(self._map[start:start + length]) != crc:
+                break
+            self.positions.append(position)
+            position = start + length
+        self.end = self._synced = position
+        if self.positions:
+            self.last_append = os.path.getmtime(self.path)
+
+    def append(self, payload: bytes) -> bool:
+        start = self.end + RECORD_HEADER.size
+        end = start + len(payload)
+        if end > self.size:
+            return False
+        RECORD_HEADER.pack_into(self._map, self.end, len(payload), zlib.crc32(payload))
+        self._map[start:end] = payload
+        # an empty header marks the end, whatever an earlier crash left after it
+        if end + RECORD_HEADER.size <= self.size:
+            RECORD_HEADER.pack_into(self._map, end, 0, 0)
+        self.positions.append(self.end)
+        self.end = end
+        self.last_append = time.time()
+        return True
+
+    def records(self, index: int, count: int) -> list:
+        payloads = []
+        for position in self.positions[index:index + count]:
+            length = RECORD_HEADER.unpack_from(self._map, position)[0]
+            start = position + RECORD_HEADER.size
+            payloads.append(self._map[start:start + length])
+        return payloads
+
+    def unsynced(self) -> tuple:
+        # the byte range appended since the last sync, which is then due
+        start, self._synced = self._synced, self.end
+        return start, self.end
+
+    def flush(self, start: int, end: int):
+        start -= start % mmap.PAGESIZE
+        if end + RECORD_HEADER.size <= self.size:
+            end += RECORD_HEADER.size
+        self._map.flush(start, end - start)
+
+    def close(self):
+        self._map.close()
+
+
+class Spool(RingBuffer):
+    """
+    RingBuffer whose notifications are also appended to segment files in
+    directory, so that a reader reconnecting with the offset of the last
+    notification it got is sent the ones after it from disk, even those
+    which no longer fit in memory or were received before a restart.
+
+    Offsets carry on from the segments found in directory. Appending never
+    waits for the disk: sync() writes out what was appended since it last
+    ran, and is called for all spools every fsync interval by their
+    SpoolDirectory. Retention drops the oldest segments once the spool
+    holds more than max_bytes or their newest notification is more than
+    max_age seconds old; readers which fell behind that are told how many
+    notifications they missed, like those of a RingBuffer.
+    """
+
+    def __init__(self, directory: str, capacity: int=10000, dropped=None, segment_bytes: int=SEGMENT_BYTES,
+                 max_bytes: int=None, max_age: float=None, **kwargs):
+        super().__init__(capacity, dropped)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                       if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        self._segments = [Segment(self._path(base), base, segment_bytes) for base in bases]
+        self._bases = bases
+        self._next = self._segments[-1].next if self._segments else 0
+        self._bytes = sum(segment.size for segment in self._segments)
+        # segments dropped by retention, unmapped by the next sync so that
+        # one running meanwhile never flushes a closed map
+        self._retired = []
+        self._sync_lock = threading.Lock()
+        self._retain(time.time())
+
+    @property
+    def head(self) -> int:
+        return self._segments[0].base if self._segments else self._next
+
+    def _path(self, base: int) -> str:
+        return os.path.join(self.directory, "{0:020d}{1}".format(base, SEGMENT_SUFFIX))
+
+    def extend(self, items: list):
+        payloads = [json.dumps(item, separators=(",", ":")).encode("utf-8") for item in items]
+        with self._cond:
+            # the offsets of a closed spool are those of its segments again
+            if self.closed:
+                return
+            for offset, payload in enumerate(payloads, self._next):
+                if not self._segments or not self._segments[-1].append(payload):
+                    self._roll(offset, RECORD_HEADER.size * 2 + len(payload))
+                    self._segments[-1].append(payload)
+            self._items.extend(items)
+            self._next += len(items)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def read(self, cursor: int=None, max_items: int=1000, timeout: float=None) -> tuple:
+        with self._cond:
+            # without an offset readers start with what is held in memory,
+            # like those of a RingBuffer, rather than replaying the spool; an
+            # offset past the end is one from before the spool was emptied
+            if cursor is None:
+                cursor = self._next - len(self._items)
+            cursor = min(cursor, self._next)
+            if cursor >= self._next and not self.closed:
+                self._cond.wait(timeout)
+            head = self.head
+            missed = max(0, head - cursor)
+            if missed and self.dropped is not None:
+                self.dropped.inc(missed)
+            cursor = max(cursor, head)
+            memory_head = self._next - len(self._items)
+            if cursor >= memory_head:
+                start = cursor - memory_head
+                items = list(islice(self._items, start, start + max_items))
+                return items, cursor + len(items), missed
+            payloads, cursor = self._records(cursor, min(max_items, memory_head - cursor))
+        return [json.loads(payload.decode("utf-8")) for payload in payloads], cursor, missed
+
+    def _records(self, cursor: int, count: int) -> tuple:
+        payloads = []
+        index = bisect_right(self._bases, cursor) - 1
+        while len(payloads) < count and index < len(self._segments):
+            segment = self._segments[index]
+            if cursor < segment.base:
+                # records a crash cut off the end of the previous segment
+                cursor = segment.base
+            records = segment.records(cursor - segment.base, count - len(payloads))
+            payloads.extend(records)
+            cursor += len(records)
+            index += 1
+        return payloads, cursor
+
+    def _roll(self, base: int, size: int):
+        if self._segments and not self._segments[-1].positions:
+            # an empty segment too small for the record is replaced, its
+            # successor would start at the same offset
+            empty = self._segments.pop()
+            self._bases.pop()
+            self._bytes -= empty.size
+            self._retired.append(empty)
+            os.remove(empty.path)
+        segment = Segment(self._path(base), base, max(self.segment_bytes, size))
+        self._segments.append(segment)
+        self._bases.append(segment.base)
+        self._bytes += segment.size
+        self._retain(time.time())
+
+    def _retain(self, now: float):
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            if not (self.max_bytes and self._bytes > self.max_bytes or
+                    self.max_age and oldest.last_append is not None and now - oldest.last_append > self.max_age):
+                return
+            self._segments.pop(0)
+            self._bases.pop(0)
+            self._bytes -= oldest.size
+            self._retired.append(oldest)
+            os.remove(oldest.path)
+
+    def expire(self, now: float=None):
+        """
+        Drop the segments older than max_age, including the one appended to
+        if all it holds is, which is then replaced by an empty one.
+        """
+        if not self.max_age:
+            return
+        now = now or time.time()
+        with self._cond:
+            if self.closed or not self._segments:
+                return
+            active = self._segments[-1]
+            if active.last_append is not None and now - active.last_append > self.max_age:
+                self._roll(self._next, self.segment_bytes)
+            self._retain(now)
+
+    def sync(self):
+        """
+        Write what was appended since the last sync to disk.
+        """
+        with self._sync_lock:
+            with self._cond:
+                ranges = [(segment,) + segment.unsynced() for segment in self._segments if segment.dirty]
+                retired, self._retired = self._retired, []
+            for segment, start, end in ranges:
+                segment.flush(start, end)
+            for segment in retired:
+                segment.close()
+
+    def close(self):
+        super().close()
+        self.sync()
+        with self._sync_lock, self._cond:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+            self._bases = []
+
+    def discard(self):
+        """
+        Close the spool and delete its files.
+        """
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class SpoolDirectory(object):
+    """
+    The spools of data-change bindings, each in its own directory under
+    path/bindings, and the state of the subscriptions feeding them under
+    path/subscriptions, from which a restarted broker takes those
+    subscriptions over. A thread syncs every spool and saves the state of
+    every subscription each fsync_interval seconds.
+    """
+
+    def __init__(self, path: str, max_bytes: int=DEFAULT_MAX_BYTES, max_age: float=None,
+                 fsync_interval: float=1.0, **kwargs):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self._spools = dict()
+        self._sources = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        os.makedirs(os.path.join(path, BINDINGS), exist_ok=True)
+        os.makedirs(os.path.join(path, SUBSCRIPTIONS), exist_ok=True)
+        self._thread = threading.Thread(target=self._sync_loop, name="spool-sync", daemon=True)
+        self._thread.start()
+
+    def open(self, binding_id: str, capacity: int=10000, dropped=None, max_bytes: int=None,
+             max_age: float=None) -> Spool:
+        max_bytes = max_bytes or self.max_bytes
+        spool = Spool(self._binding_path(binding_id), capacity, dropped, segment_bytes(max_bytes),
+                      max_bytes=max_bytes, max_age=max_age or self.max_age)
+        with self._lock:
+            self._spools[binding_id] = spool
+        return spool
+
+    def discard(self, binding_id: str):
+        with self._lock:
+            spool = self._spools.pop(binding_id, None)
+        if spool is not None:
+            spool.discard()
+        else:
+            shutil.rmtree(self._binding_path(binding_id), ignore_errors=True)
+
+    def binding_ids(self) -> list:
+        return [unquote(name) for name in os.listdir(os.path.join(self.path, BINDINGS))]
+
+    def _binding_path(self, binding_id: str) -> str:
+        return os.path.join(self.path, BINDINGS, quote(binding_id, safe=""))
+
+    def add_state_source(self, source):
+        """
+        Register source, a callable returning the (key, state) pairs of the
+        subscriptions whose state changed, to be saved on every sync.
+        """
+        self._sources.append(source)
+
+    def load_state(self, key: tuple) -> dict:
+        try:
+            with open(self._state_path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.info("Failed to load the subscription state of %s: %s", key[0], e)
+            return None
+
+    def save_state(self, key: tuple, state: dict):
+        path = self._state_path(key)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def remove_state(self, key: tuple):
+        try:
+            os.remove(self._state_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _state_path(self, key: tuple) -> str:
+        digest = hashlib.sha1(json.dumps(list(key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, SUBSCRIPTIONS, digest + ".json")
+
+    def sync(self):
+        # the states are taken first, so that the sequence numbers saved never
+        # cover notifications which did not reach the disk yet
+        states = []
+        for source in self._sources:
+            try:
+                states.extend(source())
+            except Exception:
+                logger.exception("Failed to take the state of subscriptions")
+        with self._lock:
+            for binding_id, spool in list(self._spools.items()):
+                if spool.closed:
+                    self._spools.pop(binding_id)
+            spools = list(self._spools.values())
+        now = time.time()
+        for spool in spools:
+            try:
+                spool.expire(now)
+                spool.sync()
+            except (OSError, ValueError) as e:
+                logger.info("Failed to sync spool %s: %s", spool.directory, e)
+        for key, state in states:
+            try:
+                self.save_state(key, state)
+            except OSError as e:
+                logger.info("Failed to save the subscription state of %s: %s", key[0], e)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.fsync_interval):
+            self.sync()
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.sync()
+        with self._lock:
+            spools = list(self._spools.values())
+            self._spools = dict()
+        for spool in spools:
+            spool.close()
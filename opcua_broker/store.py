@@ -0,0 +1,221 @@
+import http.client
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import quote, urlparse
+
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(object):
+    """
+    Backend persisting broker state as JSON records grouped by kind.
+
+    Every record carries a small index dict which load_index returns on its
+    own, so a restarting broker can rebuild its registries without reading
+    the full records; those are fetched with load when first used.
+    """
+
+    def save(self, kind: str, key: str, record: dict, index: dict):
+        raise NotImplementedError()
+
+    def delete(self, kind: str, key: str):
+        raise NotImplementedError()
+
+    def load(self, kind: str, key: str) -> dict:
+        raise NotImplementedError()
+
+    def load_index(self, kind: str) -> list:
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PendingWrite(object):
+    def __init__(self, statement: str, args: tuple, **kwargs):
+        self.statement = statement
+        self.args = args
+        self.done = threading.Event()
+        self.error = None
+
+
+class SqliteStateStore(StateStore):
+    """
+    StateStore on a local SQLite database in WAL mode. WAL needs all
+    processes using the file on one host and a local filesystem, replicas
+    on other hosts go through a RemoteStateStore instead.
+
+    Writes from all threads are handed to a single writer thread which
+    commits whatever has queued up in one transaction (group commit). save
+    and delete return only once their transaction is durable, so the broker
+    never acknowledges state it could lose in a crash.
+    """
+
+    SAVE = "INSERT OR REPLACE INTO records (kind, id, idx, record) VALUES (?, ?, ?, ?)"
+    DELETE = "DELETE FROM records WHERE kind = ? AND id = ?"
+
+    def __init__(self,
+                 path: str,
+                 max_batch: int=512,
+                 **kwargs):
+        self.path = path
+        self.max_batch = max_batch
+        self._local = threading.local()
+        self._queue = queue.Queue()
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS records ("
+                     "kind TEXT NOT NULL, id TEXT NOT NULL, idx TEXT NOT NULL, record TEXT NOT NULL, "
+                     "PRIMARY KEY (kind, id)) WITHOUT ROWID")
+        conn.commit()
+
+        self._writer = threading.Thread(target=self._write_loop, name="opcua-state-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def save(self, kind: str, key: str, record: dict, index: dict):
+        self._write(self.SAVE, (kind, key, json.dumps(index), json.dumps(record)))
+
+    def delete(self, kind: str, key: str):
+        self._write(self.DELETE, (kind, key))
+
+    def load(self, kind: str, key: str) -> dict:
+        row = self._connection().execute("SELECT record FROM records WHERE kind = ? AND id = ?",
+                                         (kind, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_index(self, kind: str) -> list:
+        rows = self._connection().execute("SELECT id, idx FROM records WHERE kind = ?", (kind,))
+        return [(key, json.loads(index)) for key, index in rows]
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _write(self, statement: str, args: tuple):
+        pending = PendingWrite(statement, args)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            pending = self._queue.get()
+            if pending is None:
+                break
+            batch = [pending]
+            while len(batch) < self.max_batch:
+                try:
+                    pending = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending is None:
+                    self._queue.put(None)
+                    break
+                batch.append(pending)
+
+            error = None
+            try:
+                with conn:
+                    for pending in batch:
+                        conn.execute(pending.statement, pending.args)
+            except Exception as e:
+                logger.exception("Failed to commit %d state store writes", len(batch))
+                error = e
+            for pending in batch:
+                pending.error = error
+                pending.done.set()
+        conn.close()
+
+
+class RemoteStateStore(StateStore):
+    """
+    StateStore of a broker replica keeping its state in another one, the
+    replica owning the SQLite file, through the /opcua/state endpoints of
+    routes.get_state_blueprint. That replica is the only writer of the file.
+
+    Requests are retried for up to retry_timeout seconds while the replica
+    cannot be reached, such as while it restarts.
+    """
+
+    PATH = "/opcua/state"
+
+    def __init__(self,
+                 url: str,
+                 timeout: float=10,
+                 retry_timeout: float=30,
+                 retry_interval: float=0.5,
+                 **kwargs):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.retry_timeout = retry_timeout
+        self.retry_interval = retry_interval
+        self._location = urlparse(self.url)
+        self._local = threading.local()
+
+    def save(self, kind: str, key: str, record: dict, index: dict):
+        self._request("PUT", self._path(kind, key), dict(record=record, index=index))
+
+    def delete(self, kind: str, key: str):
+        self._request("DELETE", self._path(kind, key))
+
+    def load(self, kind: str, key: str) -> dict:
+        return self._request("GET", self._path(kind, key))
+
+    def load_index(self, kind: str) -> list:
+        return [(key, index) for key, index in self._request("GET", self._path(kind))]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+
+    def _path(self, kind: str, key: str=None) -> str:
+        path = "{0}{1}/{2}".format(self._location.path, self.PATH, quote(kind, safe=""))
+        if key is not None:
+            path += "?key=" + quote(key, safe="")
+        return path
+
+    def _request(self, method: str, path: str, body: dict=None):
+        deadline = time.time() + self.retry_timeout
+        while True:
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self._location.hostname, self._location.port,
+                                                                     timeout=self.timeout)
+            try:
+                conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                             headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self._local.conn = None
+                if time.time() >= deadline:
+                    raise OSError("state store at {0} is unavailable: {1}".format(self.url, e))
+                logger.info("State store at %s is unavailable, retrying: %s", self.url, e)
+                time.sleep(self.retry_interval)
+                continue
+            if response.status >= 300:
+                raise OSError("state store at {0} answered {1}: {2}".format(self.url, response.status,
+                                                                            data.decode("utf-8", "replace")))
+            return json.loads(data.decode("utf-8")) if data else None
@@ -0,0 +1,806 @@
+import base64
+import datetime
+import logging
+import threading
+import time
+
+from opcua import Node
+from opcua import ua
+from opcua.common import events
+from opcua.common.subscription import Subscription, SubscriptionItemData
+from opcua.ua.ua_binary import struct_from_binary
+
+from . import metrics
+from . import node_management
+from .buffer import RingBuffer
+from .pool import is_connected
+
+
+logger = logging.getLogger(__name__)
+
+DATA_CHANGE = "datachange"
+EVENTS = "events"
+
+
+def to_json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(v) for v in value]
+    # LocalizedTexts, NodeIds and QualifiedNames of either OPC UA client library
+    if hasattr(value, "Text"):
+        return value.Text
+    if hasattr(value, "to_string"):
+        return value.to_string()
+    return str(value)
+
+
+class BatchSubscription(Subscription):
+    """
+    Subscription which hands every DataChangeNotification or
+    EventNotificationList to its handler as one batch instead of calling it
+    once per monitored item, and tells it the sequence number of every
+    notification message it handled.
+
+    While held is a list, publish results are appended to it instead,
+    unhandled and unacknowledged, until release() handles them.
+    """
+
+    held = None
+
+    @classmethod
+    def resume(cls, server, params: ua.CreateSubscriptionParameters, handler, subscription_id: int):
+        """
+        The subscription subscription_id which was transferred to the session
+        of server, held until released.
+        """
+        # the attributes Subscription.__init__ sets, less creating a subscription
+        subscription = cls.__new__(cls)
+        subscription.logger = logging.getLogger(Subscription.__module__)
+        subscription.server = server
+        subscription._client_handle = 200
+        subscription._handler = handler
+        subscription.parameters = params
+        subscription._monitoreditems_map = dict()
+        subscription._lock = threading.Lock()
+        subscription.subscription_id = subscription_id
+        subscription.has_unknown_handlers = False
+        subscription.held = []
+        return subscription
+
+    def publish_callback(self, publishresult):
+        with self._lock:
+            if self.held is not None:
+                self.held.append(publishresult)
+                return
+        self._publish(publishresult)
+
+    def _publish(self, publishresult):
+        super().publish_callback(publishresult)
+        message = publishresult.NotificationMessage
+        if message.NotificationData:
+            self._handler.published(message.SequenceNumber)
+
+    def hold(self):
+        with self._lock:
+            if self.held is None:
+                self.held = []
+
+    def release(self):
+        # results arriving while the held ones are handled are held in turn,
+        # so they are handled in the order they arrived
+        while True:
+            with self._lock:
+                held = self.held
+                self.held = [] if held else None
+            if not held:
+                return
+            for publishresult in held:
+                self._publish(publishresult)
+
+    def notify(self, message: ua.NotificationMessage):
+        # a notification message republished by the server
+        for notification in message.NotificationData or ():
+            if isinstance(notification, ua.DataChangeNotification):
+                self._call_datachange(notification)
+            elif isinstance(notification, ua.EventNotificationList):
+                self._call_event(notification)
+        if message.NotificationData:
+            self._handler.published(message.SequenceNumber)
+
+    def _call_datachange(self, datachange):
+        with self._lock:
+            items = [(self._monitoreditems_map.get(item.ClientHandle), item) for item in datachange.MonitoredItems]
+        try:
+            self._handler.datachange_batch([(data, item) for data, item in items if data is not None])
+        except Exception:
+            self.logger.exception("Exception calling data change batch handler")
+
+    def _call_event(self, eventlist):
+        with self._lock:
+            items = [(self._monitoreditems_map.get(event.ClientHandle), event) for event in eventlist.Events]
+        try:
+            self._handler.event_batch([(data, event) for data, event in items if data is not None])
+        except Exception:
+            self.logger.exception("Exception calling event batch handler")
+
+    def delete_monitored_items(self, server_handles: list) -> list:
+        params = ua.DeleteMonitoredItemsParameters()
+        params.SubscriptionId = self.subscription_id
+        params.MonitoredItemIds = server_handles
+        results = self.server.delete_monitored_items(params)
+        deleted = set(server_handles)
+        with self._lock:
+            for client_handle, data in list(self._monitoreditems_map.items()):
+                if data.server_handle in deleted:
+                    del self._monitoreditems_map[client_handle]
+        return results
+
+
+class MonitoredItem(object):
+    def __init__(self, key: tuple, client_handle: int, **kwargs):
+        self.key = key
+        self.client_handle = client_handle
+        self.server_handle = None
+        self.subscribers = []
+
+
+class Subscriber(object):
+    def __init__(self, binding_id: str, kind: str, buffer: RingBuffer, pipeline=None, **kwargs):
+        self.binding_id = binding_id
+        self.kind = kind
+        self.buffer = buffer
+        self.pipeline = pipeline
+        self.group = None
+        self.item_keys = []
+
+
+class SubscriptionGroup(object):
+    """
+    One server-side subscription shared by every binding which monitors
+    nodes of the same endpoint at the same publishing interval.
+
+    Monitored items are keyed by what they monitor and reference counted by
+    their subscribers, so a node watched by fifty bindings is one monitored
+    item on the server. Each notification is decoded into a record once and
+    the same record object is appended to the buffer of every subscriber,
+    after the subscriber's pipeline if it has one.
+    """
+
+    def __init__(self, key: tuple, session, **kwargs):
+        self.key = key
+        self.session = session
+        self.subscription = None
+        self.items = dict()
+        self.subscribers = 0
+        self.ready = threading.Event()
+        self.error = None
+        # the last notification message handled, and whether it or the items
+        # changed since the state was last taken
+        self.sequence_number = 0
+        self._changed = False
+        # the sequence numbers a subscription taken over had available, until
+        # the notification messages not handled yet are republished
+        self.available = None
+        # subscribers whose pipelines have windows to close with every batch
+        self._windowed = []
+        self._items_by_handle = dict()
+        endpoint = metrics.endpoint_label(key[0])
+        self._received = dict((kind, metrics.NOTIFICATIONS.labels(endpoint, kind)) for kind in (DATA_CHANGE, EVENTS))
+        self._delivered = dict((kind, metrics.NOTIFICATIONS_DELIVERED.labels(endpoint, kind))
+                               for kind in (DATA_CHANGE, EVENTS))
+        # _lock guards the item maps and is all the notification callback takes;
+        # _mutate_lock serializes the monitored item service calls, which must
+        # never run under _lock as their responses arrive on the callback thread
+        self._lock = threading.Lock()
+        self._mutate_lock = threading.Lock()
+
+    def datachange_batch(self, items: list):
+        self._received[DATA_CHANGE].inc(len(items))
+        deliveries = dict()
+        with self._lock:
+            for data, item in items:
+                monitored_item = self._items_by_handle.get(data.client_handle)
+                if monitored_item is None:
+                    continue
+                value = item.Value
+                record = [monitored_item.key[1],
+                          to_json_value(value.Value.Value if value.Value is not None else None),
+                          to_json_value(value.SourceTimestamp),
+                          value.StatusCode.name]
+                for subscriber in monitored_item.subscribers:
+                    deliveries.setdefault(subscriber, []).append(record)
+        self._deliver(DATA_CHANGE, deliveries)
+
+    def event_batch(self, items: list):
+        self._received[EVENTS].inc(len(items))
+        deliveries = dict()
+        with self._lock:
+            for data, event in items:
+                monitored_item = self._items_by_handle.get(data.client_handle)
+                if monitored_item is None:
+                    continue
+                record = dict()
+                for clause, field in zip(data.mfilter.SelectClauses, event.EventFields):
+                    name = clause.BrowsePath[0].Name if clause.BrowsePath else clause.AttributeId.name
+                    record[name] = to_json_value(field.Value)
+                for subscriber in monitored_item.subscribers:
+                    deliveries.setdefault(subscriber, []).append(record)
+        self._deliver(EVENTS, deliveries)
+
+    def status_change_notification(self, status):
+        logger.warning("Subscription to %s changed status to %s", self.key[0], status)
+
+    def published(self, sequence_number: int):
+        with self._lock:
+            self.sequence_number = sequence_number
+            self._changed = True
+
+    def state(self, changed: bool=False) -> dict:
+        """
+        What a restarted broker needs to take the subscription over: its id,
+        the sequence number of the last notification message handled and
+        the monitored items. None if changed and nothing changed.
+        """
+        with self._lock:
+            if changed and not self._changed:
+                return None
+            self._changed = False
+            return dict(subscriptionId=self.subscription.subscription_id,
+                        sequenceNumber=self.sequence_number,
+                        items=[[list(key), item.client_handle, item.server_handle]
+                               for key, item in self.items.items()])
+
+    def restore(self, state: dict) -> list:
+        """
+        Monitor the data-change items of state, those of the subscription
+        this group took over, with nobody subscribed to them yet. Returns
+        the server handles of the other items, which cannot be restored.
+        """
+        others = []
+        with self._lock:
+            self.sequence_number = state["sequenceNumber"]
+            for key, client_handle, server_handle in state["items"]:
+                key = to_key(key)
+                if key[0] != DATA_CHANGE:
+                    others.append(server_handle)
+                    continue
+                monitored_item = MonitoredItem(key, client_handle)
+                monitored_item.server_handle = server_handle
+                self.items[key] = monitored_item
+                self._items_by_handle[client_handle] = monitored_item
+                data = SubscriptionItemData()
+                data.client_handle = client_handle
+                data.server_handle = server_handle
+                data.attribute = ua.AttributeIds.Value
+                with self.subscription._lock:
+                    self.subscription._monitoreditems_map[client_handle] = data
+                    self.subscription._client_handle = max(self.subscription._client_handle, client_handle)
+        return others
+
+    def _deliver(self, kind: str, deliveries: dict):
+        delivered = 0
+        now = time.time()
+        for subscriber in self._windowed:
+            deliveries.setdefault(subscriber, [])
+        for subscriber, records in deliveries.items():
+            if subscriber.pipeline is not None:
+                records = subscriber.pipeline.process(records, now)
+            if records:
+                subscriber.buffer.extend(records)
+                delivered += len(records)
+        self._delivered[kind].inc(delivered)
+
+    def _track(self, subscriber: Subscriber):
+        if subscriber.pipeline is not None and subscriber.pipeline.windowed:
+            self._windowed = self._windowed + [subscriber]
+
+    def _untrack(self, subscriber: Subscriber):
+        self._windowed = [s for s in self._windowed if s is not subscriber]
+
+    def add(self, subscriber: Subscriber, requests: list):
+        """
+        Add subscriber to the monitored items described by requests, a list of
+        (key, node_id, attribute_id, sampling_interval, queue_size, filter)
+        tuples, creating the items the group does not monitor yet.
+        """
+        client = self.session.client
+        with self._mutate_lock:
+            missing = []
+            with self._lock:
+                self._track(subscriber)
+                for request in requests:
+                    monitored_item = self.items.get(request[0])
+                    if monitored_item is not None:
+                        if subscriber in monitored_item.subscribers:
+                            continue
+                        monitored_item.subscribers.append(subscriber)
+                        subscriber.item_keys.append(request[0])
+                    elif request[0] not in (r[0] for r in missing):
+                        missing.append(request)
+
+            limit = node_management.get_operation_limits(client).get("MaxMonitoredItemsPerCall")
+            for chunk in node_management.chunked(missing, limit):
+                created = [MonitoredItem(key, None) for key, _, _, _, _, _ in chunk]
+                item_requests = []
+                for monitored_item, (key, node_id, attribute_id, sampling_interval, queue_size, mfilter) \
+                        in zip(created, chunk):
+                    request = monitored_item_request(self.subscription, node_id, attribute_id,
+                                                     sampling_interval, queue_size, mfilter)
+                    monitored_item.client_handle = request.RequestedParameters.ClientHandle
+                    monitored_item.subscribers.append(subscriber)
+                    item_requests.append(request)
+                # register before the call, the first notification may arrive
+                # before its response
+                with self._lock:
+                    for monitored_item in created:
+                        self._items_by_handle[monitored_item.client_handle] = monitored_item
+                try:
+                    with metrics.opcua_request(self.session.client, "CreateMonitoredItems"):
+                        results = self.subscription.create_monitored_items(item_requests)
+                except Exception:
+                    with self._lock:
+                        for monitored_item in created:
+                            self._items_by_handle.pop(monitored_item.client_handle, None)
+                    raise
+                with self._lock:
+                    for monitored_item, result in zip(created, results):
+                        if isinstance(result, ua.StatusCode):
+                            logger.warning("Failed to create monitored item for %s: %s",
+                                           monitored_item.key[1], result.name)
+                            self._items_by_handle.pop(monitored_item.client_handle)
+                            continue
+                        monitored_item.server_handle = result
+                        self.items[monitored_item.key] = monitored_item
+                        subscriber.item_keys.append(monitored_item.key)
+                        self._changed = True
+
+        subscriber.group = self
+        return len(subscriber.item_keys)
+
+    def remove(self, subscriber: Subscriber) -> int:
+        """
+        Drop subscriber from its monitored items and delete the items nobody
+        subscribes to any more. Returns the number of items left in the group.
+        """
+        with self._mutate_lock:
+            unused = []
+            with self._lock:
+                self._untrack(subscriber)
+                for key in subscriber.item_keys:
+                    monitored_item = self.items.get(key)
+                    if monitored_item is None:
+                        continue
+                    monitored_item.subscribers = [s for s in monitored_item.subscribers if s is not subscriber]
+                    if not monitored_item.subscribers:
+                        unused.append(self.items.pop(key))
+                        self._items_by_handle.pop(monitored_item.client_handle, None)
+                        self._changed = True
+                subscriber.item_keys = []
+                remaining = len(self.items)
+
+            if unused:
+                try:
+                    limit = node_management.get_operation_limits(self.session.client).get("MaxMonitoredItemsPerCall")
+                    for chunk in node_management.chunked([item.server_handle for item in unused], limit):
+                        self.subscription.delete_monitored_items(chunk)
+                except Exception as e:
+                    logger.info("Failed to delete %d monitored items on %s: %s", len(unused), self.key[0], e)
+        return remaining
+
+
+class SubscriptionManager(object):
+    """
+    Fan-out of OPC UA subscriptions to bindings.
+
+    Every (endpoint, security, publishing interval) gets one subscription
+    group on the endpoint's shared session, created with the first binding
+    and deleted with the last one.
+
+    With a spool_directory, data-change bindings subscribed with spool
+    options get a Spool rather than a RingBuffer, and the state of every
+    group is saved there. A group created for a key with a saved state
+    first tries to take over the subscription a previous broker left on
+    the server, and has the server republish what it did not acknowledge.
+    """
+
+    # whether groups are saved and resumed, which needs a python-opcua session
+    resumable = True
+
+    def __init__(self, session_pool, spool_directory=None, **kwargs):
+        self.session_pool = session_pool
+        self.spool_directory = spool_directory
+        self._groups = dict()
+        self._subscribers = dict()
+        self._lock = threading.Lock()
+        if spool_directory is not None and self.resumable:
+            spool_directory.add_state_source(self._group_states)
+
+    def spooled(self, kind: str, spool: dict=None) -> bool:
+        return spool is not None and kind == DATA_CHANGE and self.spool_directory is not None
+
+    def _buffer(self, binding_id: str, kind: str, url: str, capacity: int, spool: dict=None) -> RingBuffer:
+        dropped = subscription_dropped(url, kind)
+        if not self.spooled(kind, spool):
+            return RingBuffer(capacity, dropped)
+        return self.spool_directory.open(binding_id, capacity, dropped, **spool)
+
+    def subscribe(self, binding_id: str, kind: str, url: str, security: str=None,
+                  nodes: list=None, publishing_interval: float=500, sampling_interval: float=None,
+                  queue_size: int=0, event_types: list=None, capacity: int=10000,
+                  spool: dict=None, pipeline=None) -> RingBuffer:
+        if self.spooled(kind, spool):
+            # the spool of a binding subscribed again is only opened once the
+            # previous subscriber let go of it
+            self.unsubscribe(binding_id)
+        subscriber = Subscriber(binding_id, kind, self._buffer(binding_id, kind, url, capacity, spool), pipeline)
+        key = (url, security or "", publishing_interval)
+        try:
+            group = self._group(key)
+        except Exception:
+            # a spool left open would keep its segments mapped
+            subscriber.buffer.close()
+            raise
+        try:
+            if kind == DATA_CHANGE:
+                requests = []
+                for node in nodes:
+                    node_id = node_management.to_node_id(node)
+                    requests.append(((DATA_CHANGE, node_id.to_string(), sampling_interval, queue_size),
+                                     node_id, ua.AttributeIds.Value, sampling_interval, queue_size, None))
+            else:
+                source = node_management.to_node_id(nodes[0]) if nodes else ua.NodeId(ua.ObjectIds.Server)
+                type_ids = [node_management.to_node_id(event_type)
+                            for event_type in (event_types or [ua.ObjectIds.BaseEventType])]
+                mfilter = events.get_filter_from_event_type([Node(group.session.client.uaclient, type_id)
+                                                             for type_id in type_ids])
+                requests = [((EVENTS, source.to_string(), tuple(t.to_string() for t in type_ids), queue_size),
+                             source, ua.AttributeIds.EventNotifier, 0, queue_size, mfilter)]
+            if not group.add(subscriber, requests):
+                raise RuntimeError("none of the monitored items could be created")
+        except Exception:
+            self._remove(group, subscriber)
+            raise
+
+        with self._lock:
+            previous = self._subscribers.get(binding_id)
+            self._subscribers[binding_id] = subscriber
+        if previous is not None:
+            self._remove(previous.group, previous)
+        return subscriber.buffer
+
+    def unsubscribe(self, binding_id: str, discard: bool=False):
+        """
+        Stop feeding binding_id, deleting its spool too if discard.
+        """
+        with self._lock:
+            subscriber = self._subscribers.pop(binding_id, None)
+        if subscriber is not None:
+            self._remove(subscriber.group, subscriber)
+        if discard and self.spool_directory is not None:
+            self.spool_directory.discard(binding_id)
+
+    def buffer(self, binding_id: str) -> RingBuffer:
+        with self._lock:
+            subscriber = self._subscribers.get(binding_id)
+        return subscriber.buffer if subscriber is not None else None
+
+    def collect_metrics(self) -> list:
+        items, subscribers, depth, capacity = [], [], dict(), dict()
+        with self._lock:
+            for key, group in self._groups.items():
+                labels = dict(endpoint=metrics.endpoint_label(key[0]), publishing_interval=str(key[2]))
+                items.append((labels, len(group.items)))
+                subscribers.append((labels, group.subscribers))
+            for subscriber in self._subscribers.values():
+                labels = (metrics.endpoint_label(subscriber.group.key[0]) if subscriber.group is not None else "",
+                          subscriber.kind)
+                depth[labels] = depth.get(labels, 0) + len(subscriber.buffer)
+                capacity[labels] = capacity.get(labels, 0) + subscriber.buffer.capacity
+        return [("opcua_broker_subscription_groups", "gauge", "Shared OPC UA subscriptions", [(dict(), len(items))]),
+                ("opcua_broker_monitored_items", "gauge", "Monitored items of each shared OPC UA subscription", items),
+                ("opcua_broker_subscription_subscribers", "gauge", "Bindings fed by each shared OPC UA subscription",
+                 subscribers),
+                ("opcua_broker_binding_buffer_items", "gauge",
+                 "Notifications held in the buffers of bindings by endpoint and kind",
+                 [(dict(endpoint=endpoint, kind=kind), value) for (endpoint, kind), value in depth.items()]),
+                ("opcua_broker_binding_buffer_capacity", "gauge",
+                 "Capacity of the buffers of bindings by endpoint and kind",
+                 [(dict(endpoint=endpoint, kind=kind), value) for (endpoint, kind), value in capacity.items()])]
+
+    def binding_ids(self) -> list:
+        with self._lock:
+            return list(self._subscribers.keys())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict((key, dict(items=len(group.items), subscribers=group.subscribers))
+                        for key, group in self._groups.items())
+
+    def close(self):
+        """
+        Stop feeding every binding. With a spool_directory the subscriptions
+        are left on the servers for the next broker to take over: their
+        publish results are held unacknowledged from now on, so the server
+        republishes them then, and the sessions are closed without deleting
+        them.
+        """
+        if self.spool_directory is None or not self.resumable:
+            with self._lock:
+                subscribers = list(self._subscribers.values())
+            for subscriber in subscribers:
+                self.unsubscribe(subscriber.binding_id)
+            return
+
+        with self._lock:
+            groups = list(self._groups.values())
+            subscribers = list(self._subscribers.values())
+            self._groups = dict()
+            self._subscribers = dict()
+        for group in groups:
+            if group.subscription is not None:
+                group.subscription.hold()
+        states = [(group.key, group.state()) for group in groups if group.subscription is not None]
+        for subscriber in subscribers:
+            subscriber.buffer.close()
+        for key, state in states:
+            try:
+                self.spool_directory.save_state(key, state)
+            except OSError as e:
+                logger.info("Failed to save the subscription state of %s: %s", key[0], e)
+        for group in groups:
+            if group.session is not None:
+                group.session.keep_subscriptions = True
+                self.session_pool.release_shared(group.session)
+
+    def drop_broken(self) -> list:
+        """
+        Drop the groups whose session lost its connection, ending the streams
+        of their bindings. With a spool_directory their state is saved
+        first, so that subscribing the bindings again takes their
+        subscriptions over once the server is reachable. Returns the ids of
+        the bindings dropped.
+        """
+        with self._lock:
+            broken = [group for group in self._groups.values()
+                      if group.ready.is_set() and group.session is not None and not is_connected(group.session.client)]
+            for group in broken:
+                self._groups.pop(group.key)
+            subscribers = [subscriber for subscriber in self._subscribers.values() if subscriber.group in broken]
+            for subscriber in subscribers:
+                self._subscribers.pop(subscriber.binding_id)
+        for group in broken:
+            logger.warning("Lost the connection of the subscription to %s", group.key[0])
+            if self.spool_directory is not None and self.resumable and group.subscription is not None:
+                try:
+                    self.spool_directory.save_state(group.key, group.state())
+                except OSError as e:
+                    logger.info("Failed to save the subscription state of %s: %s", group.key[0], e)
+            group.session.broken = True
+            self.session_pool.release_shared(group.session)
+        for subscriber in subscribers:
+            subscriber.buffer.close()
+        return [subscriber.binding_id for subscriber in subscribers]
+
+    def _group_states(self) -> list:
+        with self._lock:
+            groups = list(self._groups.values())
+        states = []
+        for group in groups:
+            if group.ready.is_set() and group.subscription is not None:
+                state = group.state(changed=True)
+                if state is not None:
+                    states.append((group.key, state))
+        return states
+
+    def _group(self, key: tuple) -> SubscriptionGroup:
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = SubscriptionGroup(key, None)
+                leader = True
+            else:
+                leader = False
+            group.subscribers += 1
+        if not leader:
+            group.ready.wait()
+            if group.error is not None:
+                raise group.error
+            return group
+
+        try:
+            group.session = self.session_pool.acquire_shared(key[0], key[1] or None)
+            if not self._resume(group):
+                group.subscription = BatchSubscription(group.session.client.uaclient,
+                                                       subscription_parameters(key[2]), group)
+        except Exception as e:
+            group.error = e
+            with self._lock:
+                if self._groups.get(key) is group:
+                    self._groups.pop(key)
+            if group.session is not None:
+                self.session_pool.release_shared(group.session)
+            raise
+        finally:
+            group.ready.set()
+        return group
+
+    def _resume(self, group: SubscriptionGroup) -> bool:
+        """
+        Take over the subscription of group.key a previous broker left on
+        the server, if any: transfer it to the group's session and monitor
+        its data-change items again. Its notifications are held until
+        finish_resumes(), so that the bindings subscribing again meanwhile
+        get those the server republishes too.
+        """
+        state = self.spool_directory.load_state(group.key) if self.spool_directory is not None else None
+        if not state or not self.resumable:
+            return False
+        client = group.session.client
+        subscription_id = state["subscriptionId"]
+        group.subscription = BatchSubscription.resume(client.uaclient, subscription_parameters(group.key[2]), group,
+                                                      subscription_id)
+        others = group.restore(state)
+        # publish results of the subscription may arrive as soon as it is
+        # transferred, where they are held
+        client.uaclient._publishcallbacks[subscription_id] = group.subscription.publish_callback
+        try:
+            group.available = transfer_subscription(client, subscription_id)
+        except Exception as e:
+            client.uaclient._publishcallbacks.pop(subscription_id, None)
+            group.subscription = None
+            group.sequence_number = 0
+            group.items = dict()
+            group._items_by_handle = dict()
+            self.spool_directory.remove_state(group.key)
+            logger.warning("Failed to take over subscription %d on %s, what it published since is lost: %s",
+                           subscription_id, group.key[0], e)
+            return False
+        if others:
+            try:
+                group.subscription.delete_monitored_items(others)
+            except Exception as e:
+                logger.info("Failed to delete %d monitored items on %s: %s", len(others), group.key[0], e)
+        return True
+
+    def finish_resumes(self):
+        """
+        Have the servers republish the notification messages of the
+        subscriptions taken over which were not handled yet, hand them to
+        the bindings subscribed by now, then the notifications held since,
+        and start publishing again.
+        """
+        resumes = []
+        with self._lock:
+            for group in self._groups.values():
+                if group.ready.is_set() and group.available is not None:
+                    resumes.append((group, group.available))
+                    group.available = None
+        for group, available in resumes:
+            client = group.session.client
+            subscription = group.subscription
+            subscription_id = subscription.subscription_id
+            republished = [n for n in sorted(available) if n > group.sequence_number]
+            for sequence_number in republished:
+                try:
+                    subscription.notify(republish(client, subscription_id, sequence_number))
+                except Exception as e:
+                    logger.warning("Notification message %d of subscription %d on %s is lost: %s",
+                                   sequence_number, subscription_id, group.key[0], e)
+            acks = []
+            for sequence_number in available:
+                ack = ua.SubscriptionAcknowledgement()
+                ack.SubscriptionId = subscription_id
+                ack.SequenceNumber = sequence_number
+                acks.append(ack)
+            subscription.release()
+            # the two publish requests Subscription.__init__ sends for a new one
+            try:
+                client.uaclient.publish(acks)
+                client.uaclient.publish()
+            except Exception as e:
+                logger.info("Failed to publish on %s: %s", group.key[0], e)
+            logger.info("Took over subscription %d on %s with %d items, %d notification messages republished",
+                        subscription_id, group.key[0], len(group.items), len(republished))
+
+    def _remove(self, group: SubscriptionGroup, subscriber: Subscriber):
+        subscriber.buffer.close()
+        group.remove(subscriber)
+        with self._lock:
+            group.subscribers -= 1
+            if group.subscribers:
+                return
+            if self._groups.get(group.key) is group:
+                self._groups.pop(group.key)
+        # the last subscriber of the group is gone, deleting the subscription
+        # also deletes whatever monitored items are left on the server
+        try:
+            if group.subscription is not None and group.subscription.subscription_id:
+                group.subscription.delete()
+        except Exception as e:
+            logger.info("Failed to delete subscription on %s: %s", group.key[0], e)
+        finally:
+            if self.spool_directory is not None and self.resumable:
+                self.spool_directory.remove_state(group.key)
+            if group.session is not None:
+                self.session_pool.release_shared(group.session)
+
+
+def to_key(value):
+    # the key of a monitored item from its JSON, lists back to tuples
+    if isinstance(value, list):
+        return tuple(to_key(v) for v in value)
+    return value
+
+
+def transfer_subscription(client, subscription_id: int) -> list:
+    """
+    Transfer subscription_id from the session it was created on to that of
+    client, without having the current values of its items sent again.
+    Returns the sequence numbers of the notification messages the server
+    still holds because they were not acknowledged.
+    """
+    request = ua.TransferSubscriptionsRequest()
+    request.Parameters.SubscriptionIds = [subscription_id]
+    request.Parameters.SendInitialValues = False
+    with metrics.opcua_request(client, "TransferSubscriptions"):
+        data = client.uaclient._uasocket.send_request(request)
+    response = struct_from_binary(ua.TransferSubscriptionsResponse, data)
+    response.ResponseHeader.ServiceResult.check()
+    result = response.Parameters.Results[0]
+    result.StatusCode.check()
+    return list(result.AvailableSequenceNumbers)
+
+
+def republish(client, subscription_id: int, sequence_number: int) -> ua.NotificationMessage:
+    request = ua.RepublishRequest()
+    request.Parameters.SubscriptionId = subscription_id
+    request.Parameters.RetransmitSequenceNumber = sequence_number
+    with metrics.opcua_request(client, "Republish"):
+        data = client.uaclient._uasocket.send_request(request)
+    response = struct_from_binary(ua.RepublishResponse, data)
+    response.ResponseHeader.ServiceResult.check()
+    return response.NotificationMessage
+
+
+def subscription_dropped(url: str, kind: str):
+    return metrics.NOTIFICATIONS_DROPPED.labels(metrics.endpoint_label(url), kind)
+
+
+def subscription_parameters(publishing_interval: float) -> ua.CreateSubscriptionParameters:
+    params = ua.CreateSubscriptionParameters()
+    params.RequestedPublishingInterval = publishing_interval
+    params.RequestedLifetimeCount = 10000
+    params.RequestedMaxKeepAliveCount = 3000
+    params.MaxNotificationsPerPublish = 0
+    params.PublishingEnabled = True
+    params.Priority = 0
+    return params
+
+
+def monitored_item_request(subscription: Subscription, node_id: ua.NodeId, attribute_id: int,
+                           sampling_interval: float=None, queue_size: int=0,
+                           mfilter=None) -> ua.MonitoredItemCreateRequest:
+    rv = ua.ReadValueId()
+    rv.NodeId = node_id
+    rv.AttributeId = attribute_id
+    mparams = ua.MonitoringParameters()
+    with subscription._lock:
+        subscription._client_handle += 1
+        mparams.ClientHandle = subscription._client_handle
+    if sampling_interval is None:
+        sampling_interval = subscription.parameters.RequestedPublishingInterval
+    mparams.SamplingInterval = sampling_interval
+    mparams.QueueSize = queue_size
+    mparams.DiscardOldest = True
+    if mfilter is not None:
+        mparams.Filter = mfilter
+    request = ua.MonitoredItemCreateRequest()
+    request.ItemToMonitor = rv
+    request.MonitoringMode = ua.MonitoringMode.Reporting
+    request.RequestedParameters = mparams
+    return request
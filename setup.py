@@ -1,6 +1,12 @@
 from setuptools import setup, find_packages
 
-install_requires = ["opcua", "flask", "openbrokerapi"]
+# the broker uses the 2.x api of openbrokerapi (errors.ServiceExeption,
+# api.get_blueprint(broker, credentials, logger)), which 1.x and 3.x changed
+install_requires = ["opcua", "flask", "openbrokerapi>=2,<3", "python-dateutil"]
+
+# asynccontextmanager needs 3.7, and openbrokerapi 2.0 imports
+# collections.Iterable, which 3.10 removed
+python_requires = ">=3.7,<3.10"
 
 setup(name="opcua-broker",
       version="0.0.1",
@@ -8,12 +14,16 @@ setup(name="opcua-broker",
       author="Leon Wang",
       author_email="wanghui71leon@gmail.com",
       url='https://github.com/leonwanghui/opcua-broker.git',
-      packages=find_packages(),
+      packages=find_packages(exclude=["tests", "tests.*"]),
+      package_data={"opcua_broker": ["plans.json"]},
       provides=["opcua"],
       license="Apache-2.0",
+      python_requires=python_requires,
       install_requires=install_requires,
       extras_require={
-          'encryption': ['cryptography']
+          'encryption': ['cryptography'],
+          'msgpack': ['msgpack'],
+          'asyncio': ['asyncua', 'uvicorn']
       },
       classifiers=["Programming Language :: Python",
                    "Programming Language :: Python :: 3",
@@ -23,6 +33,8 @@ setup(name="opcua-broker",
                    "License :: OSI Approved :: Apache-2.0",
                    "Topic :: Software Development :: Libraries :: Python Modules",
                    ],
-      entry_points={}
+      entry_points={
+          'console_scripts': ['opcua-broker = opcua_broker.broker:main']
+      }
       )
 
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+
+@pytest.fixture(scope="session")
+def standin():
+    """
+    The stand-in OPC UA server of the benchmarks, shared by the tests which
+    talk to a server; they add nodes of their own below Objects.
+    """
+    from standin import StandInServer
+
+    server = StandInServer(port=int(os.environ.get("OPCUA_BROKER_TEST_PORT", 4870)), nodes=10)
+    server.start()
+    yield server
+    server.stop()
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+from openbrokerapi.service_broker import ProvisionDetails
+
+from opcua_broker import catalog
+from opcua_broker.broker import AsyncOpcuaServiceBroker, OpcuaServiceBroker
+from opcua_broker.handler import OpcuaHandler
+from opcua_broker.operations import OperationTable
+from opcua_broker.validation import InvalidParameters
+
+
+SERVICE_ID = "00000000-0000-0000-0000-000000000000"
+NODE_MANAGEMENT_PLAN = "00000000-0000-0000-0000-000000000002"
+REFERENCE_MANAGEMENT_PLAN = "00000000-0000-0000-0000-000000000003"
+# nothing listens there, provisioning must fail before connecting
+URL = "opc.tcp://127.0.0.1:9"
+
+
+@pytest.fixture
+def operation_table():
+    return OperationTable(max_workers=1)
+
+
+@pytest.fixture
+def service_broker(operation_table):
+    return OpcuaServiceBroker(OpcuaHandler(URL), operation_table)
+
+
+def details(plan_id: str, parameters: dict) -> ProvisionDetails:
+    return ProvisionDetails(SERVICE_ID, plan_id, "org-guid", "space-guid", parameters)
+
+
+def test_plans_are_the_ones_tested():
+    service_catalog = catalog.Catalog.load()
+    assert service_catalog.kind(NODE_MANAGEMENT_PLAN) == catalog.NODE_MANAGEMENT
+    assert service_catalog.kind(REFERENCE_MANAGEMENT_PLAN) == catalog.REFERENCE_MANAGEMENT
+
+
+@pytest.mark.parametrize("async_allowed", [False, True])
+def test_invalid_node_ids_are_rejected_before_accepting(service_broker, operation_table, async_allowed):
+    parameters = dict(url=URL, nodesToAdd=[dict(parentNodeId="i=85", requestedNewNodeId="ns=2;s=x;y",
+                                                 browseName="2:A")])
+    with pytest.raises(InvalidParameters) as e:
+        service_broker.provision("abc", details(NODE_MANAGEMENT_PLAN, parameters), async_allowed)
+    assert e.value.errors == ["nodesToAdd[0]: invalid node id 'ns=2;s=x;y'"]
+    assert not operation_table._operations
+
+
+def test_duplicate_requested_node_ids_are_rejected_before_accepting(service_broker):
+    parameters = dict(url=URL, nodesToAdd=[
+        dict(parentNodeId="i=85", requestedNewNodeId="ns=2;s=A", browseName="2:A"),
+        dict(parentNodeId="i=85", requestedNewNodeId="ns=2;s=A", browseName="2:B")])
+    with pytest.raises(InvalidParameters) as e:
+        service_broker.provision("abc", details(NODE_MANAGEMENT_PLAN, parameters), True)
+    assert e.value.errors == ["nodesToAdd[1]: requestedNewNodeId ns=2;s=A is requested by nodesToAdd[0] as well"]
+
+
+def test_invalid_references_are_rejected_before_accepting(service_broker):
+    parameters = dict(url=URL, referencesToAdd=[dict(sourceNodeId="i=85", targetNodeId="bogus")])
+    with pytest.raises(InvalidParameters) as e:
+        service_broker.provision("abc", details(REFERENCE_MANAGEMENT_PLAN, parameters), True)
+    assert e.value.errors == ["referencesToAdd[0]: invalid node id 'bogus'"]
+
+
+def test_valid_node_specs_are_provisioned_in_the_background(service_broker, operation_table):
+    parameters = dict(url=URL, nodesToAdd=[dict(parentNodeId="i=85", browseName="2:A")])
+    spec = service_broker.provision("abc", details(NODE_MANAGEMENT_PLAN, parameters), True)
+    assert spec.operation
+    # the server is not there, so the operation itself fails
+    operation_table._executor.shutdown(wait=True)
+    assert operation_table.get("abc", spec.operation).state.value == "failed"
+
+
+def test_asyncio_mode_rejects_invalid_node_specs_before_accepting(operation_table):
+    service_broker = AsyncOpcuaServiceBroker(OpcuaHandler(URL), operation_table)
+    parameters = dict(url=URL, nodesToAdd=[dict(parentNodeId="i=85", browseName="2:A{i}", repeat=2,
+                                                 children=[dict(browseName="A{i}:B")])])
+    with pytest.raises(InvalidParameters) as e:
+        asyncio.run(service_broker.provision("abc", details(NODE_MANAGEMENT_PLAN, parameters), True))
+    assert e.value.errors == ["nodesToAdd[0](i=0).children[0](i=0): invalid browse name 'A0:B'",
+                              "nodesToAdd[0](i=1).children[0](i=1): invalid browse name 'A1:B'"]
@@ -0,0 +1,67 @@
+import json
+
+import flask
+import pytest
+
+from opcua_broker import catalog, routes
+
+
+HEADERS = {"X-Broker-Api-Version": "2.13"}
+
+
+@pytest.fixture(scope="module")
+def service_catalog():
+    return catalog.Catalog.load()
+
+
+@pytest.fixture
+def client(service_catalog):
+    app = flask.Flask(__name__)
+    app.register_blueprint(routes.get_catalog_blueprint(service_catalog))
+
+    @app.route("/v2/catalog", methods=["GET", "POST"])
+    def fallback():
+        return "fallback"
+    return app.test_client()
+
+
+def test_catalog_is_answered_from_the_cached_body(client, service_catalog):
+    first = client.get("/v2/catalog", headers=HEADERS)
+    assert first.status_code == 200
+    assert first.mimetype == "application/json"
+    assert first.get_data() == service_catalog.body
+    assert [service["id"] for service in json.loads(first.get_data())["services"]] == [service_catalog.service.id]
+    second = client.get("/v2/catalog", headers=HEADERS)
+    assert second.get_data() == first.get_data()
+    assert second.headers["ETag"] == first.headers["ETag"] == service_catalog.etag
+
+
+def test_etag_is_stable_across_loads(service_catalog):
+    other = catalog.Catalog.load()
+    assert other.body == service_catalog.body
+    assert other.etag == service_catalog.etag
+
+
+def test_if_none_match(client, service_catalog):
+    etag = service_catalog.etag
+    for if_none_match in (etag, "W/" + etag, '"other", ' + etag, "*"):
+        response = client.get("/v2/catalog", headers=dict(HEADERS, **{"If-None-Match": if_none_match}))
+        assert response.status_code == 304
+        assert response.get_data() == b""
+        assert response.headers["ETag"] == etag
+    response = client.get("/v2/catalog", headers=dict(HEADERS, **{"If-None-Match": '"other"'}))
+    assert response.status_code == 200
+    assert response.get_data() == service_catalog.body
+
+
+def test_api_version(client):
+    response = client.get("/v2/catalog")
+    assert response.status_code == 400
+    assert response.get_json() == dict(description="No X-Broker-Api-Version found.")
+    response = client.get("/v2/catalog", headers={"X-Broker-Api-Version": "2.12"})
+    assert response.status_code == 412
+    assert client.get("/v2/catalog", headers={"X-Broker-Api-Version": "2.14"}).status_code == 200
+
+
+def test_other_requests_pass_through(client):
+    assert client.post("/v2/catalog", headers=HEADERS).get_data() == b"fallback"
@@ -0,0 +1,126 @@
+from opcua_broker.cluster import FORWARDED_HEADER, Cluster, HashRing
+from opcua_broker.store import SqliteStateStore
+
+
+KEYS = ["opc.tcp://server-{0}:4840".format(i) for i in range(2000)]
+MEMBERS = ["http://broker-{0}:5000".format(i) for i in range(4)]
+
+
+def owners(ring: HashRing) -> dict:
+    return dict((key, ring.owner(key)) for key in KEYS)
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing().owner("opc.tcp://server:4840") is None
+
+
+def test_single_member_owns_everything():
+    ring = HashRing([MEMBERS[0]])
+    assert set(owners(ring).values()) == {MEMBERS[0]}
+
+
+def test_ownership_does_not_depend_on_member_order():
+    ring = HashRing(MEMBERS)
+    assert ring.members == tuple(sorted(MEMBERS))
+    assert owners(HashRing(list(reversed(MEMBERS)) + [MEMBERS[0]])) == owners(ring)
+
+
+def test_keys_spread_over_all_members():
+    counts = dict((member, 0) for member in MEMBERS)
+    for owner in owners(HashRing(MEMBERS)).values():
+        counts[owner] += 1
+    fair = len(KEYS) / len(MEMBERS)
+    assert all(fair / 2 < count < fair * 2 for count in counts.values())
+
+
+def test_joining_member_only_takes_keys():
+    before = owners(HashRing(MEMBERS[:3]))
+    after = owners(HashRing(MEMBERS))
+    moved = [key for key in KEYS if before[key] != after[key]]
+    # keys only ever move to the new member, about a quarter of them
+    assert all(after[key] == MEMBERS[3] for key in moved)
+    assert len(KEYS) / 8 < len(moved) < len(KEYS) / 2
+
+
+def test_leaving_member_only_gives_its_keys():
+    before = owners(HashRing(MEMBERS))
+    after = owners(HashRing(MEMBERS[1:]))
+    for key in KEYS:
+        if before[key] != MEMBERS[0]:
+            assert after[key] == before[key]
+        else:
+            assert after[key] in MEMBERS[1:]
+
+
+def test_replicas_agree_and_rebalance(tmp_path):
+    store = SqliteStateStore(str(tmp_path / "state.db"))
+    try:
+        first = Cluster(MEMBERS[0], store)
+        second = Cluster(MEMBERS[1], store)
+        rebalanced = []
+        first.add_listener(rebalanced.append)
+
+        first.heartbeat()
+        assert not first.refresh()
+        assert first.members() == (MEMBERS[0],)
+        for key in KEYS[:10]:
+            first.assign(key, key)
+        assert all(first.owns_instance(key) for key in KEYS[:10])
+
+        second.heartbeat()
+        assert first.refresh()
+        second.refresh()
+        assert first.members() == second.members() == tuple(MEMBERS[:2])
+        assert rebalanced == [first.owns_instance]
+        # the partition keys are shared through the store, so both place
+        # every instance on the same replica
+        for key in KEYS[:10]:
+            assert first.owns_instance(key) != second.owns_instance(key)
+
+        second.stop()
+        assert first.refresh()
+        assert first.members() == (MEMBERS[0],)
+        assert len(rebalanced) == 2
+        assert all(first.owns_instance(key) for key in KEYS[:10])
+    finally:
+        store.close()
+
+
+def test_expired_replicas_leave_the_ring(tmp_path):
+    store = SqliteStateStore(str(tmp_path / "state.db"))
+    try:
+        store.save(Cluster.REPLICA, MEMBERS[1], dict(url=MEMBERS[1], seen=0), dict(seen=0))
+        cluster = Cluster(MEMBERS[0], store, member_ttl=10)
+        cluster.heartbeat()
+        cluster.refresh()
+        assert cluster.members() == (MEMBERS[0],)
+        # long expired heartbeats are removed from the store as well
+        assert store.load(Cluster.REPLICA, MEMBERS[1]) is None
+    finally:
+        store.close()
+
+
+def test_route_to_owner(tmp_path):
+    store = SqliteStateStore(str(tmp_path / "state.db"))
+    try:
+        first = Cluster(MEMBERS[0], store)
+        second = Cluster(MEMBERS[1], store)
+        for cluster in (first, second):
+            cluster.heartbeat()
+        for cluster in (first, second):
+            cluster.refresh()
+
+        url = next(key for key in KEYS if first.owner(key) == MEMBERS[1])
+        body = b'{"parameters": {"url": "%s"}}' % url.encode("utf-8")
+        assert first.route("PUT", "/v2/service_instances/abc", dict(), body) == MEMBERS[1]
+        assert second.route("PUT", "/v2/service_instances/abc", dict(), body) is None
+        # later requests find the partition key the instance was assigned
+        assert first.route("GET", "/v2/service_instances/abc/last_operation", dict()) == MEMBERS[1]
+        assert first.route("GET", "/v2/service_instances/abc/last_operation", {FORWARDED_HEADER: MEMBERS[1]}) is None
+
+        store.save("binding", "b1", dict(instance_id="abc"), dict(instance_id="abc"))
+        assert first.route("GET", "/opcua/bindings/b1/stream", dict()) == MEMBERS[1]
+        assert first.route("GET", "/opcua/bindings/unknown/stream", dict()) is None
+        assert first.route("GET", "/v2/catalog", dict()) is None
+    finally:
+        store.close()
@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+from opcua_broker import discovery
+from opcua_broker.discovery import DiscoveryCache
+
+
+class Clock(object):
+    """
+    Stands in for the time module of discovery: time() is advanced by the
+    test, and sleep() of the refresher returns only for each tick().
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self._ticks = threading.Semaphore(0)
+        self._sleeping = threading.Semaphore(0)
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self._sleeping.release()
+        self._ticks.acquire()
+
+    def tick(self):
+        # lets the refresher run one round and waits for it to finish
+        assert self._sleeping.acquire(timeout=5)
+        self._ticks.release()
+        assert self._sleeping.acquire(timeout=5)
+        self._sleeping.release()
+
+    def stop(self):
+        # lets the refresher of a closed cache return from sleep and exit
+        self._ticks.release()
+
+
+class Fetch(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, url: str):
+        self.calls.append(url)
+        return "{0}#{1}".format(url, len(self.calls))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(discovery, "time", clock)
+    return clock
+
+
+def test_entries_expire_after_ttl(clock):
+    fetch = Fetch()
+    cache = DiscoveryCache(fetch, ttl=10)
+    assert cache.get(("a",)) == "a#1"
+    clock.now += 9.9
+    assert cache.get(("a",)) == "a#1"
+    clock.now += 0.1
+    assert cache.get(("a",)) == "a#2"
+    cache.invalidate(("a",))
+    assert cache.get(("a",)) == "a#3"
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    fetch = Fetch()
+    cache = DiscoveryCache(fetch, max_entries=2)
+    cache.get(("a",))
+    cache.get(("b",))
+    cache.get(("a",))
+    cache.get(("c",))
+    assert fetch.calls == ["a", "b", "c"]
+    cache.get(("a",))
+    cache.get(("b",))
+    assert fetch.calls == ["a", "b", "c", "b"]
+
+
+def test_concurrent_misses_share_one_fetch(clock):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(url: str):
+        calls.append(url)
+        started.set()
+        release.wait(5)
+        if len(calls) == 1:
+            raise ConnectionError("no server at {0}".format(url))
+        return url
+
+    cache = DiscoveryCache(fetch)
+    results = []
+
+    def get():
+        try:
+            results.append(cache.get(("a",)))
+        except ConnectionError as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=get) for _ in range(5)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # the others wait for the fetch in flight rather than starting their own
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == ["a"]
+    assert len(results) == 5
+    assert len(set(map(id, results))) == 1
+    # a failed fetch is not cached
+    assert cache.get(("a",)) == "a"
+
+
+def test_used_entries_are_refreshed_in_the_background(clock):
+    fetch = Fetch()
+    cache = DiscoveryCache(fetch, ttl=30, refresh_interval=10)
+    try:
+        assert cache.get(("used",)) == "used#1"
+        assert cache.get(("unused",)) == "unused#2"
+        clock.now += 5
+        cache.get(("used",))
+        clock.tick()
+        # neither expires within the next 10s yet
+        assert fetch.calls == ["used", "unused"]
+
+        clock.now += 20
+        clock.tick()
+        assert fetch.calls == ["used", "unused", "used"]
+        clock.now += 10
+        assert cache.get(("used",)) == "used#3"
+        assert cache.get(("unused",)) == "unused#4"
+    finally:
+        cache.close()
+        clock.stop()
+
+
+def test_failed_background_refresh_keeps_the_entry(clock):
+    fetch = Fetch()
+    cache = DiscoveryCache(fetch, ttl=30, refresh_interval=10)
+    try:
+        cache.get(("a",))
+        clock.now += 1
+        cache.get(("a",))
+
+        def failing_fetch(url: str):
+            raise ConnectionError("no server at {0}".format(url))
+        cache.fetch = failing_fetch
+        clock.now += 20
+        clock.tick()
+        assert cache.get(("a",)) == "a#1"
+    finally:
+        cache.close()
+        clock.stop()
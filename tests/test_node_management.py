@@ -0,0 +1,309 @@
+import asyncio
+import itertools
+
+import pytest
+from opcua import Client, ua
+
+from opcua_broker import aio, node_management
+from opcua_broker.handler import OpcuaHandler
+from opcua_broker.pool import SessionPool
+from opcua_broker.node_management import METHOD_NODE_CLASS, OBJECT_NODE_CLASS, VARIABLE_NODE_CLASS, NodeTree
+from opcua_broker.validation import InvalidParameters
+
+
+OBJECTS = "i=85"
+
+# every test adds nodes of its own to the shared stand-in server
+names = ("Test{0}".format(i) for i in itertools.count())
+
+
+def tree_errors(nodes_to_add, **kwargs) -> list:
+    with pytest.raises(InvalidParameters) as e:
+        NodeTree(nodes_to_add, **kwargs)
+    return e.value.errors
+
+
+def test_nested_children_are_levels():
+    tree = NodeTree([dict(parentNodeId=OBJECTS, browseName="2:Line", children=[
+        dict(browseName="2:Machine", nodeClass=OBJECT_NODE_CLASS, children=[
+            dict(browseName="2:Speed", nodeClass=VARIABLE_NODE_CLASS, value=1.5)])])])
+    assert tree.names == ["2:Line", "2:Machine", "2:Speed"]
+    assert tree.parents == [None, 0, 1]
+    assert tree.levels == [[0], [1], [2]]
+    assert tree.items[0].ParentNodeId == ua.NodeId(ua.ObjectIds.ObjectsFolder)
+    assert tree.items[0].TypeDefinition == ua.NodeId(ua.ObjectIds.FolderType)
+    assert tree.items[2].NodeAttributes.DataType == ua.NodeId(ua.ObjectIds.Double)
+
+
+def test_requested_node_ids_order_specs_given_out_of_order():
+    tree = NodeTree([
+        dict(parentNodeId="ns=2;s=Machine", browseName="2:Speed", nodeClass=VARIABLE_NODE_CLASS, value=0),
+        dict(parentNodeId="ns=2;s=Line", requestedNewNodeId="ns=2;s=Machine", browseName="2:Machine"),
+        dict(parentNodeId=OBJECTS, requestedNewNodeId="ns=2;s=Line", browseName="2:Line")])
+    assert tree.parents == [1, 2, None]
+    assert tree.levels == [[2], [1], [0]]
+
+
+def test_parents_outside_the_tree_are_roots():
+    tree = NodeTree([dict(parentNodeId="ns=2;s=Elsewhere", browseName="2:A"),
+                     dict(parentNodeId=OBJECTS, browseName="2:B")])
+    assert tree.levels == [[0, 1]]
+
+
+def test_duplicate_requested_node_ids():
+    assert tree_errors([
+        dict(parentNodeId=OBJECTS, requestedNewNodeId="ns=2;s=A", browseName="2:A"),
+        dict(parentNodeId=OBJECTS, browseName="2:B", children=[
+            dict(requestedNewNodeId="ns=2;s=A", browseName="2:C")])]) == [
+        "nodesToAdd[1].children[0]: requestedNewNodeId ns=2;s=A is requested by nodesToAdd[0] as well"]
+
+
+def test_invalid_ids_are_all_reported():
+    assert tree_errors([
+        dict(parentNodeId=OBJECTS, requestedNewNodeId="ns=2;s=x;y", browseName="2:A"),
+        dict(parentNodeId="bogus", browseName="2:B"),
+        dict(parentNodeId=OBJECTS, browseName="2:C", dataType="NoSuchType", nodeClass=VARIABLE_NODE_CLASS),
+        dict(parentNodeId=OBJECTS, browseName="x:D"),
+        "E"]) == [
+        "nodesToAdd[0]: invalid node id 'ns=2;s=x;y'",
+        "nodesToAdd[1]: invalid node id 'bogus'",
+        "nodesToAdd[2]: invalid node id 'NoSuchType'",
+        "nodesToAdd[3]: invalid browse name 'x:D'",
+        "nodesToAdd[4]: expected object"]
+
+
+def test_cycles():
+    assert tree_errors([
+        dict(parentNodeId="ns=2;s=B", requestedNewNodeId="ns=2;s=A", browseName="2:A"),
+        dict(parentNodeId="ns=2;s=C", requestedNewNodeId="ns=2;s=B", browseName="2:B"),
+        dict(parentNodeId="ns=2;s=A", requestedNewNodeId="ns=2;s=C", browseName="2:C")]) == [
+        "nodesToAdd[0]: is its own ancestor"]
+    assert tree_errors([dict(parentNodeId="ns=2;s=A", requestedNewNodeId="ns=2;s=A", browseName="2:A")]) == [
+        "nodesToAdd[0]: is its own ancestor"]
+
+
+def test_repeat():
+    tree = NodeTree([dict(parentNodeId=OBJECTS, browseName="2:Machine{i}", repeat=2, children=[
+        dict(browseName="2:Axis{i}.{j}", requestedNewNodeId="ns=2;s=Machine{i}.Axis{j}",
+             repeat=dict(count=2, **{"from": 1, "index": "j"}))])])
+    assert tree.names == ["2:Machine0", "2:Axis0.1", "2:Axis0.2", "2:Machine1", "2:Axis1.1", "2:Axis1.2"]
+    assert tree.parents == [None, 0, 0, None, 3, 3]
+    assert tree.levels == [[0, 3], [1, 2, 4, 5]]
+    assert tree.items[5].RequestedNewNodeId == ua.NodeId("Machine1.Axis2", 2)
+
+
+def test_repeat_errors():
+    assert tree_errors([dict(parentNodeId=OBJECTS, browseName="2:A{j}", repeat=2)]) == [
+        "nodesToAdd[0]: 'j' names no enclosing repeat index"]
+    assert tree_errors([dict(parentNodeId=OBJECTS, browseName="2:A", repeat=-1)]) == [
+        "nodesToAdd[0]: invalid repeat -1"]
+    assert tree_errors([dict(parentNodeId=OBJECTS, browseName="2:A{i}", repeat=10)], max_nodes=5) == [
+        "nodesToAdd: expands to more than 5 nodes"]
+    # the same requested node id for every index
+    assert len(tree_errors([dict(parentNodeId=OBJECTS, browseName="2:A{i}", requestedNewNodeId="ns=2;s=A",
+                                 repeat=3)])) == 2
+
+
+def test_method_arguments():
+    tree = NodeTree([dict(parentNodeId=OBJECTS, browseName="2:Start", nodeClass=METHOD_NODE_CLASS,
+                          inputArguments=[dict(name="speed", dataType="Double"),
+                                          dict(name="axes", dataType="Int32", valueRank=1)],
+                          outputArguments=[dict(name="ok", dataType="Boolean")])])
+    assert tree.names == ["2:Start", "0:InputArguments", "0:OutputArguments"]
+    assert tree.parents == [None, 0, 0]
+    inputs = tree.items[1]
+    assert inputs.ReferenceTypeId == ua.NodeId(ua.ObjectIds.HasProperty)
+    assert inputs.NodeAttributes.ArrayDimensions == [2]
+    arguments = inputs.NodeAttributes.Value.Value
+    assert [argument.Name for argument in arguments] == ["speed", "axes"]
+    assert arguments[0].DataType == ua.NodeId(ua.ObjectIds.Double)
+    assert arguments[1].ValueRank == 1
+
+
+def test_method_argument_errors():
+    assert tree_errors([dict(parentNodeId=OBJECTS, browseName="2:Start", nodeClass=METHOD_NODE_CLASS,
+                             inputArguments=[dict(name="speed"), dict(dataType="Double")])]) == [
+        "nodesToAdd[0]: inputArguments[1]: argument name is required"]
+
+
+def test_unlimited_servers_get_bounded_chunks():
+    items = list(range(2 * node_management.DEFAULT_MAX_PER_CALL + 1))
+    for limit in (0, None):
+        assert [len(chunk) for chunk in node_management.chunked(items, limit)] == [
+            node_management.DEFAULT_MAX_PER_CALL, node_management.DEFAULT_MAX_PER_CALL, 1]
+    assert [len(chunk) for chunk in node_management.chunked(items[:5], 2)] == [2, 2, 1]
+    assert list(node_management.chunked([], 0)) == []
+
+
+def test_batch_timeout_grows_with_the_batch():
+    assert node_management.batch_timeout(4, 0) == 4
+    assert node_management.batch_timeout(4, node_management.ITEMS_PER_TIMEOUT) == 4
+    assert node_management.batch_timeout(4, node_management.ITEMS_PER_TIMEOUT + 1) == 8
+    assert node_management.batch_timeout(4, node_management.DEFAULT_MAX_PER_CALL) == 20
+
+
+@pytest.fixture(scope="module")
+def client(standin):
+    client = Client(standin.admin_url)
+    client.connect()
+    yield client
+    client.disconnect()
+
+
+def exists(client, node_id) -> bool:
+    result = node_management.read(client, [node_id], ua.AttributeIds.NodeClass)[0]
+    return result.StatusCode.is_good()
+
+
+def test_add_node_tree_in_waves(client):
+    name = next(names)
+    tree = NodeTree([
+        dict(parentNodeId="ns=2;s={0}.Machine".format(name), browseName="2:Speed", nodeClass=VARIABLE_NODE_CLASS,
+             value=1.5),
+        dict(parentNodeId="ns=2;s={0}".format(name), requestedNewNodeId="ns=2;s={0}.Machine".format(name),
+             browseName="2:Machine", nodeClass=OBJECT_NODE_CLASS),
+        dict(parentNodeId=OBJECTS, requestedNewNodeId="ns=2;s={0}".format(name), browseName="2:" + name, children=[
+            dict(browseName="2:Axis{i}", nodeClass=VARIABLE_NODE_CLASS, value=0, repeat=3)])])
+    order = [index for index, result in node_management.add_node_tree(client, tree, max_per_call=2)
+             if result.StatusCode.is_good()]
+    # each level is answered before the next one is sent
+    assert sorted(order) == list(range(len(tree)))
+    depth = dict((index, level) for level, indexes in enumerate(tree.levels) for index in indexes)
+    assert [depth[index] for index in order] == sorted(depth[index] for index in order)
+
+    machine = client.get_node("ns=2;s={0}.Machine".format(name))
+    assert machine.get_parent().nodeid == ua.NodeId(name, 2)
+    assert [child.get_browse_name().Name for child in machine.get_children()] == ["Speed"]
+    assert machine.get_child("2:Speed").get_value() == 1.5
+    assert len(client.get_node("ns=2;s={0}".format(name)).get_children()) == 4
+
+
+def test_failed_parents_orphan_their_children(client):
+    name = next(names)
+    node_id = "ns=2;s={0}".format(name)
+    list(node_management.add_node_tree(client, NodeTree([dict(parentNodeId=OBJECTS, requestedNewNodeId=node_id,
+                                                              browseName="2:" + name)])))
+    tree = NodeTree([
+        dict(parentNodeId=OBJECTS, requestedNewNodeId=node_id, browseName="2:" + name, children=[
+            dict(browseName="2:Child", children=[dict(browseName="2:Grandchild")])]),
+        dict(parentNodeId=OBJECTS, browseName="2:{0}Sibling".format(name))])
+    results = dict((tree.names[index], result.StatusCode.name)
+                   for index, result in node_management.add_node_tree(client, tree))
+    assert results == {"2:" + name: "BadNodeIdExists",
+                       "2:{0}Sibling".format(name): "Good",
+                       "2:Child": "BadParentNodeIdInvalid",
+                       "2:Grandchild": "BadParentNodeIdInvalid"}
+
+
+def test_failed_wave_keeps_the_results_of_the_others(client, monkeypatch):
+    name = next(names)
+    tree = NodeTree([dict(parentNodeId=OBJECTS, browseName="2:" + name, children=[
+        dict(browseName="2:Child{i}", repeat=2)])])
+    add_nodes = node_management.add_nodes
+    calls = []
+
+    def failing_add_nodes(client, items, max_per_call=None):
+        calls.append(len(items))
+        if len(calls) == 2:
+            raise ConnectionError("connection lost")
+        return add_nodes(client, items, max_per_call)
+    monkeypatch.setattr(node_management, "add_nodes", failing_add_nodes)
+
+    results = []
+    with pytest.raises(ConnectionError):
+        for index, result in node_management.add_node_tree(client, tree):
+            results.append((index, result))
+    assert calls == [1, 2]
+    assert [index for index, _ in results] == [0]
+    assert exists(client, results[0][1].AddedNodeId)
+
+
+def test_provision_rolls_back_added_nodes(standin, monkeypatch):
+    name = next(names)
+    handler = OpcuaHandler(standin.admin_url)
+    add_nodes = node_management.add_nodes
+    added = []
+
+    def failing_add_nodes(client, items, max_per_call=None):
+        if added:
+            raise ConnectionError("connection lost")
+        results = add_nodes(client, items, max_per_call)
+        added.extend(result.AddedNodeId for result in results)
+        return results
+    monkeypatch.setattr(node_management, "add_nodes", failing_add_nodes)
+
+    try:
+        spec = handler.provision_node_instance("abc", "service", "plan", dict(url=standin.admin_url, nodesToAdd=[
+            dict(parentNodeId=OBJECTS, browseName="2:{0}A".format(name), children=[dict(browseName="2:Child")]),
+            dict(parentNodeId=OBJECTS, browseName="2:{0}B".format(name))]))
+        assert spec.state == "failed"
+        assert "abc" not in handler.service_instances
+        with handler.session_pool.session(standin.admin_url) as client:
+            assert len(added) == 2
+            assert not any(exists(client, node_id) for node_id in added)
+    finally:
+        handler.close()
+        handler.session_pool.close()
+
+
+def test_provision_and_deprovision(standin):
+    name = next(names)
+    handler = OpcuaHandler(standin.admin_url)
+    try:
+        spec = handler.provision_node_instance("abc", "service", "plan", dict(url=standin.admin_url, nodesToAdd=[
+            dict(parentNodeId=OBJECTS, browseName="2:" + name, children=[
+                dict(browseName="2:Child{i}", nodeClass=VARIABLE_NODE_CLASS, value=0, repeat=3)])]))
+        assert spec.state != "failed"
+        nodes = handler.service_instances.get("abc").params["nodes"]
+        assert len(nodes) == 4
+
+        handler.deprovision_node_instance("abc")
+        assert "abc" not in handler.service_instances
+        with handler.session_pool.session(standin.admin_url) as client:
+            assert not any(exists(client, ua.NodeId.from_string(node)) for node in nodes)
+    finally:
+        handler.close()
+        handler.session_pool.close()
+
+
+def test_provision_and_deprovision_many_nodes(standin):
+    # the stand-in takes well over the request timeout to delete this many
+    # nodes in one request
+    name = next(names)
+    handler = OpcuaHandler(standin.admin_url, session_pool=SessionPool(timeout=2))
+    try:
+        spec = handler.provision_node_instance("abc", "service", "plan", dict(url=standin.admin_url, nodesToAdd=[
+            dict(parentNodeId=OBJECTS, browseName="2:" + name, children=[
+                dict(browseName="2:Child{i}", nodeClass=VARIABLE_NODE_CLASS, value=0, repeat=299)])]))
+        assert spec.state != "failed"
+        nodes = handler.service_instances.get("abc").params["nodes"]
+        assert len(nodes) == 300
+
+        handler.deprovision_node_instance("abc")
+        assert "abc" not in handler.service_instances
+        with handler.session_pool.session(standin.admin_url) as client:
+            assert not any(result.StatusCode.is_good() for result in node_management.read(
+                client, [ua.NodeId.from_string(node) for node in nodes], ua.AttributeIds.NodeClass))
+    finally:
+        handler.close()
+        handler.session_pool.close()
+
+
+def test_asyncio_mode_adds_and_deletes_many_nodes(standin):
+    import asyncua
+
+    async def add_and_delete(tree: NodeTree) -> list:
+        client = asyncua.Client(standin.admin_url, timeout=2)
+        await client.connect()
+        try:
+            results = await aio.add_node_tree(client, tree)
+            return await aio.delete_nodes(client, [result.AddedNodeId.to_string() for _, result in results])
+        finally:
+            await client.disconnect()
+
+    name = next(names)
+    tree = NodeTree([dict(parentNodeId=OBJECTS, browseName="2:" + name, children=[
+        dict(browseName="2:Child{i}", nodeClass=VARIABLE_NODE_CLASS, value=0, repeat=299)])])
+    results = asyncio.run(add_and_delete(tree))
+    assert len(results) == 300
+    assert all(result.is_good() for result in results)
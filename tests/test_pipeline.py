@@ -0,0 +1,124 @@
+import datetime
+
+from opcua_broker.pipeline import ChangeOnly, Deadband, Sample, Window, build_pipeline
+
+
+def record(value, node: str="ns=2;i=1", status: str="Good", timestamp: str="t") -> list:
+    return [node, value, timestamp, status]
+
+
+def values(records: list) -> list:
+    return [record[1] for record in records]
+
+
+def iso(seconds: float) -> str:
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat()
+
+
+def test_change_only():
+    stage = ChangeOnly()
+    assert values(stage.process([record(1), record(1), record(2), record(2, node="b")], 0)) == [1, 2, 2]
+    assert values(stage.process([record(2), record(2, status="Bad"), record(2)], 1)) == [2, 2]
+
+
+def test_absolute_deadband():
+    stage = Deadband(absolute=1)
+    assert values(stage.process([record(10), record(10.5), record(11), record(11.01), record(9.9)], 0)) == \
+        [10, 11.01, 9.9]
+
+
+def test_percent_deadband_of_range():
+    # 1% of 0..200 is 2 units, whatever the value
+    stage = Deadband(percent=1, range=[200, 0])
+    assert values(stage.process([record(100), record(102), record(102.5), record(0.5), record(2)], 0)) == \
+        [100, 102.5, 0.5]
+
+
+def test_percent_deadband_without_range_is_of_the_last_value():
+    stage = Deadband(percent=10)
+    assert values(stage.process([record(100), record(109), record(111), record(121), record(122.2)], 0)) == \
+        [100, 111, 122.2]
+    # a last value of 0 leaves no band
+    stage = Deadband(percent=10)
+    assert values(stage.process([record(0), record(0), record(0.001)], 0)) == [0, 0.001]
+
+
+def test_deadband_takes_the_wider_band():
+    stage = Deadband(absolute=5, percent=1, range=[0, 100])
+    assert values(stage.process([record(50), record(54), record(56)], 0)) == [50, 56]
+
+
+def test_deadband_passes_status_changes_and_other_values():
+    stage = Deadband(absolute=10)
+    assert values(stage.process([record(1), record(1, status="Bad"), record(1, status="Bad"), record(1)], 0)) == \
+        [1, 1, 1]
+    assert values(stage.process([record("on", node="b"), record("on", node="b"), record(None, node="b")], 0)) == \
+        ["on", "on", None]
+
+
+def test_sample_interval_boundaries():
+    stage = Sample(interval=1)
+    assert values(stage.process([record(1), record(2)], 10)) == [1]
+    assert values(stage.process([record(3)], 10.999)) == []
+    # the next value is due exactly interval seconds after the last one passed
+    assert values(stage.process([record(4), record(5)], 11)) == [4]
+    assert values(stage.process([record(6)], 11.5)) == []
+    assert values(stage.process([record(7)], 12.5)) == [7]
+
+
+def test_sample_is_per_node_and_passes_status_changes():
+    stage = Sample(interval=1)
+    assert values(stage.process([record(1), record(1, node="b")], 0)) == [1, 1]
+    assert values(stage.process([record(2, status="Bad"), record(3, status="Bad"), record(4)], 0.5)) == [2, 4]
+
+
+def test_window_alignment():
+    stage = Window(interval=10)
+    assert stage.process([record(1), record(3)], 23) == []
+    assert stage.process([record(2)], 29.9) == []
+    # the window 20..30 ends at 30, and is stamped with its start
+    assert stage.process([record(100)], 30) == [["ns=2;i=1", dict(min=1, max=3, avg=2, count=3), iso(20), "Good"]]
+    assert stage.process([], 40) == [["ns=2;i=1", dict(min=100, max=100, avg=100, count=1), iso(30), "Good"]]
+
+
+def test_window_flushes_on_empty_batches():
+    stage = Window(interval=1, aggregates=["max"])
+    assert stage.process([record(1), record(2, node="b")], 5.5) == []
+    assert stage.process([], 5.9) == []
+    flushed = stage.process([], 8)
+    assert sorted(flushed) == [["b", dict(max=2, count=1), iso(5), "Good"],
+                               ["ns=2;i=1", dict(max=1, count=1), iso(5), "Good"]]
+    assert stage.process([], 9) == []
+
+
+def test_window_uncertain_status():
+    stage = Window(interval=1)
+    stage.process([record(1), record(2, status="BadSensorFailure"), record(3, node="b")], 0)
+    flushed = dict((record[0], record[3]) for record in stage.process([], 1))
+    assert flushed == {"ns=2;i=1": "Uncertain", "b": "Good"}
+
+
+def test_window_passes_other_values():
+    stage = Window(interval=1)
+    assert stage.process([record("on"), record(1), record(True)], 0) == [record("on"), record(True)]
+
+
+def test_build_pipeline():
+    assert build_pipeline(dict()) is None
+    assert build_pipeline(dict(deadband=dict())) is None
+
+    pipeline = build_pipeline(dict(changeOnly=True, deadband=dict(absolute=1), sampleInterval=1000,
+                                   window=dict(interval=10000)))
+    assert [type(stage) for stage in pipeline.stages] == [ChangeOnly, Deadband, Sample, Window]
+    assert pipeline.windowed
+    assert pipeline.stages[2].interval == 1
+    assert pipeline.stages[3].interval == 10
+    assert not build_pipeline(dict(changeOnly=True)).windowed
+
+
+def test_pipeline_stages_in_order():
+    pipeline = build_pipeline(dict(deadband=dict(absolute=1), sampleInterval=1000))
+    assert values(pipeline.process([record(0), record(0.5), record(2)], 0)) == [0]
+    # 2 passed the deadband before sampling dropped it, so the deadband is
+    # around 2 rather than 0 now
+    assert values(pipeline.process([record(2.5), record(3.5)], 1)) == [3.5]
@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+import pytest
+
+from opcua_broker import aio
+from opcua_broker.pool import SessionPool
+
+
+@pytest.fixture
+def session_pool():
+    session_pool = SessionPool(max_size=2, timeout=7)
+    yield session_pool
+    session_pool.close()
+
+
+def test_sessions_use_the_request_timeout(standin, session_pool):
+    with session_pool.session(standin.url) as client:
+        assert client.uaclient._uasocket.timeout == 7
+
+
+def test_sessions_are_reused(standin, session_pool):
+    with session_pool.session(standin.url) as first:
+        pass
+    with session_pool.session(standin.url) as second:
+        assert second is first
+    assert session_pool.stats() == {(standin.url, ""): dict(in_use=0, idle=1)}
+
+
+def test_broken_sessions_are_discarded(standin, session_pool):
+    with pytest.raises(ConnectionError):
+        with session_pool.session(standin.url) as first:
+            raise ConnectionError("connection lost")
+    with session_pool.session(standin.url) as second:
+        assert second is not first
+
+
+def run_with_async_pool(test, **kwargs):
+    async def run():
+        session_pool = aio.AsyncSessionPool(max_size=2, **kwargs)
+        try:
+            await test(session_pool)
+        finally:
+            await session_pool.close()
+    asyncio.run(run())
+
+
+def test_async_sessions_use_the_request_timeout(standin):
+    async def test(session_pool):
+        async with session_pool.session(standin.url) as client:
+            assert client.uaclient._timeout == 7
+            assert client._watchdog_intervall == 7
+    run_with_async_pool(test, timeout=7)
+
+
+def test_async_sessions_are_reused(standin):
+    async def test(session_pool):
+        async with session_pool.session(standin.url) as first:
+            pass
+        async with session_pool.session(standin.url) as second:
+            assert second is first
+        assert session_pool.stats() == {(standin.url, ""): dict(in_use=0, idle=1)}
+    run_with_async_pool(test)
+
+
+def test_async_sessions_broken_by_transport_errors_are_discarded(standin):
+    async def test(session_pool):
+        with pytest.raises(ConnectionError):
+            async with session_pool.session(standin.url) as first:
+                raise ConnectionError("connection lost")
+        assert session_pool.stats() == {(standin.url, ""): dict(in_use=0, idle=0)}
+        assert not aio.is_connected(first)
+        # other errors leave the session as healthy as it was
+        with pytest.raises(ValueError):
+            async with session_pool.session(standin.url) as second:
+                raise ValueError("bad node id")
+        async with session_pool.session(standin.url) as third:
+            assert third is second
+    run_with_async_pool(test)
+
+
+def test_async_sessions_are_reconnected_on_checkout(standin):
+    async def test(session_pool):
+        session = await session_pool.acquire(standin.url)
+        await session_pool.release(session)
+        # a connection lost while the session was idle
+        client = session.client
+        await client.disconnect()
+        assert await session_pool.acquire(standin.url) is session
+        assert session.client is not client
+        assert aio.is_connected(session.client)
+        await session_pool.release(session)
+    run_with_async_pool(test)
+
+
+def test_async_sessions_check_the_server_state(standin):
+    async def test(session_pool):
+        session = await session_pool.acquire(standin.url)
+        await session_pool.release(session)
+        session.last_checked = 0
+        assert await session_pool._check(session)
+        assert session.last_checked > 0
+
+        class Node(object):
+            async def read_value(self):
+                raise TimeoutError("no answer")
+        client = session.client
+        client.get_node = lambda node_id: Node()
+        # checked once health_check_interval has passed since the last check
+        assert await session_pool.acquire(standin.url) is session
+        assert session.client is client
+        await session_pool.release(session)
+        session.last_checked = 0
+        assert await session_pool.acquire(standin.url) is session
+        assert session.client is not client
+        await session_pool.release(session)
+    run_with_async_pool(test, health_check_interval=30)
+
+
+def test_async_idle_sessions_are_evicted(standin):
+    async def test(session_pool):
+        session = await session_pool.acquire(standin.url)
+        await session_pool.release(session)
+        await session_pool.evict_idle(time.time() + 5)
+        assert session_pool.stats() == {(standin.url, ""): dict(in_use=0, idle=1)}
+        await session_pool.evict_idle(time.time() + 11)
+        assert session_pool.stats() == {(standin.url, ""): dict(in_use=0, idle=0)}
+        assert not aio.is_connected(session.client)
+    run_with_async_pool(test, idle_timeout=10)
+
+
+def test_async_reaper_evicts_idle_sessions(standin):
+    async def test(session_pool):
+        session = await session_pool.acquire(standin.url)
+        await session_pool.release(session)
+        await asyncio.sleep(1.5)
+        assert session_pool.stats() == {(standin.url, ""): dict(in_use=0, idle=0)}
+        assert not aio.is_connected(session.client)
+    run_with_async_pool(test, idle_timeout=0.5)
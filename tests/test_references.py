@@ -0,0 +1,113 @@
+import itertools
+
+import pytest
+from opcua import Client, ua
+
+from opcua_broker import node_management
+from opcua_broker.handler import OpcuaHandler
+from opcua_broker.node_management import NodeTree
+
+
+OBJECTS = "i=85"
+ORGANIZES = "i=35"
+
+# every test adds nodes of its own to the shared stand-in server
+names = ("References{0}".format(i) for i in itertools.count())
+
+
+@pytest.fixture(scope="module")
+def client(standin):
+    client = Client(standin.admin_url)
+    client.connect()
+    yield client
+    client.disconnect()
+
+
+def add_folders(client, count: int) -> tuple:
+    """
+    Add a folder with count child folders, returning the node ids of the
+    folder and of the children.
+    """
+    name = next(names)
+    tree = NodeTree([dict(parentNodeId=OBJECTS, requestedNewNodeId="ns=2;s=" + name, browseName="2:" + name,
+                          children=[dict(requestedNewNodeId="ns=2;s={0}.{{i}}".format(name),
+                                         browseName="2:Child{i}", repeat=count)])])
+    results = list(node_management.add_node_tree(client, tree))
+    assert all(result.StatusCode.is_good() for _, result in results)
+    return "ns=2;s=" + name, ["ns=2;s={0}.{1}".format(name, i) for i in range(count)]
+
+
+def organized(client, node_id: str) -> list:
+    return sorted(node.nodeid.to_string() for node in client.get_node(node_id).get_referenced_nodes(
+        refs=ua.ObjectIds.Organizes, direction=ua.BrowseDirection.Forward, includesubtypes=False))
+
+
+def organizes(source: str, targets: list) -> list:
+    return node_management.build_add_references_items([dict(sourceNodeId=source, referenceTypeId=ORGANIZES,
+                                                            targetNodeId=target) for target in targets])
+
+
+def test_add_and_delete_references_in_batches(client):
+    source, _ = add_folders(client, 0)
+    _, targets = add_folders(client, 5)
+    items = organizes(source, targets)
+    assert [result.name for result in node_management.add_references(client, items, max_per_call=2)] == \
+        ["Good"] * 5
+    assert organized(client, source) == sorted(targets)
+
+    references = [node_management.reference_key(item) for item in items]
+    results = node_management.delete_references(client, references[:3], max_per_call=2)
+    assert [result.name for result in results] == ["Good"] * 3
+    assert organized(client, source) == sorted(targets[3:])
+
+    # references already gone count as deleted
+    results = node_management.delete_references(client, references, max_per_call=2)
+    assert [result.name for result in results[:3]] == ["BadNotFound"] * 3
+    assert all(node_management.is_reference_deleted(result) for result in results)
+    assert organized(client, source) == []
+
+
+def test_provision_adds_only_missing_references(standin, client):
+    source, _ = add_folders(client, 0)
+    _, targets = add_folders(client, 3)
+    node_management.add_references(client, organizes(source, targets[:1]))
+    handler = OpcuaHandler(standin.admin_url)
+    try:
+        spec = handler.provision_reference_instance("abc", "service", "plan", dict(
+            url=standin.admin_url, referencesToAdd=[dict(sourceNodeId=source, referenceTypeId=ORGANIZES,
+                                                         targetNodeId=target) for target in targets + targets]))
+        assert spec.state != "failed"
+        params = handler.service_instances.get("abc").params
+        assert [reference[3] for reference in params["existingReferences"]] == targets[:1]
+        assert [reference[3] for reference in params["references"]] == targets[1:]
+        assert params["failedReferences"] == []
+        assert organized(client, source) == sorted(targets)
+
+        handler.deprovision_reference_instance("abc")
+        assert "abc" not in handler.service_instances
+        # the reference which was there before is left alone
+        assert organized(client, source) == targets[:1]
+    finally:
+        handler.close()
+        handler.session_pool.close()
+
+
+def test_deprovision_of_references_already_gone(standin, client):
+    source, _ = add_folders(client, 0)
+    _, targets = add_folders(client, 4)
+    handler = OpcuaHandler(standin.admin_url)
+    try:
+        handler.provision_reference_instance("abc", "service", "plan", dict(
+            url=standin.admin_url, referencesToAdd=[dict(sourceNodeId=source, referenceTypeId=ORGANIZES,
+                                                         targetNodeId=target) for target in targets]))
+        references = handler.service_instances.get("abc").params["references"]
+        assert len(references) == 4
+        node_management.delete_references(client, [tuple(reference) for reference in references[:2]])
+        node_management.delete_nodes(client, [ua.NodeId.from_string(targets[2])])
+
+        handler.deprovision_reference_instance("abc")
+        assert "abc" not in handler.service_instances
+        assert organized(client, source) == []
+    finally:
+        handler.close()
+        handler.session_pool.close()
@@ -0,0 +1,132 @@
+import threading
+from operator import itemgetter
+
+from opcua_broker.registry import Registry, Unloaded
+from opcua_broker.store import SqliteStateStore
+
+
+def make_registry(store=None) -> Registry:
+    return Registry(indexes=dict(plan_id=itemgetter("plan_id")), store=store, kind="instance",
+                    dump=dict, load=dict)
+
+
+def test_put_get_pop_and_indexes():
+    registry = make_registry()
+    registry.put("a", dict(plan_id="p1"))
+    registry.put("b", dict(plan_id="p1"))
+    registry.put("c", dict(plan_id="p2"))
+
+    assert registry.get("a") == dict(plan_id="p1")
+    assert registry.get("missing", "default") == "default"
+    assert sorted(item["plan_id"] for item in registry.find("plan_id", "p1")) == ["p1", "p1"]
+    assert "c" in registry and len(registry) == 3
+
+    registry.put("a", dict(plan_id="p2"))
+    assert len(registry.find("plan_id", "p1")) == 1
+    assert len(registry.find("plan_id", "p2")) == 2
+
+    assert registry.pop("c") == dict(plan_id="p2")
+    assert registry.pop("c") is None
+    assert registry.find("plan_id", "p2") == [dict(plan_id="p2")]
+
+
+def test_concurrent_puts_keep_indexes_consistent():
+    registry = make_registry()
+
+    def put(thread: int):
+        for i in range(200):
+            registry.put(str(i), dict(plan_id="p{0}".format(thread % 2)))
+
+    threads = [threading.Thread(target=put, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(registry) == 200
+    # every id is in exactly one index entry, the one of its last put
+    assert len(registry.find("plan_id", "p0")) + len(registry.find("plan_id", "p1")) == 200
+
+
+def test_put_and_pop_write_through(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStateStore(path)
+    registry = make_registry(store)
+    registry.put("a", dict(plan_id="p1"))
+    registry.put("b", dict(plan_id="p2"))
+    registry.pop("b")
+    store.close()
+
+    restarted = SqliteStateStore(path)
+    try:
+        assert restarted.load_index("instance") == [("a", dict(plan_id="p1"))]
+        assert restarted.load("instance", "a") == dict(plan_id="p1")
+    finally:
+        restarted.close()
+
+
+def test_restore_is_lazy_after_restart(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStateStore(path)
+    registry = make_registry(store)
+    for i in range(10):
+        registry.put(str(i), dict(plan_id="p{0}".format(i % 2), number=i))
+    store.close()
+
+    store = SqliteStateStore(path)
+    try:
+        restored = make_registry(store)
+        assert restored.restore() == 10
+        assert len(restored) == 10
+        assert sorted(restored.keys()) == sorted(str(i) for i in range(10))
+        # only the index was read, the records stay on disk until used
+        assert isinstance(restored._shard("3").items["3"], Unloaded)
+
+        assert restored.get("3") == dict(plan_id="p1", number=3)
+        assert not isinstance(restored._shard("3").items["3"], Unloaded)
+        assert isinstance(restored._shard("4").items["4"], Unloaded)
+        assert sorted(item["number"] for item in restored.find("plan_id", "p0")) == [0, 2, 4, 6, 8]
+    finally:
+        store.close()
+
+
+def test_unloaded_entry_deleted_from_store_resolves_to_none(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStateStore(path)
+    try:
+        make_registry(store).put("a", dict(plan_id="p1"))
+        restored = make_registry(store)
+        restored.restore()
+        # another broker sharing the store removed it meanwhile
+        store.delete("instance", "a")
+
+        assert restored.get("a") is None
+        assert "a" not in restored
+        assert restored.find("plan_id", "p1") == []
+    finally:
+        store.close()
+
+
+def test_restore_reset_replaces_entries_changed_elsewhere(tmp_path):
+    store = SqliteStateStore(str(tmp_path / "state.db"))
+    try:
+        registry = make_registry(store)
+        registry.put("a", dict(plan_id="p1"))
+        registry.put("b", dict(plan_id="p1"))
+        # written by another broker sharing the store
+        other = make_registry(store)
+        other.restore()
+        other.put("a", dict(plan_id="p2"))
+        other.pop("b")
+        other.put("c", dict(plan_id="p3"))
+
+        registry.restore()
+        assert registry.get("a") == dict(plan_id="p1")
+
+        registry.restore(reset=True)
+        assert registry.get("a") == dict(plan_id="p2")
+        assert registry.get("b") is None
+        assert registry.get("c") == dict(plan_id="p3")
+        assert registry.find("plan_id", "p1") == []
+    finally:
+        store.close()
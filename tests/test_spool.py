@@ -0,0 +1,316 @@
+import itertools
+import os
+import time
+
+import pytest
+from opcua import ua
+
+from opcua_broker import subscription
+from opcua_broker.pool import SessionPool
+from opcua_broker.spool import RECORD_HEADER, SEGMENT_SUFFIX, Spool, SpoolDirectory
+from opcua_broker.subscription import DATA_CHANGE, SubscriptionManager
+
+
+# the tests write values of their own to the variables of the stand-in
+values = itertools.count(2000)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int=1):
+        self.value += amount
+
+
+@pytest.fixture
+def spool_directory(tmp_path):
+    # synced by hand, the thread of the directory would race the tests
+    directory = SpoolDirectory(str(tmp_path / "spool"), fsync_interval=3600)
+    yield directory
+    directory.close()
+
+
+def segment_files(directory: str) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def write(variable) -> int:
+    value = next(values)
+    variable.set_value(ua.DataValue(ua.Variant(value, ua.VariantType.Int64)))
+    return value
+
+
+def wait_for(buffer, node: str, value: int, cursor: int=None, timeout: float=5) -> int:
+    """
+    Read buffer from cursor until the record of value for node, and return
+    the cursor after it.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        records, cursor, _ = buffer.read(cursor, timeout=deadline - time.time())
+        if any(record[0] == node and record[1] == value for record in records):
+            return cursor
+    raise AssertionError("no notification of {0} for {1}".format(value, node))
+
+
+def test_segments_roll_over_and_are_read_back(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory, capacity=2, segment_bytes=64)
+    items = [["node", i, "x" * 10] for i in range(10)]
+    spool.extend(items[:4])
+    spool.extend(items[4:])
+    assert len(segment_files(directory)) > 1
+    # the first segment is named after offset 0, the next after its successor
+    assert segment_files(directory)[0] == "{0:020d}{1}".format(0, SEGMENT_SUFFIX)
+    # what no longer fits in memory is read from the segments
+    assert spool.read(0, timeout=0) == (items[:8], 8, 0)
+    assert spool.read(8, timeout=0) == (items[8:], 10, 0)
+    assert spool.read(3, max_items=2, timeout=0) == (items[3:5], 5, 0)
+    spool.close()
+
+
+def test_record_larger_than_a_segment_gets_one_of_its_own(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    items = [1, "y" * 200, 2]
+    spool.extend(items)
+    assert len(segment_files(str(tmp_path))) == 3
+    spool.close()
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    assert spool.read(0, timeout=0) == (items, 3, 0)
+    spool.close()
+
+
+def test_reopened_spool_replays_from_disk_and_carries_on(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory, segment_bytes=64)
+    spool.extend([[i] for i in range(6)])
+    spool.close()
+
+    spool = Spool(directory, segment_bytes=64)
+    assert (spool.head, spool.tail, len(spool)) == (0, 6, 0)
+    # readers without an offset only get what is appended from now on
+    assert spool.read(None, timeout=0) == ([], 6, 0)
+    assert spool.read(2, timeout=0) == ([[i] for i in range(2, 6)], 6, 0)
+    spool.extend([[6]])
+    # the spooled records are read up to those held in memory
+    assert spool.read(5, timeout=0) == ([[5]], 6, 0)
+    assert spool.read(6, timeout=0) == ([[6]], 7, 0)
+    spool.close()
+
+
+def test_torn_records_are_dropped_on_reopen(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory)
+    spool.extend(["first", "second", "third"])
+    spool.close()
+
+    # flip a byte of the payload of the last record, as a crash midway
+    # through writing it could have left it
+    path = os.path.join(directory, segment_files(directory)[0])
+    with open(path, "r+b") as f:
+        data = f.read(256)
+        position = 0
+        for _ in range(2):
+            position += RECORD_HEADER.size + RECORD_HEADER.unpack_from(data, position)[0]
+        f.seek(position + RECORD_HEADER.size)
+        f.write(b"X")
+
+    spool = Spool(directory)
+    assert spool.tail == 2
+    assert spool.read(0, timeout=0) == (["first", "second"], 2, 0)
+    # the torn record is overwritten by the next one
+    spool.extend(["fourth"])
+    spool.close()
+    spool = Spool(directory)
+    assert spool.read(0, timeout=0) == (["first", "second", "fourth"], 3, 0)
+    spool.close()
+
+
+def test_oversized_length_is_rejected_on_reopen(tmp_path):
+    directory = str(tmp_path)
+    spool = Spool(directory, segment_bytes=4096)
+    spool.extend(["first", "second"])
+    spool.close()
+    path = os.path.join(directory, segment_files(directory)[0])
+    with open(path, "r+b") as f:
+        length = RECORD_HEADER.unpack_from(f.read(RECORD_HEADER.size))[0]
+        f.seek(RECORD_HEADER.size + length)
+        f.write(RECORD_HEADER.pack(1 << 20, 0))
+    spool = Spool(directory, segment_bytes=4096)
+    assert spool.read(0, timeout=0) == (["first"], 1, 0)
+    spool.close()
+
+
+def test_old_segments_expire(tmp_path):
+    dropped = Counter()
+    spool = Spool(str(tmp_path), capacity=2, dropped=dropped, segment_bytes=64, max_age=60)
+    spool.extend([[i] for i in range(20)])
+    segments = len(segment_files(str(tmp_path)))
+    assert segments > 2
+    spool.expire(time.time() + 30)
+    assert len(segment_files(str(tmp_path))) == segments
+    assert spool.head == 0
+
+    spool.expire(time.time() + 120)
+    # everything was appended too long ago, an empty segment replaces it all
+    assert len(segment_files(str(tmp_path))) == 1
+    assert spool.head == spool.tail == 20
+    assert spool.read(0, timeout=0) == ([], 20, 20)
+    assert dropped.value == 20
+    spool.extend([[20]])
+    assert spool.read(20, timeout=0) == ([[20]], 21, 0)
+    spool.sync()
+    spool.close()
+
+
+def test_expiry_drops_only_the_segments_past_max_age(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64, max_age=60)
+    spool.extend([[i] for i in range(6)])
+    old = list(spool._segments)
+    for segment in old:
+        segment.last_append -= 120
+    spool.extend([[i] for i in range(6, 12)])
+    spool.expire()
+    # the last of them was appended to again
+    assert spool._segments[0] is old[-1]
+    assert spool.head == old[-1].base > 0
+    items, cursor, missed = spool.read(0, timeout=0)
+    assert missed == spool.head
+    assert items == [[i] for i in range(spool.head, 12)]
+    spool.close()
+
+
+def test_max_bytes_drops_the_oldest_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64, max_bytes=64 * 3)
+    spool.extend([[i] for i in range(30)])
+    assert len(segment_files(str(tmp_path))) <= 3
+    assert spool.head > 0
+    assert spool.read(spool.head, max_items=100, timeout=0)[0] == [[i] for i in range(spool.head, 30)]
+    spool.close()
+
+
+def test_spool_directory_keeps_spools_and_states(spool_directory):
+    spool = spool_directory.open("binding/1", capacity=5)
+    spool.extend([1, 2])
+    assert spool_directory.binding_ids() == ["binding/1"]
+    key = ("opc.tcp://localhost:4840", "", 50)
+    assert spool_directory.load_state(key) is None
+    spool_directory.save_state(key, dict(subscriptionId=7))
+    assert spool_directory.load_state(key) == dict(subscriptionId=7)
+    spool_directory.remove_state(key)
+    assert spool_directory.load_state(key) is None
+
+    spool_directory.sync()
+    spool.close()
+    spool = spool_directory.open("binding/1", capacity=5)
+    assert spool.read(0, timeout=0) == ([1, 2], 2, 0)
+    spool_directory.discard("binding/1")
+    assert spool.closed
+    assert spool_directory.binding_ids() == []
+
+
+def test_spool_is_closed_when_the_group_cannot_be_created(spool_directory):
+    session_pool = SessionPool()
+    manager = SubscriptionManager(session_pool, spool_directory)
+    try:
+        with pytest.raises(Exception):
+            manager.subscribe("b", DATA_CHANGE, "opc.tcp://127.0.0.1:1", nodes=["ns=2;i=1"], spool=dict())
+        assert manager.stats() == dict()
+        spool_directory.sync()
+        assert spool_directory._spools == dict()
+    finally:
+        manager.close()
+        session_pool.close()
+
+
+def subscribe(manager: SubscriptionManager, standin, node: str):
+    return manager.subscribe("b", DATA_CHANGE, standin.url, nodes=[node], publishing_interval=50,
+                             sampling_interval=0, spool=dict())
+
+
+def test_subscription_taken_over_is_republished_into_the_spool(standin, spool_directory, monkeypatch):
+    node = standin.node_ids(4)[3]
+    session_pool = SessionPool()
+    manager = SubscriptionManager(session_pool, spool_directory)
+    buffer = subscribe(manager, standin, node)
+    first = write(standin.variables[3])
+    cursor = wait_for(buffer, node, first)
+    group = manager._subscribers["b"].group
+    state = group.state()
+    manager.close()
+    session_pool.close()
+    assert buffer.closed
+    assert spool_directory.load_state(group.key) == state
+
+    # the stand-in deletes subscriptions with their session and cannot
+    # transfer them, the server which kept this one is played here
+    sequence_number = state["sequenceNumber"]
+    client_handle = state["items"][0][1]
+    second = next(values)
+    transferred, republished = [], []
+
+    def transfer_subscription(client, subscription_id):
+        transferred.append(subscription_id)
+        return [sequence_number, sequence_number + 1]
+
+    def republish(client, subscription_id, number):
+        republished.append(number)
+        item = ua.MonitoredItemNotification()
+        item.ClientHandle = client_handle
+        item.Value = ua.DataValue(ua.Variant(second, ua.VariantType.Int64))
+        notification = ua.DataChangeNotification()
+        notification.MonitoredItems = [item]
+        message = ua.NotificationMessage()
+        message.SequenceNumber = number
+        message.NotificationData = [notification]
+        return message
+
+    monkeypatch.setattr(subscription, "transfer_subscription", transfer_subscription)
+    monkeypatch.setattr(subscription, "republish", republish)
+    session_pool = SessionPool()
+    manager = SubscriptionManager(session_pool, spool_directory)
+    try:
+        buffer = subscribe(manager, standin, node)
+        group = manager._subscribers["b"].group
+        assert transferred == [state["subscriptionId"]]
+        assert group.subscription.subscription_id == state["subscriptionId"]
+        assert group.available == [sequence_number, sequence_number + 1]
+        # the item of the subscription taken over is monitored again, not added
+        assert manager.stats() == {(standin.url, "", 50): dict(items=1, subscribers=1)}
+        assert group.items[(DATA_CHANGE, node, 0, 0)].client_handle == client_handle
+
+        manager.finish_resumes()
+        assert republished == [sequence_number + 1]
+        assert group.available is None
+        assert group.sequence_number == sequence_number + 1
+        assert wait_for(buffer, node, second, cursor) == cursor + 1
+        # and what the previous broker spooled is still there
+        records, _, missed = buffer.read(0, max_items=cursor, timeout=0)
+        assert missed == 0
+        assert [node, first] in [record[:2] for record in records]
+    finally:
+        manager.close()
+        session_pool.close()
+
+
+def test_failed_transfer_falls_back_to_a_new_subscription(standin, spool_directory):
+    node = standin.node_ids(5)[4]
+    key = (standin.url, "", 50)
+    spool_directory.save_state(key, dict(subscriptionId=987654, sequenceNumber=3,
+                                         items=[[[DATA_CHANGE, node, 0, 0], 201, 1]]))
+    session_pool = SessionPool()
+    manager = SubscriptionManager(session_pool, spool_directory)
+    try:
+        buffer = subscribe(manager, standin, node)
+        group = manager._subscribers["b"].group
+        assert group.subscription.subscription_id != 987654
+        assert group.available is None
+        assert group.sequence_number == 0
+        assert spool_directory.load_state(key) is None
+        assert manager.stats() == {key: dict(items=1, subscribers=1)}
+        manager.finish_resumes()
+        wait_for(buffer, node, write(standin.variables[4]))
+    finally:
+        manager.close()
+        session_pool.close()
@@ -0,0 +1,107 @@
+import threading
+
+from opcua_broker.store import PendingWrite, SqliteStateStore
+
+
+def test_save_and_load(tmp_path):
+    store = SqliteStateStore(str(tmp_path / "state.db"))
+    try:
+        store.save("instance", "a", dict(plan_id="p1", params=dict(url="opc.tcp://x")), dict(plan_id="p1"))
+        store.save("instance", "b", dict(plan_id="p2"), dict(plan_id="p2"))
+        store.save("binding", "a", dict(instance_id="a"), dict(instance_id="a"))
+
+        assert store.load("instance", "a") == dict(plan_id="p1", params=dict(url="opc.tcp://x"))
+        assert store.load("instance", "c") is None
+        assert sorted(store.load_index("instance")) == [("a", dict(plan_id="p1")), ("b", dict(plan_id="p2"))]
+        assert store.load_index("binding") == [("a", dict(instance_id="a"))]
+    finally:
+        store.close()
+
+
+def test_save_replaces_and_delete_removes(tmp_path):
+    store = SqliteStateStore(str(tmp_path / "state.db"))
+    try:
+        store.save("instance", "a", dict(version=1), dict(plan_id="p1"))
+        store.save("instance", "a", dict(version=2), dict(plan_id="p2"))
+        assert store.load("instance", "a") == dict(version=2)
+        assert store.load_index("instance") == [("a", dict(plan_id="p2"))]
+
+        store.delete("instance", "a")
+        store.delete("instance", "missing")
+        assert store.load("instance", "a") is None
+        assert store.load_index("instance") == []
+    finally:
+        store.close()
+
+
+def test_restore_from_fresh_store(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStateStore(path)
+    store.save("instance", "a", dict(plan_id="p1"), dict(plan_id="p1"))
+    store.save("instance", "b", dict(plan_id="p2"), dict(plan_id="p2"))
+    store.delete("instance", "b")
+    store.close()
+
+    restarted = SqliteStateStore(path)
+    try:
+        assert restarted.load_index("instance") == [("a", dict(plan_id="p1"))]
+        assert restarted.load("instance", "a") == dict(plan_id="p1")
+    finally:
+        restarted.close()
+
+
+def test_concurrent_saves_are_all_durable(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStateStore(path, max_batch=16)
+
+    def save(thread: int):
+        for i in range(50):
+            key = "{0}-{1}".format(thread, i)
+            store.save("binding", key, dict(key=key), dict(thread=thread))
+
+    threads = [threading.Thread(target=save, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store.close()
+
+    restarted = SqliteStateStore(path)
+    try:
+        assert len(restarted.load_index("binding")) == 8 * 50
+        assert restarted.load("binding", "7-49") == dict(key="7-49")
+    finally:
+        restarted.close()
+
+
+def test_close_flushes_queued_writes(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStateStore(path, max_batch=64)
+    # queued behind each other without waiting, as by many threads at once;
+    # close must commit all of them before the writer stops
+    pending = [PendingWrite(SqliteStateStore.SAVE, ("instance", str(i), "{}", '{"i": %d}' % i)) for i in range(500)]
+    for write in pending:
+        store._queue.put(write)
+    store.close()
+
+    assert all(write.done.is_set() and write.error is None for write in pending)
+    restarted = SqliteStateStore(path)
+    try:
+        assert len(restarted.load_index("instance")) == 500
+        assert restarted.load("instance", "499") == dict(i=499)
+    finally:
+        restarted.close()
+
+
+def test_failed_commit_is_raised_to_writers(tmp_path):
+    store = SqliteStateStore(str(tmp_path / "state.db"))
+    try:
+        write = PendingWrite("INSERT INTO missing VALUES (?)", (1,))
+        store._queue.put(write)
+        write.done.wait(5)
+        assert write.error is not None
+        # the writer keeps going after a failed transaction
+        store.save("instance", "a", dict(), dict())
+        assert store.load("instance", "a") == dict()
+    finally:
+        store.close()
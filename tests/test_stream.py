@@ -0,0 +1,144 @@
+import threading
+
+import flask
+import pytest
+
+from opcua_broker import routes
+from opcua_broker.buffer import RingBuffer
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int=1):
+        self.value += amount
+
+
+class Handler(object):
+    def __init__(self, buffers: dict):
+        self.buffers = buffers
+
+    def binding_buffer(self, binding_id: str) -> RingBuffer:
+        buffer = self.buffers.get(binding_id)
+        if isinstance(buffer, Exception):
+            raise buffer
+        return buffer
+
+
+def closed_buffer(items: list, capacity: int=10) -> RingBuffer:
+    buffer = RingBuffer(capacity)
+    buffer.extend(items)
+    buffer.close()
+    return buffer
+
+
+@pytest.fixture
+def app_client():
+    def app_client(buffers: dict):
+        app = flask.Flask(__name__)
+        app.register_blueprint(routes.get_blueprint(Handler(buffers), keepalive=0.01))
+        return app.test_client()
+    return app_client
+
+
+def test_read_from_the_head_and_on():
+    buffer = RingBuffer(capacity=5)
+    buffer.extend([1, 2, 3])
+    assert buffer.read(None, timeout=0) == ([1, 2, 3], 3, 0)
+    assert buffer.read(1, max_items=1, timeout=0) == ([2], 2, 0)
+    assert buffer.read(3, timeout=0) == ([], 3, 0)
+
+
+def test_wraparound_counts_the_missed_notifications():
+    dropped = Counter()
+    buffer = RingBuffer(capacity=3, dropped=dropped)
+    buffer.extend([1, 2, 3, 4])
+    buffer.extend([5])
+    assert (buffer.head, buffer.tail, len(buffer)) == (2, 5, 3)
+    assert buffer.read(0, timeout=0) == ([3, 4, 5], 5, 2)
+    assert buffer.read(3, timeout=0) == ([4, 5], 5, 0)
+    assert dropped.value == 2
+
+
+def test_cursor_past_the_tail_reads_on_from_the_tail():
+    buffer = RingBuffer(capacity=3)
+    buffer.extend([1, 2])
+    assert buffer.read(10, timeout=0) == ([], 2, 0)
+    buffer.extend([3])
+    assert buffer.read(2, timeout=0) == ([3], 3, 0)
+
+
+def test_readers_are_woken_by_extend_and_close():
+    buffer = RingBuffer(capacity=3)
+    calls = []
+    buffer.add_listener(lambda: calls.append(len(buffer)))
+    results = []
+    reader = threading.Thread(target=lambda: results.append(buffer.read(0, timeout=5)))
+    reader.start()
+    buffer.extend([1])
+    reader.join(5)
+    assert results == [([1], 1, 0)]
+
+    reader = threading.Thread(target=lambda: results.append(buffer.read(1, timeout=5)))
+    reader.start()
+    buffer.close()
+    reader.join(5)
+    assert results[1] == ([], 1, 0)
+    assert calls == [1, 1]
+
+
+def test_parse_cursor():
+    assert routes.parse_cursor(None) is None
+    assert routes.parse_cursor("0") == 0
+    assert routes.parse_cursor("42") == 42
+    for value in ("", "-1", "1.5", "abc"):
+        with pytest.raises(ValueError):
+            routes.parse_cursor(value)
+
+
+def test_reset_cursor():
+    buffer = closed_buffer([1, 2, 3])
+    assert routes.reset_cursor(buffer, None) is None
+    assert routes.reset_cursor(buffer, 3) is None
+    assert routes.reset_cursor(buffer, 4) == 3
+
+
+def test_stream_resumes_after_last_event_id(app_client):
+    client = app_client(dict(b=closed_buffer(["a", "b", "c"])))
+    response = client.get("/opcua/bindings/b/stream", headers={"Last-Event-ID": "1"})
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.get_data(as_text=True) == 'id: 3\ndata: ["b","c"]\n\n'
+    # the query overrides the header
+    response = client.get("/opcua/bindings/b/stream?after=2&format=ndjson", headers={"Last-Event-ID": "0"})
+    assert response.get_data(as_text=True) == '"c"\n'
+
+
+def test_stream_resets_ids_past_the_end_of_the_buffer(app_client):
+    client = app_client(dict(b=closed_buffer(["a", "b"])))
+    response = client.get("/opcua/bindings/b/stream", headers={"Last-Event-ID": "7"})
+    assert response.get_data(as_text=True) == "event: reset\nid: 2\ndata: 2\n\n"
+    response = client.get("/opcua/bindings/b/stream?after=7&format=ndjson")
+    assert response.get_data(as_text=True) == '{"reset": 2}\n'
+
+
+def test_stream_reports_wrapped_around_notifications(app_client):
+    client = app_client(dict(b=closed_buffer([1, 2, 3, 4, 5], capacity=3)))
+    response = client.get("/opcua/bindings/b/stream", headers={"Last-Event-ID": "1"})
+    assert response.get_data(as_text=True) == "event: dropped\ndata: 1\n\nid: 5\ndata: [3,4,5]\n\n"
+    response = client.get("/opcua/bindings/b/stream?format=ndjson&after=0")
+    assert response.get_data(as_text=True) == '{"dropped": 2}\n3\n4\n5\n'
+
+
+def test_stream_errors(app_client):
+    client = app_client(dict(b=closed_buffer([]), down=ConnectionError("server unavailable")))
+    for cursor in ("-1", "abc", "1e3"):
+        response = client.get("/opcua/bindings/b/stream", headers={"Last-Event-ID": cursor})
+        assert response.status_code == 400
+        assert response.get_json() == dict(description="Invalid notification id {0!r}".format(cursor))
+    assert client.get("/opcua/bindings/b/stream?after=x").status_code == 400
+    assert client.get("/opcua/bindings/missing/stream").status_code == 404
+    response = client.get("/opcua/bindings/down/stream")
+    assert response.status_code == 503
+    assert response.get_json() == dict(description="server unavailable")
@@ -0,0 +1,88 @@
+import itertools
+import time
+
+import pytest
+from opcua import ua
+
+from opcua_broker.pool import SessionPool
+from opcua_broker.subscription import DATA_CHANGE, SubscriptionManager
+
+
+# the tests write values of their own to the variables of the stand-in
+values = itertools.count(1000)
+
+
+@pytest.fixture
+def manager():
+    session_pool = SessionPool()
+    manager = SubscriptionManager(session_pool)
+    yield manager
+    manager.close()
+    session_pool.close()
+
+
+def write(variable) -> int:
+    value = next(values)
+    variable.set_value(ua.DataValue(ua.Variant(value, ua.VariantType.Int64)))
+    return value
+
+
+def wait_for(buffer, node: str, value: int, cursor: int=None, timeout: float=5) -> int:
+    """
+    Read buffer from cursor until the record of value for node, and return
+    the cursor after it.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        records, cursor, _ = buffer.read(cursor, timeout=deadline - time.time())
+        if any(record[0] == node and record[1] == value for record in records):
+            return cursor
+    raise AssertionError("no notification of {0} for {1}".format(value, node))
+
+
+def test_bindings_share_monitored_items(standin, manager):
+    shared, other = standin.node_ids(2)
+    first = manager.subscribe("a", DATA_CHANGE, standin.url, nodes=[shared, other], publishing_interval=50,
+                              sampling_interval=0)
+    second = manager.subscribe("b", DATA_CHANGE, standin.url, nodes=[shared], publishing_interval=50,
+                               sampling_interval=0)
+    assert manager.stats() == {(standin.url, "", 50): dict(items=2, subscribers=2)}
+    group = manager._subscribers["a"].group
+    assert manager._subscribers["b"].group is group
+    assert group.items[(DATA_CHANGE, shared, 0, 0)].subscribers == [manager._subscribers["a"],
+                                                                     manager._subscribers["b"]]
+
+    value = write(standin.variables[0])
+    wait_for(first, shared, value)
+    cursor = wait_for(second, shared, value)
+
+    manager.unsubscribe("a")
+    assert first.closed
+    assert manager.stats() == {(standin.url, "", 50): dict(items=1, subscribers=1)}
+    assert list(group.items) == [(DATA_CHANGE, shared, 0, 0)]
+    # the item shared with the binding left is still monitored on the server
+    value = write(standin.variables[0])
+    wait_for(second, shared, value, cursor)
+
+    manager.unsubscribe("b")
+    assert second.closed
+    assert manager.stats() == dict()
+
+
+def test_subscribing_again_to_the_same_node_adds_no_item(standin, manager):
+    node = standin.node_ids(3)[2]
+    first = manager.subscribe("a", DATA_CHANGE, standin.url, nodes=[node], publishing_interval=60,
+                              sampling_interval=0)
+    second = manager.subscribe("b", DATA_CHANGE, standin.url, nodes=[node, node], publishing_interval=60,
+                               sampling_interval=0)
+    assert manager.stats() == {(standin.url, "", 60): dict(items=1, subscribers=2)}
+    assert manager._subscribers["b"].item_keys == [(DATA_CHANGE, node, 0, 0)]
+
+    value = write(standin.variables[2])
+    wait_for(first, node, value)
+    wait_for(second, node, value)
+
+    group = manager._subscribers["b"].group
+    assert group.remove(manager._subscribers["b"]) == 1
+    assert group.remove(manager._subscribers["a"]) == 0
+    assert group.items == dict()
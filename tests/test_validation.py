@@ -0,0 +1,84 @@
+import pytest
+
+from opcua_broker import catalog
+from opcua_broker.validation import InvalidParameters, Validator
+
+
+NODE_MANAGEMENT_PLAN = "00000000-0000-0000-0000-000000000002"
+
+
+def errors(schema: dict, value) -> list:
+    return Validator(schema).errors(value)
+
+
+def test_types():
+    assert errors(dict(type="integer"), 3) == []
+    assert errors(dict(type="integer"), 3.0) == []
+    assert errors(dict(type="integer"), 3.5) == ["parameters: expected integer, got number"]
+    assert errors(dict(type="number"), True) == ["parameters: expected number, got boolean"]
+    assert errors(dict(type=["string", "number"]), 2) == []
+    assert errors(dict(type=["string", "number"]), None) == ["parameters: expected string or number, got null"]
+
+
+def test_wrong_type_skips_the_other_keywords():
+    assert errors(dict(type="string", minLength=3, pattern="^a"), 12) == ["parameters: expected string, got integer"]
+
+
+def test_objects():
+    schema = dict(type="object", required=["url"], additionalProperties=False,
+                  properties=dict(url=dict(type="string"), nodes=dict(type="array")))
+    assert errors(schema, dict(url="opc.tcp://x")) == []
+    assert errors(schema, dict(nodes=[], other=1)) == ["url: is required", "other: is not allowed"]
+    assert errors(dict(additionalProperties=dict(type="integer")), dict(a=1, b="2")) == [
+        "b: expected integer, got string"]
+
+
+def test_arrays_and_ranges():
+    schema = dict(type="array", minItems=1, maxItems=2, items=dict(type="integer", minimum=0, maximum=10))
+    assert errors(schema, [0, 10]) == []
+    assert errors(schema, []) == ["parameters: expected at least 1 items, got 0"]
+    assert errors(schema, [-1, 11, 5]) == ["parameters: expected at most 2 items, got 3",
+                                           "parameters[0]: -1 is below the minimum of 0",
+                                           "parameters[1]: 11 is above the maximum of 10"]
+    assert errors(dict(minimum=0, exclusiveMinimum=True), 0) == ["parameters: 0 is below the minimum of 0"]
+
+
+def test_strings_and_enums():
+    assert errors(dict(minLength=2, maxLength=3), "a") == ["parameters: expected at least 2 characters"]
+    assert errors(dict(pattern="^opc\\.tcp://"), "http://x") == ["parameters: 'http://x' does not match ^opc\\.tcp://"]
+    assert errors(dict(enum=["a", "b"]), "c") == ["parameters: 'c' is not one of ['a', 'b']"]
+
+
+def test_nested_paths():
+    child = dict(properties=dict(nodeClass=dict(type="number")))
+    node = dict(properties=dict(browseName=dict(type="string"), children=dict(items=child)))
+    schema = dict(properties=dict(nodesToAdd=dict(items=node)))
+    value = dict(nodesToAdd=[dict(browseName="2:A"), dict(browseName=1, children=[dict(nodeClass="x")])])
+    assert errors(schema, value) == ["nodesToAdd[1].browseName: expected string, got integer",
+                                     "nodesToAdd[1].children[0].nodeClass: expected number, got string"]
+
+
+def test_validate_raises_every_error():
+    with pytest.raises(InvalidParameters) as e:
+        Validator(dict(required=["a", "b"])).validate(dict())
+    assert e.value.errors == ["a: is required", "b: is required"]
+    assert str(e.value) == "invalid parameters: a: is required; b: is required"
+
+
+def test_plan_schema_lists_every_error():
+    service_catalog = catalog.Catalog.load()
+    parameters = dict(nodesToAdd=[dict(browseName="2:A{0}".format(i), parentNodeId="i=85") for i in range(3)] +
+                      [dict(browseName=4, parentNodeId="i=85")])
+    with pytest.raises(InvalidParameters) as e:
+        service_catalog.validate(NODE_MANAGEMENT_PLAN, catalog.SERVICE_INSTANCE, parameters)
+    assert str(e.value) == ("invalid parameters: url: is required; "
+                            "nodesToAdd[3].browseName: expected string, got integer")
+
+    service_catalog.validate(NODE_MANAGEMENT_PLAN, catalog.SERVICE_INSTANCE,
+                             dict(url="opc.tcp://x", nodesToAdd=parameters["nodesToAdd"][:3]))
+
+
+def test_missing_parameters_are_checked_as_empty():
+    with pytest.raises(InvalidParameters) as e:
+        catalog.Catalog.load().validate(NODE_MANAGEMENT_PLAN, catalog.SERVICE_INSTANCE, None)
+    assert "url: is required" in e.value.errors